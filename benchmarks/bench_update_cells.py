@@ -0,0 +1,79 @@
+""" Per-write overhead of SqliteTable._update_cells
+
+Compares the previous implementation (SQL rebuilt on every call, UPDATE then
+INSERT on a miss, missing columns found by parsing OperationalError) with
+the current one, with and without its statement cache.
+
+    python -m benchmarks.bench_update_cells [writes]
+
+Run from the repository root.
+"""
+import random
+import re
+import sqlite3
+import sys
+from time import perf_counter
+from sqlite_shelf.sqliteshelf import SqliteTable
+
+
+class LegacySqliteTable(SqliteTable):
+    __slots__ = ()
+
+    def _update_cells(self, row, values):
+        values = {str(k): v for k, v in values.items()}
+        values["_id"] = row
+        while True:
+            try:
+                self._c.execute('UPDATE %s SET "%s WHERE _id = :_id' %
+                                    (self._table, ', "'.join(map(lambda x: x+'" = :'+x, filter(lambda x: x!="_id", values.keys())))),
+                                    values)
+                if self._c.rowcount == 0:
+                    self._c.execute('INSERT INTO "%s" ("%s") VALUES (:%s)' % (self._table, '", "'.join(values.keys()), ", :".join(values.keys())), values)
+                return
+            except sqlite3.OperationalError as e:
+                match = re.match(r"no such column: (\w+)", e.args[0])
+                if match:
+                    self._add_column(match.group(1), values[match.group(1)])
+                    continue
+                raise
+
+
+def workload(writes, rows=10000, columns=20, seed=0):
+    "Mostly single cell writes (row[col] = value), one in ten a whole row"
+    rnd = random.Random(seed)
+    names = ['c%d' % n for n in range(columns)]
+    ret = []
+    for _ in range(writes):
+        if rnd.random() < 0.1:
+            values = {col: rnd.random() for col in names}
+        else:
+            values = {rnd.choice(names): rnd.random()}
+        ret.append((str(rnd.randrange(rows)), values))
+    return ret
+
+
+def run(cls, writes, repeat=3, **kwds):
+    "Best of repeat runs, in microseconds per write"
+    best = None
+    for _ in range(repeat):
+        conn = sqlite3.connect(':memory:')
+        table = cls(conn, **kwds)
+        start = perf_counter()
+        for row, values in writes:
+            table._update_cells(row, values)
+        seconds = perf_counter() - start
+        conn.close()
+        best = seconds if best is None else min(best, seconds)
+    return best / len(writes) * 1e6
+
+
+def main(argv):
+    writes = workload(int(argv[1]) if len(argv) > 1 else 50000)
+    for name, cls, kwds in [('before (UPDATE + INSERT, regex retry)', LegacySqliteTable, {}),
+                            ('after, statement cache disabled', SqliteTable, {'sql_cache_size':0}),
+                            ('after', SqliteTable, {})]:
+        print('%-40s %8.2f us/write' % (name, run(cls, writes, **kwds)))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,298 @@
+""" Workloads run against every MutableTable backend
+
+    python -m benchmarks.suite run [-o results.json] [--rows N] [--backend B ...] [--workload W ...]
+    python -m benchmarks.suite compare baseline.json results.json [--threshold 0.1]
+
+Run from the repository root.
+
+Each (backend, workload) pair runs in its own subprocess, so its peak RSS is
+its own. Results are JSON: ops/sec, latency percentiles in microseconds and
+peak RSS in KiB. Latencies are sampled per timed call: a single operation,
+or a whole batch (bulk_insert) or scan (full_scan). compare exits with status 1 if a pair lost more than
+threshold of its ops/sec or of its p99 latency.
+"""
+from contextlib import contextmanager
+from time import perf_counter
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from sqlite_shelf.mutabletable import DictTable
+from sqlite_shelf.sqliteshelf import SqliteTable
+from sqlite_shelf.csvshelf import CsvTable, LazyCsvTable
+from sqlite_shelf.columnartable import ColumnarTable
+from sqlite_shelf.shardedshelf import ShardedTable
+from sqlite_shelf.sparseshelf import SparseSqliteTable
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+@contextmanager
+def dict_table(directory):
+    yield DictTable()
+
+
+@contextmanager
+def sqlite_table(directory):
+    conn = sqlite3.connect(os.path.join(directory, 'table.db'))
+    table = SqliteTable(conn)
+    try:
+        yield table
+    finally:
+        table.close()
+        conn.commit()
+        conn.close()
+
+
+@contextmanager
+def sparse_sqlite_table(directory):
+    conn = sqlite3.connect(os.path.join(directory, 'table.db'))
+    table = SparseSqliteTable(conn)
+    try:
+        yield table
+    finally:
+        table.close()
+        conn.commit()
+        conn.close()
+
+
+@contextmanager
+def csv_table(directory):
+    table = CsvTable(os.path.join(directory, 'table.csv'))
+    yield table
+    table.close()
+
+
+@contextmanager
+def lazy_csv_table(directory):
+    table = LazyCsvTable(os.path.join(directory, 'table.csv'))
+    yield table
+    table.close()
+
+
+@contextmanager
+def columnar_table(directory):
+    yield ColumnarTable()
+
+
+@contextmanager
+def sharded_table(directory):
+    table = ShardedTable(os.path.join(directory, 'shards'), shards=4)
+    yield table
+    table.close()
+
+
+BACKENDS = {'dict':dict_table, 'sqlite':sqlite_table, 'sparse':sparse_sqlite_table, 'csv':csv_table,
+            'lazycsv':lazy_csv_table, 'columnar':columnar_table, 'sharded':sharded_table}
+
+
+def make_rows(rows, columns, filled, rnd):
+    "rows rows of filled cells each, out of columns columns"
+    names = ['c%d' % n for n in range(columns)]
+    ret = []
+    for n in range(rows):
+        cols = names if filled == columns else rnd.sample(names, filled)
+        ret.append(('r%d' % n, {col: rnd.random() for col in cols}))
+    return names, ret
+
+
+def timed(ops):
+    "Runs each op, Returns: per-op latencies in seconds"
+    latencies = []
+    for op in ops:
+        start = perf_counter()
+        op()
+        latencies.append(perf_counter() - start)
+    return latencies
+
+
+def bulk_insert(table, rows, rnd, batch=100):
+    "update() in batches, one op per row, latencies per batch"
+    names, data = make_rows(rows, 10, 10, rnd)
+    batches = [dict(data[n:n + batch]) for n in range(0, len(data), batch)]
+    return len(data), timed(lambda b=b: table.update(b) for b in batches)
+
+
+def point_read(table, rows, rnd):
+    names, data = make_rows(rows, 10, 10, rnd)
+    table.update(dict(data))
+    keys = [(rnd.choice(data)[0], rnd.choice(names)) for _ in range(rows)]
+    return rows, timed(lambda row=row, col=col: table[row][col] for row, col in keys)
+
+
+def cell_update(table, rows, rnd):
+    names, data = make_rows(rows, 10, 10, rnd)
+    table.update(dict(data))
+    keys = [(rnd.choice(data)[0], rnd.choice(names), rnd.random()) for _ in range(rows)]
+
+    def update(row, col, value):
+        table[row][col] = value
+    return rows, timed(lambda args=args: update(*args) for args in keys)
+
+
+def row_delete(table, rows, rnd):
+    names, data = make_rows(rows, 10, 10, rnd)
+    table.update(dict(data))
+    keys = [row for row, _ in data]
+    rnd.shuffle(keys)
+
+    def delete(row):
+        del table[row]
+    return rows, timed(lambda row=row: delete(row) for row in keys)
+
+
+def full_scan(table, rows, rnd, repeat=5):
+    "Reads every cell, one op per row, latencies per scan"
+    names, data = make_rows(rows, 10, 10, rnd)
+    table.update(dict(data))
+
+    def scan():
+        for row, view in table.items():
+            for col in names:
+                view[col]
+    return rows * repeat, timed([scan] * repeat)
+
+
+def wide_table(table, rows, rnd):
+    "500 column rows, written whole then read whole"
+    names, data = make_rows(max(rows // 20, 1), 500, 500, rnd)
+    latencies = timed(lambda row=row, cells=cells: table.__setitem__(row, cells) for row, cells in data)
+    latencies += timed(lambda row=row: dict(table[row].items()) for row, _ in data)
+    return len(latencies), latencies
+
+
+def sparse_table(table, rows, rnd):
+    "3 of 1000 columns set per row, written then read"
+    names, data = make_rows(rows, 1000, 3, rnd)
+    latencies = timed(lambda row=row, cells=cells: table.__setitem__(row, cells) for row, cells in data)
+    keys = [(row, rnd.choice(list(cells))) for row, cells in data]
+    latencies += timed(lambda row=row, col=col: table[row][col] for row, col in keys)
+    return len(latencies), latencies
+
+
+WORKLOADS = {'bulk_insert':bulk_insert, 'point_read':point_read, 'cell_update':cell_update,
+             'row_delete':row_delete, 'full_scan':full_scan, 'wide_table':wide_table,
+             'sparse_table':sparse_table}
+
+
+def percentile(ordered, p):
+    return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+
+def peak_rss():
+    "Peak RSS of this process in KiB, None where unavailable"
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def measure(backend, workload, rows, seed=0):
+    "Runs one workload in this process, Returns: result dict"
+    directory = tempfile.mkdtemp()
+    try:
+        with BACKENDS[backend](directory) as table:
+            start = perf_counter()
+            ops, latencies = WORKLOADS[workload](table, rows, random.Random(seed))
+            seconds = perf_counter() - start
+    finally:
+        shutil.rmtree(directory)
+    ordered = sorted(latencies)
+    return {'backend':backend, 'workload':workload, 'ops':ops, 'seconds':seconds,
+            'ops_per_sec':ops / sum(latencies) if sum(latencies) else None,
+            'p50_us':percentile(ordered, 0.5) * 1e6, 'p90_us':percentile(ordered, 0.9) * 1e6,
+            'p99_us':percentile(ordered, 0.99) * 1e6, 'max_us':ordered[-1] * 1e6,
+            'peak_rss_kb':peak_rss()}
+
+
+def run(backends, workloads, rows):
+    "Measures each pair in a subprocess, Returns: results document"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root] + [path for path in sys.path if path]))
+    results = []
+    for backend in backends:
+        for workload in workloads:
+            out = subprocess.check_output([sys.executable, '-m', 'benchmarks.suite', 'measure',
+                                           backend, workload, '--rows', str(rows)], env=env, cwd=root)
+            result = json.loads(out.decode('utf-8'))
+            results.append(result)
+            print('%-10s %-14s %12.0f ops/s  p50 %9.1f us  p99 %9.1f us  rss %s KiB' %
+                  (backend, workload, result['ops_per_sec'] or 0, result['p50_us'], result['p99_us'],
+                   result['peak_rss_kb']), file=sys.stderr)
+    return {'meta':{'python':platform.python_version(), 'platform':platform.platform(),
+                    'sqlite':sqlite3.sqlite_version, 'rows':rows},
+            'results':results}
+
+
+def compare(baseline, current, threshold=0.1):
+    """ Lines comparing two results documents
+    Returns: (lines, number of regressions)
+    """
+    before = {(r['backend'], r['workload']): r for r in baseline['results']}
+    lines = []
+    regressions = 0
+    for r in current['results']:
+        old = before.get((r['backend'], r['workload']))
+        if old is None or not old['ops_per_sec'] or not r['ops_per_sec']:
+            continue
+        speed = r['ops_per_sec'] / old['ops_per_sec']
+        tail = r['p99_us'] / old['p99_us'] if old['p99_us'] else 1.0
+        regressed = speed < 1 - threshold or tail > 1 + threshold
+        regressions += regressed
+        lines.append('%-10s %-14s ops/s x%5.2f  p99 x%5.2f%s' %
+                     (r['backend'], r['workload'], speed, tail, '  REGRESSION' if regressed else ''))
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.suite', description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('run', help='run the suite')
+    command.add_argument('-o', '--output', help='JSON file, defaults to stdout')
+    command.add_argument('--rows', type=int, default=2000)
+    command.add_argument('--backend', action='append', choices=sorted(BACKENDS))
+    command.add_argument('--workload', action='append', choices=sorted(WORKLOADS))
+    command = commands.add_parser('compare', help='compare two runs')
+    command.add_argument('baseline')
+    command.add_argument('current')
+    command.add_argument('--threshold', type=float, default=0.1)
+    command = commands.add_parser('measure', help='run a single pair in this process')
+    command.add_argument('backend', choices=sorted(BACKENDS))
+    command.add_argument('workload', choices=sorted(WORKLOADS))
+    command.add_argument('--rows', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        doc = run(args.backend or sorted(BACKENDS), args.workload or sorted(WORKLOADS), args.rows)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(doc, f, indent=1)
+        else:
+            json.dump(doc, sys.stdout, indent=1)
+        return 0
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        lines, regressions = compare(baseline, current, args.threshold)
+        print('\n'.join(lines))
+        return 1 if regressions else 0
+    if args.command == 'measure':
+        json.dump(measure(args.backend, args.workload, args.rows), sys.stdout)
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,5 +7,4 @@ setup(
     author='eszense',
     classifiers=['Programming Language :: Python :: 3.5'],
     packages=find_packages(exclude=['tests*']),
-    install_requires=['es_commons']
 )
@@ -1 +1,45 @@
-from sqlite_shelf.sqliteshelf import SqliteTable
+""" 2-D dict-like tables backed by SQLite, CSV files or memory
+
+Backends are imported on first use, so `import sqlite_shelf` loads none of
+them (nor sqlite3) until e.g. sqlite_shelf.SqliteTable is accessed.
+"""
+import importlib
+import sys
+import types
+
+
+# Exported name -> submodule defining it
+_exports = {
+    'MutableTable':'mutabletable', 'DictTable':'mutabletable', 'MutableRowView':'mutabletable',
+    'SqliteTable':'sqliteshelf', 'IngestStats':'sqliteshelf',
+    'SparseSqliteTable':'sparseshelf', 'open_table':'sparseshelf',
+    'CsvTable':'csvshelf', 'LazyCsvTable':'csvshelf',
+    'ColumnarTable':'columnartable',
+    'ShardedTable':'shardedshelf',
+    'SqliteTablePool':'pool',
+    'AsyncSqliteTable':'asyncshelf',
+    'SnapshotTable':'snapshot', 'write_snapshot':'snapshot',
+    'Codec':'serialization',
+    'import_csv':'transfer', 'export_csv':'transfer', 'copy_rows':'transfer',
+}
+
+__all__ = sorted(_exports)
+
+
+class _LazyModule(types.ModuleType):
+    "Package module importing the submodule of an exported name when it is first accessed"
+
+    def __getattr__(self, name):
+        module = _exports.get(name)
+        if module is None:
+            raise AttributeError("module %r has no attribute %r" % (self.__name__, name))
+        value = getattr(importlib.import_module('%s.%s' % (self.__name__, module)), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(types.ModuleType.__dir__(self)) | set(_exports))
+
+
+# Module level __getattr__ needs Python 3.7, swapping the class works from 3.5
+sys.modules[__name__].__class__ = _LazyModule
@@ -0,0 +1,236 @@
+""" asyncio interface to SqliteTable
+
+    table = AsyncSqliteTable('shelf.db')
+    await table.set('a', {'x': 1})
+    cells = await table.get('a')
+    async for row, cells in table.iter_rows():
+        ...
+    await table.close()
+
+The connection and its SqliteTable live on one dedicated executor thread,
+so the event loop never blocks on SQLite. Calls run in the order they are
+made; writes do not wait for each other, they are queued back to back and
+committed together once the queue drains, or once max_batch writes or
+max_batch_age seconds are pending, and each write resolves after that
+commit. Each write runs in its own savepoint, so one that raises is undone
+alone.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import sqlite3
+import threading
+from sqlite_shelf.sqliteshelf import SqliteTable
+
+
+# Python 3.7+, the event loop of a coroutine is the current one before
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class AsyncRowIterator(object):
+    """ Async iterator over (row, cells dict) pairs of a SqliteTable generator
+    The generator is created and advanced on the executor thread, prefetch
+    pairs at a time.
+    """
+    __slots__ = ('_table', '_make', '_items', '_buffer', '_prefetch', '_done')
+
+    def __init__(self, table, make, prefetch):
+        self._table = table
+        self._make = make
+        self._items = None
+        self._buffer = []
+        self._prefetch = prefetch
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._buffer:
+            if self._done:
+                raise StopAsyncIteration
+            self._buffer = await self._table._read(self._next_chunk)
+            self._buffer.reverse()
+            if not self._buffer:
+                raise StopAsyncIteration
+        return self._buffer.pop()
+
+    def _next_chunk(self):
+        if self._items is None:
+            self._items = self._make()
+        chunk = []
+        for item in self._items:
+            chunk.append(item)
+            if len(chunk) >= self._prefetch:
+                break
+        else:
+            self._done = True
+        return chunk
+
+
+class AsyncSqliteTable(object):
+    """ Awaitable SqliteTable operations on a connection owned by an executor thread
+    path and the keywords are passed to sqlite3.connect() and SqliteTable.
+    max_batch, max_batch_age: commit once that many writes, or writes that
+                              old, are pending even if more are queued
+    Rows are read as plain (decoded) cells dicts.
+    """
+
+    def __init__(self, path, table="DefaultTable", max_batch=1000, max_batch_age=0.1, **kwds):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self.max_batch = max_batch
+        self.max_batch_age = max_batch_age
+        self._queued = 0
+        self._done = []
+        self._batch_start = None
+        self._commits = 0
+        self._table = None
+        self._executor.submit(self._open, path, table, kwds).result()
+
+    def _open(self, path, table, kwds):
+        self._table = SqliteTable(sqlite3.connect(path), table, **kwds)
+        self._table._c.connection.commit()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def get(self, row):
+        "Raises: KeyError"
+        return await self._read(self._get, row)
+
+    def _get(self, row):
+        table = self._table
+        return dict(table._decode_cells(table._read_cells(row)))
+
+    async def get_many(self, rows):
+        "{row: cells} of the rows present, in one executor hop"
+        return await self._read(self._get_many, list(rows))
+
+    def _get_many(self, rows):
+        ret = dict()
+        for row in rows:
+            try:
+                ret[row] = self._get(row)
+            except KeyError:
+                pass
+        return ret
+
+    async def set(self, row, cells):
+        "Like table[row] = cells: replaces the row, None removes it"
+        await self._write(self._table.__setitem__, row, cells)
+
+    async def update(self, row, cells):
+        "Like table[row].update(cells), creating the row if needed"
+        await self._write(self._table._write_cells, row, dict(cells))
+
+    async def delete(self, row):
+        "Raises: KeyError"
+        await self._write(self._table.__delitem__, row)
+
+    async def bulk_update(self, rows):
+        "SqliteTable.bulk_update, Returns: IngestStats"
+        if hasattr(rows, "keys"):
+            rows = [(key, rows[key]) for key in rows.keys()]
+        else:
+            rows = list(rows)
+        return await self._write(self._table.bulk_update, rows)
+
+    async def contains(self, row):
+        return await self._read(self._table.__contains__, row)
+
+    async def len(self):
+        return await self._read(self._table.__len__)
+
+    async def keys(self):
+        return await self._read(lambda: list(self._table))
+
+    def iter_rows(self, chunk_size=None):
+        "async for row, cells in table.iter_rows(): streams in rowid order"
+        chunk_size = chunk_size or self._table.chunk_size
+        return AsyncRowIterator(self, lambda: self._table.iter_rows(chunk_size), chunk_size)
+
+    def query(self, columns=None, where=None, order_by=None, limit=None, prefetch=100):
+        "async for row, cells in table.query(...): see SqliteTable.query"
+        return AsyncRowIterator(self, lambda: self._table.query(columns, where, order_by, limit), prefetch)
+
+    async def run(self, func, *args):
+        "Runs func(table, *args) on the executor thread as a write"
+        return await self._write(func, self._table, *args)
+
+    async def commit(self):
+        "Waits until every write made so far is committed"
+        await self._write(lambda: None)
+
+    async def close(self):
+        "Commits outstanding writes, closes the connection and stops the executor"
+        await self.commit()
+        await self._read(self._close)
+        self._executor.shutdown()
+
+    def _close(self):
+        self._table.close()
+        self._table._c.connection.close()
+
+    def _read(self, func, *args):
+        return _running_loop().run_in_executor(self._executor, func, *args)
+
+    def _write(self, func, *args):
+        loop = _running_loop()
+        future = loop.create_future()
+        with self._lock:
+            self._queued += 1
+        self._executor.submit(self._run_write, loop, future, func, args)
+        return future
+
+    def _run_write(self, loop, future, func, args):
+        """ Runs on the executor thread, in a savepoint
+        Commits once no further write is queued, or the batch is full or old
+        """
+        conn = self._table._c.connection
+        if not conn.in_transaction:
+            conn.execute('BEGIN')
+            self._table._schema_checked = False
+        if self._batch_start is None:
+            self._batch_start = perf_counter()
+        conn.execute('SAVEPOINT write')
+        try:
+            result = func(*args)
+        except BaseException as e:
+            conn.execute('ROLLBACK TO write')
+            conn.execute('RELEASE write')
+            # Columns the write added are gone again
+            self._table._discard_pending()
+            self._table._schema = None
+            self._done.append((future, False, e))
+        else:
+            conn.execute('RELEASE write')
+            self._done.append((future, True, result))
+        with self._lock:
+            self._queued -= 1
+            if self._queued and len(self._done) < self.max_batch and \
+                    perf_counter() - self._batch_start < self.max_batch_age:
+                return
+        done, self._done = self._done, []
+        self._batch_start = None
+        try:
+            conn.commit()
+        except BaseException as e:
+            conn.rollback()
+            self._table._schema = None
+            done = [(future, False, e) for future, ok, result in done]
+        self._commits += 1
+        loop.call_soon_threadsafe(self._resolve, done)
+
+    @staticmethod
+    def _resolve(done):
+        for future, ok, result in done:
+            if future.cancelled():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
@@ -0,0 +1,289 @@
+from array import array
+from contextlib import contextmanager
+from itertools import compress
+import operator
+from sqlite_shelf.mutabletable import MutableTable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_TOMBSTONE = object()
+
+_operators = {'=':operator.eq, '!=':operator.ne, '<':operator.lt,
+              '<=':operator.le, '>':operator.gt, '>=':operator.ge}
+
+
+def _typecode(value):
+    "array typecode able to hold value, None if it needs a Python object"
+    if value.__class__ is int:
+        return 'q'
+    if value.__class__ is float:
+        return 'd'
+    return None
+
+
+class _Column(object):
+    """ Values by position, with a null bitmap (bit set = null)
+
+    Holds an array('q') / array('d') while every value written fits the
+    type, falls back to a list of objects otherwise. The type is picked by
+    the first non-null value written.
+    """
+    __slots__ = ('values', 'nulls', 'typed')
+
+    def __init__(self, size):
+        self.values = array('q', bytes(8 * size))
+        self.nulls = bytearray(b'\xff' * ((size + 7) >> 3))
+        self.typed = False
+
+    def append_null(self, pos):
+        if isinstance(self.values, list):
+            self.values.append(None)
+        else:
+            self.values.append(0)
+        if not pos & 7:
+            self.nulls.append(0xff)
+
+    def is_null(self, pos):
+        return self.nulls[pos >> 3] >> (pos & 7) & 1
+
+    def get(self, pos):
+        if self.is_null(pos):
+            return None
+        return self.values[pos]
+
+    def set(self, pos, value):
+        if value is None:
+            self.nulls[pos >> 3] |= 1 << (pos & 7)
+            return
+        values = self.values
+        if not isinstance(values, list):
+            typecode = _typecode(value)
+            if typecode is None:
+                self._to_list()
+            elif not self.typed:
+                if typecode != values.typecode:
+                    self.values = array(typecode, bytes(array(typecode).itemsize * len(values)))
+                self.typed = True
+            elif typecode != values.typecode:
+                self._to_list()
+        try:
+            self.values[pos] = value
+        except OverflowError:
+            self._to_list()
+            self.values[pos] = value
+        self.nulls[pos >> 3] &= ~(1 << (pos & 7)) & 0xff
+
+    def take(self, positions):
+        "New column holding only the given positions, in order"
+        column = _Column(0)
+        column.typed = self.typed
+        if isinstance(self.values, list):
+            column.values = [self.values[pos] for pos in positions]
+        else:
+            column.values = array(self.values.typecode, (self.values[pos] for pos in positions))
+        column.nulls = bytearray(b'\xff' * ((len(column.values) + 7) >> 3))
+        for new, pos in enumerate(positions):
+            if not self.is_null(pos):
+                column.nulls[new >> 3] &= ~(1 << (new & 7)) & 0xff
+        return column
+
+    def _to_list(self):
+        self.values = [self.get(pos) for pos in range(len(self.values))]
+        self.typed = True
+
+
+class ColumnarTable(MutableTable):
+    """ In-memory table storing each column as a typed array with a null bitmap
+
+    Rows are appended, deleted rows are tombstoned until compact() (run
+    automatically once tombstones outnumber live rows). Numeric columns can
+    be aggregated and filtered without building rows, using NumPy if
+    installed.
+
+    Masks select rows by position, which compact() shifts: a mask is valid
+    until the next compaction, the automatic ones included. Deleting rows
+    while masks are in use must happen inside keep_positions().
+    """
+
+    def __init__(self, compact_threshold=1024):
+        MutableTable.__init__(self)
+        self._index = dict()
+        self._ids = []
+        self._live = bytearray()
+        self._columns = dict()
+        self._deleted = 0
+        self._kept = 0
+        self.compact_threshold = compact_threshold
+
+    @contextmanager
+    def keep_positions(self):
+        """ Defers automatic compaction to the end of the block, so masks stay valid in it
+            with table.keep_positions():
+                mask = table.column_mask('n', '>', 0)
+                for row in list(table.mask_rows(mask)):
+                    del table[row]
+        """
+        self._kept += 1
+        try:
+            yield self
+        finally:
+            self._kept -= 1
+            if not self._kept and self._compaction_due():
+                self.compact()
+
+    def _compaction_due(self):
+        return self._deleted > max(self.compact_threshold, len(self._index))
+
+    def compact(self):
+        """ Reclaim the space of deleted rows
+        Masks made before are stale afterwards.
+        """
+        positions = [pos for pos, row in enumerate(self._ids) if row is not _TOMBSTONE]
+        for col, column in self._columns.items():
+            self._columns[col] = column.take(positions)
+        self._ids = [self._ids[pos] for pos in positions]
+        self._live = bytearray(b'\x01' * len(positions))
+        self._index = dict(zip(self._ids, range(len(positions))))
+        self._deleted = 0
+
+    def column_sum(self, col, mask=None):
+        values = self._valid_values(col, mask)
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            return values.sum().item()
+        return sum(values)
+
+    def column_min(self, col, mask=None):
+        "Raises: ValueError if there is no value"
+        values = self._valid_values(col, mask)
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            if not len(values):
+                raise ValueError("column_min() of empty column %s" % col)
+            return values.min().item()
+        return min(values)
+
+    def column_max(self, col, mask=None):
+        "Raises: ValueError if there is no value"
+        values = self._valid_values(col, mask)
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            if not len(values):
+                raise ValueError("column_max() of empty column %s" % col)
+            return values.max().item()
+        return max(values)
+
+    def column_mask(self, col, op, value):
+        """ Mask of rows where the cell compares to value, op being one of = != < <= > >=
+        Nulls never match. Masks can be passed to column_* / mask_rows and
+        combined with mask_and, until the table is compacted; rows appended
+        since are not selected.
+        """
+        compare = _operators[op]
+        column = self._get_column(col)
+        valid = self._valid_mask(column)
+        if numpy is not None and not isinstance(column.values, list):
+            values = numpy.frombuffer(column.values, dtype=column.values.typecode)
+            return bytearray((compare(values, value) & numpy.frombuffer(valid, dtype=bool)).view(numpy.uint8))
+        return bytearray(ok and compare(v, value) for ok, v in zip(valid, column.values))
+
+    @staticmethod
+    def mask_and(*masks):
+        return bytearray(all(bits) for bits in zip(*masks))
+
+    def mask_rows(self, mask):
+        """ Yields the row ids selected by mask
+        Raises: ValueError if mask was made before a compaction
+        """
+        self._check_mask(mask)
+        return compress(self._ids, mask)
+
+    def _check_mask(self, mask):
+        "Raises: ValueError if mask covers more positions than the table, i.e. predates a compaction"
+        if len(mask) > len(self._ids):
+            raise ValueError("Mask of %d positions is stale, the table holds %d since compacted"
+                             % (len(mask), len(self._ids)))
+
+    def rename_column(self, old, new):
+        "Raises: KeyError if old does not exist, ValueError if new does"
+        self._check_rename(old, new)
+        self._undo_all()
+        self._columns[new] = self._columns.pop(old)
+        self._columns_changed()
+
+    def drop_column(self, col):
+        "Raises: KeyError"
+        self._check_column(col)
+        self._undo_all()
+        del self._columns[col]
+        self._columns_changed()
+
+    def _iter_column(self, col):
+        column = self._columns.get(col)
+        for row, pos in self._index.items():
+            yield row, None if column is None else column.get(pos)
+
+    def _get_column(self, col):
+        try:
+            return self._columns[col]
+        except KeyError:
+            raise KeyError("Column %s does not exists" % col)
+
+    def _valid_mask(self, column):
+        "Live and non-null positions"
+        size = len(self._ids)
+        if numpy is not None:
+            nulls = numpy.unpackbits(numpy.frombuffer(column.nulls, dtype=numpy.uint8), bitorder='little')[:size]
+            live = numpy.frombuffer(self._live, dtype=numpy.uint8)
+            return bytearray(live & (nulls ^ 1))
+        return bytearray(live and not column.is_null(pos) for pos, live in enumerate(self._live))
+
+    def _valid_values(self, col, mask):
+        column = self._get_column(col)
+        valid = self._valid_mask(column)
+        if mask is not None:
+            self._check_mask(mask)
+            valid = self.mask_and(valid, mask)
+        if numpy is not None and not isinstance(column.values, list):
+            values = numpy.frombuffer(column.values, dtype=column.values.typecode)
+            return values[numpy.frombuffer(valid, dtype=bool)]
+        return list(compress(column.values, valid))
+
+    def _del_row(self, row):
+        try:
+            pos = self._index.pop(row)
+        except KeyError:
+            raise KeyError("Row with id %s does not exists" % row)
+        self._ids[pos] = _TOMBSTONE
+        self._live[pos] = 0
+        self._deleted += 1
+        if not self._kept and self._compaction_due():
+            self.compact()
+
+    def _update_cells(self, row, values):
+        pos = self._index.get(row)
+        if pos is None:
+            pos = self._index[row] = len(self._ids)
+            self._ids.append(row)
+            self._live.append(1)
+            for column in self._columns.values():
+                column.append_null(pos)
+        for col, value in values.items():
+            column = self._columns.get(col)
+            if column is None:
+                column = self._columns[col] = _Column(len(self._ids))
+            column.set(pos, value)
+
+    def _get_cells(self, row):
+        try:
+            pos = self._index[row]
+        except KeyError:
+            raise KeyError("Row with id %s does not exists" % row)
+        return {col: column.get(pos) for col, column in self._columns.items()}
+
+    def _get_column_names(self):
+        return self._columns.keys()
+
+    def _get_row_names(self):
+        return self._index.keys()
@@ -1,31 +1,211 @@
-from collections import Mapping, MutableMapping
-from es_commons.suppress2 import suppress
-import re
-from sqlite_shelf.mutabletable import DictTable
+from collections import OrderedDict
+import io
+import os
+from sqlite_shelf.mutabletable import MutableTable, DictTable
 import csv
 
 
+def write_rows(csvfile, columns, rows):
+    "Streams (row, cells) as CSV records, _id first and None as empty"
+    writer = csv.writer(csvfile)
+    for row, cells in rows:
+        record = [row]
+        record.extend([cells.get(col) for col in columns])
+        writer.writerow(record)
+
+
+def read_record(f):
+    """ Reads one CSV record, which may span lines, from a binary file
+    Returns: (offset, fields), or None at end of file
+    """
+    offset = f.tell()
+    lines = []
+    quotes = 0
+    while True:
+        line = f.readline()
+        if not line:
+            break
+        lines.append(line)
+        quotes += line.count(b'"')
+        if not quotes % 2:
+            break
+    if not lines:
+        return None
+    text = b''.join(lines).decode('utf-8-sig' if offset == 0 else 'utf-8')
+    return offset, next(csv.reader(io.StringIO(text, newline='')))
+
+
 class CsvTable(DictTable):
     __slots__ = ('_path')
-    
-    
+
+
     def __init__(self, path):
         self._path = path
         DictTable.__init__(self)
-        
+
     def close(self):
         with open(self._path, 'w', encoding='utf-8',newline="\n") as csvfile:
             csvfile.write(u'\ufeff')
             fieldnames = ['_id']
             fieldnames.extend(sorted(self._cols))
-            
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction="ignore")
-            writer.writeheader()
-            row_lists = []
-            for row in self._rows:
-                row_dict = {'_id':row}
-                for col in self._cols:
-                    row_dict[col] = self._cells.get((row,col), None)
-                row_lists.append(row_dict)
-            writer.writerows(row_lists)
-            
+            csv.writer(csvfile).writerow(fieldnames)
+            write_rows(csvfile, fieldnames[1:], self._rows.items())
+
+
+class LazyCsvTable(CsvTable):
+    """ CsvTable reading an existing file on demand
+
+    Opening only indexes the byte offset of each _id; rows are read when
+    accessed and scans read the file sequentially. Writes are kept in memory
+    until close(), which streams the merged rows to a new file, or just
+    appends the new rows if no existing row or column was changed.
+
+    N.B. CSV has no NULL, empty cells read back as None
+    """
+
+    def __init__(self, path):
+        CsvTable.__init__(self, path)
+        self._index = OrderedDict()
+        self._new = OrderedDict()
+        self._header = []
+        self._dirty = False
+        try:
+            self._file = open(path, 'rb')
+        except FileNotFoundError:
+            self._file = None
+        else:
+            self._build_index()
+
+    def _build_index(self):
+        record = read_record(self._file)
+        if record is None:
+            return
+        self._header = record[1][1:]
+        for col in self._header:
+            self._cols.setdefault(col)
+        while True:
+            record = read_record(self._file)
+            if record is None:
+                break
+            offset, fields = record
+            if fields:
+                self._index[fields[0]] = offset
+
+    def _read_file_row(self, offset, fields=None):
+        if fields is None:
+            self._file.seek(offset)
+            fields = read_record(self._file)[1]
+        return {col: value if value != '' else None
+                for col, value in zip(self._header, fields[1:]) if col is not None}
+
+    def close(self):
+        if not self._dirty and self._header:
+            self._append()
+        else:
+            self._rewrite()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _append(self):
+        if not self._new:
+            return
+        self._file.seek(-1, os.SEEK_END)
+        terminated = self._file.read(1) == b'\n'
+        with open(self._path, 'a', encoding='utf-8', newline="\n") as csvfile:
+            if not terminated:
+                csvfile.write('\r\n')
+            write_rows(csvfile, self._header,
+                       ((row, self._rows[row]) for row in self._new))
+
+    def _rewrite(self):
+        temp = self._path + '.tmp'
+        with open(temp, 'w', encoding='utf-8', newline="\n") as csvfile:
+            csvfile.write(u'\ufeff')
+            fieldnames = ['_id']
+            fieldnames.extend(sorted(self._cols))
+            csv.writer(csvfile).writerow(fieldnames)
+            write_rows(csvfile, fieldnames[1:], self._iter_cells())
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        os.replace(temp, self._path)
+
+    def _iter_cells(self):
+        "Reads the file sequentially, then yields the new rows"
+        if self._index:
+            # Own handle, point reads seek the shared one
+            with open(self._path, 'rb') as f:
+                read_record(f)
+                while True:
+                    record = read_record(f)
+                    if record is None:
+                        break
+                    offset, fields = record
+                    if not fields or self._index.get(fields[0]) != offset:
+                        continue
+                    cells = dict.fromkeys(self._cols)
+                    cells.update(self._read_file_row(offset, fields))
+                    cells.update(self._rows.get(fields[0], ()))
+                    yield fields[0], cells
+        for row in list(self._new):
+            if row in self._new:
+                yield row, DictTable._get_cells(self, row)
+
+    def _iter_items(self):
+        return self._prefetched_items(self._iter_cells())
+
+    fill_column = MutableTable.fill_column
+    _iter_column = MutableTable._iter_column
+    _new_savepoint = MutableTable._new_savepoint
+    _undo_state = MutableTable._undo_state
+    _restore_savepoint = MutableTable._restore_savepoint
+
+    def rename_column(self, old, new):
+        "Raises: KeyError if old does not exist, ValueError if new does"
+        DictTable.rename_column(self, old, new)
+        self._header = [new if col == old else col for col in self._header]
+        self._dirty = True
+
+    def drop_column(self, col):
+        "Raises: KeyError"
+        DictTable.drop_column(self, col)
+        # Dropped columns stay as placeholders, to keep the file's field positions
+        self._header = [None if name == col else name for name in self._header]
+        self._dirty = True
+
+    def _del_row(self, row):
+        if row in self._index:
+            del self._index[row]
+            self._rows.pop(row, None)
+            self._dirty = True
+            return
+        DictTable._del_row(self, row)
+        del self._new[row]
+
+    def _update_cells(self, row, values):
+        if row in self._index:
+            self._dirty = True
+        elif row not in self._new:
+            self._new[row] = None
+        if not all(col in self._cols for col in values):
+            self._dirty = True
+        DictTable._update_cells(self, row, values)
+
+    def _get_cells(self, row):
+        offset = self._index.get(row)
+        if offset is None:
+            return DictTable._get_cells(self, row)
+        cells = dict.fromkeys(self._cols)
+        cells.update(self._read_file_row(offset))
+        cells.update(self._rows.get(row, ()))
+        return cells
+
+    def _get_row_names(self):
+        return list(self._index) + list(self._new)
+
+    def __contains__(self, row):
+        return row in self._index or row in self._new
+
+    def __len__(self):
+        return len(self._index) + len(self._new)
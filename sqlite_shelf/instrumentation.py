@@ -0,0 +1,227 @@
+""" Per-operation counters and timing histograms for MutableTable backends
+
+    metrics = table.enable_metrics(callback)
+    ...
+    table.metrics_info()['_get_cells'].p99
+
+    with profile(table) as metrics:
+        ...
+
+Enabling swaps the table's class for a subclass timing the backend
+operations (_get_cells, _update_cells, _del_row, _get_column_names,
+_get_row_names), and wraps the cursors of SQLite backends to time each
+statement as sql.<first keyword>, e.g. sql.select, sql.pragma. Disabled
+tables run their plain class, so the instrumentation costs nothing then.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+from time import perf_counter
+from types import GeneratorType
+
+
+OPERATIONS = ('_get_cells', '_update_cells', '_del_row', '_get_column_names', '_get_row_names')
+
+OperationStats = namedtuple('OperationStats', ('count', 'seconds', 'mean', 'max', 'p50', 'p99'))
+
+
+class Histogram(object):
+    """ Timings in power of two microsecond buckets
+    Percentiles are the upper bound of their bucket.
+    """
+    __slots__ = ('count', 'seconds', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.buckets = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = int(seconds * 1e6).bit_length()
+        if bucket >= len(self.buckets):
+            self.buckets.extend([0] * (bucket + 1 - len(self.buckets)))
+        self.buckets[bucket] += 1
+
+    def percentile(self, p):
+        rank = p * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+    def stats(self):
+        return OperationStats(self.count, self.seconds, self.seconds / self.count if self.count else 0.0,
+                              self.max, self.percentile(0.5), self.percentile(0.99))
+
+
+class Metrics(object):
+    """ Histograms by operation name
+    callback(name, seconds) is called on every record, e.g. to export them.
+    """
+    __slots__ = ('callback', '_histograms')
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._histograms = dict()
+
+    def record(self, name, seconds):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram()
+        histogram.add(seconds)
+        if self.callback is not None:
+            self.callback(name, seconds)
+
+    def stats(self):
+        "{name: OperationStats}"
+        return {name: histogram.stats() for name, histogram in self._histograms.items()}
+
+    def reset(self):
+        self._histograms.clear()
+
+
+def _timed_generator(metrics, name, items, seconds):
+    "Yields from items, recording the time spent producing them once done"
+    try:
+        while True:
+            start = perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                seconds += perf_counter() - start
+                return
+            seconds += perf_counter() - start
+            yield item
+    finally:
+        items.close()
+        metrics.record(name, seconds)
+
+
+def _timed_method(name, method):
+    def timed(self, *args):
+        start = perf_counter()
+        try:
+            ret = method(self, *args)
+        except BaseException:
+            self._metrics.record(name, perf_counter() - start)
+            raise
+        if ret.__class__ is GeneratorType:
+            return _timed_generator(self._metrics, name, ret, perf_counter() - start)
+        self._metrics.record(name, perf_counter() - start)
+        return ret
+    timed.__name__ = name
+    timed.__doc__ = method.__doc__
+    return timed
+
+
+_classes = dict()
+
+
+def instrumented_class(cls):
+    "Subclass of cls timing OPERATIONS, with the same layout so instances can switch"
+    ret = _classes.get(cls)
+    if ret is None:
+        ns = {'__slots__':(), '__module__':cls.__module__, '_uninstrumented_class':cls}
+        for name in OPERATIONS:
+            ns[name] = _timed_method(name, getattr(cls, name))
+        ret = _classes[cls] = type(cls.__name__, (cls,), ns)
+    return ret
+
+
+class TimedConnection(object):
+    "sqlite3 connection proxy whose cursors are timed"
+    __slots__ = ('_conn', '_metrics')
+
+    def __init__(self, conn, metrics):
+        self._conn = conn
+        self._metrics = metrics
+
+    def cursor(self):
+        return TimedCursor(self._conn.cursor(), self._metrics)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class TimedCursor(object):
+    "sqlite3 cursor proxy recording each statement as sql.<first keyword>"
+    __slots__ = ('_cursor', '_metrics')
+
+    def __init__(self, cursor, metrics):
+        self._cursor = cursor
+        self._metrics = metrics
+
+    @property
+    def connection(self):
+        return TimedConnection(self._cursor.connection, self._metrics)
+
+    def _timed(self, method, sql, args):
+        start = perf_counter()
+        try:
+            method(sql, *args)
+        finally:
+            self._metrics.record('sql.' + sql.split(None, 1)[0].lower(), perf_counter() - start)
+        return self
+
+    def execute(self, sql, *args):
+        return self._timed(self._cursor.execute, sql, args)
+
+    def executemany(self, sql, *args):
+        return self._timed(self._cursor.executemany, sql, args)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def _sqlite_tables(table):
+    "The table and, for sharded tables, its shards, that have a cursor"
+    return [t for t in [table] + list(getattr(table, '_shards', ())) if hasattr(t, '_c')]
+
+
+def instrument(table, metrics):
+    "Times table's operations into metrics, replacing any previous metrics"
+    uninstrument(table)
+    table._metrics = metrics
+    table.__class__ = instrumented_class(table.__class__)
+    for t in _sqlite_tables(table):
+        t._c = TimedCursor(t._c, metrics)
+    return metrics
+
+
+def uninstrument(table):
+    table.__class__ = getattr(table.__class__, '_uninstrumented_class', table.__class__)
+    for t in _sqlite_tables(table):
+        if isinstance(t._c, TimedCursor):
+            t._c = t._c._cursor
+    table._metrics = None
+
+
+@contextmanager
+def profile(table, callback=None):
+    """ Times table's operations for the block, into the yielded Metrics
+    Metrics enabled before the block are restored after it.
+    """
+    previous = table._metrics
+    metrics = instrument(table, Metrics(callback))
+    try:
+        yield metrics
+    finally:
+        if previous is None:
+            uninstrument(table)
+        else:
+            instrument(table, previous)
@@ -1,7 +1,10 @@
-from collections import Mapping, MutableMapping, deque
-from contextlib import suppress
+from collections import OrderedDict, deque, namedtuple
+from collections.abc import Mapping, MutableMapping, ItemsView, ValuesView
+from contextlib import contextmanager, suppress
 from abc import abstractmethod
 from itertools import count as icount
+import sys
+from sqlite_shelf import instrumentation, query
 
 def count(iterable):
     counter = icount()
@@ -13,31 +16,63 @@ class MutableRowView(MutableMapping):
 
     Behavior:
     - Table is regular, hence del will only fill cell with None
+    - If cells is given (e.g. by streaming iteration), reads are served
+      from that snapshot until the table is written, or for columns it lacks
     """
     
-    __slots__ = ('_parent','_row')
+    __slots__ = ('_parent','_row','_cells','_generation')
     
-    def __init__(self, parent, row):
+    def __init__(self, parent, row, cells=None):
         self._parent = parent
         self._row = row
+        self._cells = cells
+        self._generation = parent._generation
         
     def __delitem__(self, col):
         self[col] = None
        
     def __getitem__(self, col):
-        return self._parent._get_cells(self._row)[col]
+        cells = self._snapshot()
+        if cells is None or col not in cells:
+            cells = self._parent._read_cells(self._row, copy=False)
+        value = cells[col]
+        codec = self._parent._codec
+        if codec is None:
+            return value
+        return codec.decode(value)
         
     def __iter__(self):
-        yield from self._parent._get_column_names()
+        cells = self._snapshot()
+        if cells is not None:
+            yield from tuple(cells)
+        else:
+            yield from self._parent._get_column_names()
         
     def __len__(self):
+        cells = self._snapshot()
+        if cells is not None:
+            return len(cells)
         return count(self._parent._get_column_names())
         
     def __setitem__(self, col, value):
-        self._parent._update_cells(self._row, {col:value})
+        self._parent._write_cells(self._row, {col:value})
+        # Read back what the backend stored
+        self._cells = None
         
     def __repr__(self):
-        return str(self._parent._get_cells(self._row))
+        return str(self._parent._decode_cells(self._get_cells()))
+
+    def _get_cells(self):
+        cells = self._snapshot()
+        if cells is not None:
+            return cells
+        return self._parent._read_cells(self._row, copy=False)
+
+    def _snapshot(self):
+        "The prefetched cells, None once the table was written since"
+        if self._cells is not None and self._generation != self._parent._generation:
+            self._cells = None
+        return self._cells
 
     #Reimplemented since None means not exists
 
@@ -93,12 +128,176 @@ class MutableRowView(MutableMapping):
         return default
     
 
-class MutableTable(MutableMapping):
+RowCacheInfo = namedtuple('RowCacheInfo', ('hits', 'misses', 'evictions', 'maxrows', 'maxbytes', 'currrows', 'currbytes'))
+
+
+class RowCache(object):
+    """ Bounded LRU of row -> cells dict, limited by row count and/or estimated bytes
+
+    Every cached entry holds the full set of columns, so a write introducing a
+    new column drops the whole cache.
+    """
+    __slots__ = ('maxrows', 'maxbytes', '_rows', '_sizes', '_bytes', '_hits', '_misses', '_evictions')
+
+    def __init__(self, maxrows=1024, maxbytes=None):
+        self.maxrows = maxrows
+        self.maxbytes = maxbytes
+        self._rows = OrderedDict()
+        self._sizes = dict()
+        self._bytes = 0
+        self._hits = self._misses = self._evictions = 0
+
+    def get(self, row):
+        "Returns cached cells or None"
+        try:
+            cells = self._rows[row]
+        except KeyError:
+            self._misses += 1
+            return None
+        self._rows.move_to_end(row)
+        self._hits += 1
+        return cells
+
+    def put(self, row, cells):
+        self.discard(row)
+        self._rows[row] = cells
+        self._resize(row)
+        self._evict()
+
+    def write(self, row, values):
+        """ Drops the cached entry of row, values are not necessarily what
+        the backend stores (e.g. SQLite type affinity), the next read fetches it
+        """
+        if not self._rows:
+            return
+        sample = next(iter(self._rows.values()))
+        if any(col not in sample for col in values):
+            self.clear()
+            return
+        self.discard(row)
+
+    def discard(self, row):
+        if self._rows.pop(row, None) is not None:
+            self._bytes -= self._sizes.pop(row)
+
+    def clear(self):
+        self._rows.clear()
+        self._sizes.clear()
+        self._bytes = 0
+
+    def info(self):
+        return RowCacheInfo(self._hits, self._misses, self._evictions,
+                            self.maxrows, self.maxbytes, len(self._rows), self._bytes)
+
+    def _resize(self, row):
+        cells = self._rows[row]
+        size = sys.getsizeof(cells) + sum(map(sys.getsizeof, cells.values()))
+        self._bytes += size - self._sizes.get(row, 0)
+        self._sizes[row] = size
+
+    def _evict(self):
+        while self._rows and ((self.maxrows is not None and len(self._rows) > self.maxrows) or
+                              (self.maxbytes is not None and self._bytes > self.maxbytes)):
+            row, cells = self._rows.popitem(last=False)
+            self._bytes -= self._sizes.pop(row)
+            self._evictions += 1
+
+
+class RowItemsView(ItemsView):
+    __slots__ = ()
+
+    def __iter__(self):
+        yield from self._mapping._iter_items()
+
+
+class RowValuesView(ValuesView):
     __slots__ = ()
 
+    def __iter__(self):
+        for row, view in self._mapping._iter_items():
+            yield view
+
+
+class ColumnView(Mapping):
+    """ Read-only mapping of row -> cell of one column, see MutableTable.column()
+    items() and values() stream the column without reading whole rows.
+    """
+    __slots__ = ('_table', '_col')
+
+    def __init__(self, table, col):
+        self._table = table
+        self._col = col
+
+    def __getitem__(self, row):
+        value = self._table._read_cells(row, copy=False).get(self._col)
+        if self._table._codec is not None:
+            value = self._table._codec.decode(value)
+        return value
+
+    def __iter__(self):
+        return iter(self._table)
+
+    def __len__(self):
+        return len(self._table)
+
+    def __contains__(self, row):
+        return row in self._table
+
+    def items(self):
+        return RowItemsView(self)
+
+    def values(self):
+        return RowValuesView(self)
+
+    def _iter_items(self):
+        codec = self._table._codec
+        if codec is None:
+            return self._table._iter_column(self._col)
+        return ((row, codec.decode(value)) for row, value in self._table._iter_column(self._col))
+
+    def __repr__(self):
+        return str(dict(self.items()))
+
+
+class Savepoint(object):
+    """ A level of an open transaction
+    rows: undo log, cells of each row before its first write (None if absent)
+    columns: backend state to restore columns from, if any
+    """
+    __slots__ = ('name', 'rows', 'columns')
+
+    def __init__(self, name, columns=None):
+        self.name = name
+        self.rows = dict()
+        self.columns = columns
+
+
+class Transaction(object):
+    "State of an open MutableTable.transaction(), savepoints[0] being the transaction itself"
+    __slots__ = ('savepoints', 'autocommit_every', 'ops', 'commits')
+
+    def __init__(self, autocommit_every=None):
+        self.savepoints = []
+        self.autocommit_every = autocommit_every
+        self.ops = 0
+        self.commits = 0
+
+
+class MutableTable(MutableMapping):
+    __slots__ = ('_row_cache', '_codec', '_metrics', '_transaction', '_generation')
+    # Backends without native transactions undo writes from a log of rows
+    _undo_log = True
+
+    def __init__(self):
+        self._row_cache = None
+        self._codec = None
+        self._metrics = None
+        self._transaction = None
+        # Counts writes, so that row views know when their prefetched cells are stale
+        self._generation = 0
 
     def __delitem__(self, row):
-        self._del_row(row)
+        self._remove_row(row)
        
     def __getitem__(self, row):
         if row not in self:
@@ -109,7 +308,7 @@ class MutableTable(MutableMapping):
         if values is not None:
             new_row = dict(map(lambda col: (col,None),self._get_column_names()))
             new_row.update(values)
-            self._update_cells(row, new_row)
+            self._write_cells(row, new_row)
         else:
             with suppress(KeyError):
                 del self[row]
@@ -123,6 +322,100 @@ class MutableTable(MutableMapping):
     def __contains__(self, row):
         return row in self._get_row_names()
 
+    def items(self):
+        "D.items() -> a set-like object providing a view on D's (row, row view) pairs"
+        return RowItemsView(self)
+
+    def values(self):
+        "D.values() -> an object providing a view on D's row views"
+        return RowValuesView(self)
+
+    def _iter_items(self):
+        "Yields (row, MutableRowView), backends may override to prefetch cells"
+        for row in self:
+            yield row, MutableRowView(self, row)
+
+    def _prefetched_items(self, cells_items):
+        """ Yields (row, MutableRowView) of (row, cells) pairs read ahead
+        Once the table is written, the cells read before are dropped
+        """
+        generation = self._generation
+        for row, cells in cells_items:
+            if self._generation != generation:
+                cells = None
+            yield row, MutableRowView(self, row, cells)
+
+    def query(self, columns=None, where=None, order_by=None, limit=None):
+        """ Streams (row, cells dict) pairs matching where, see sqlite_shelf.query
+        columns: projection, defaults to every column
+        """
+        return self._decode_items(query.evaluate(self._iter_cells(), columns, where, order_by, limit))
+
+    def _iter_cells(self):
+        "Yields (row, cells dict), backends may override with a bulk read"
+        # (past the row cache, so that a full scan does not evict the hot rows)
+        for row in list(self):
+            yield row, self._get_cells(row)
+
+    def column(self, col):
+        """ Read-only mapping of row -> cell of column col
+        Raises: KeyError if the column does not exist
+        """
+        self._check_column(col)
+        return ColumnView(self, col)
+
+    def set_column(self, col, values):
+        "Sets col from a mapping or iterable of (row, value), adding missing rows"
+        items = values
+        if hasattr(values, "keys"):
+            items = ((row, values[row]) for row in values.keys())
+        self._update_rows((row, {col: value}) for row, value in items)
+
+    def fill_column(self, col, value, overwrite=False):
+        "Sets the empty (None) cells of col, or all of them if overwrite, to value"
+        rows = [row for row, current in self._iter_column(col) if overwrite or current is None]
+        self._update_rows((row, {col: value}) for row in rows)
+
+    def rename_column(self, old, new):
+        """ Moves the cells of old to new, row by row through _get_cells / _update_cells
+        Backends override it to remove old as well, here it stays, empty.
+        Raises: KeyError if old does not exist, ValueError if new does
+        """
+        self._check_rename(old, new)
+        self._undo_all()
+        for row in list(self):
+            self._update_cells(row, {new: self._get_cells(row).get(old), old: None})
+        self._columns_changed()
+
+    def drop_column(self, col):
+        """ Empties the cells of col, row by row through _update_cells
+        Backends override it to remove the column as well.
+        Raises: KeyError
+        """
+        self._check_column(col)
+        self._undo_all()
+        for row in list(self):
+            self._update_cells(row, {col: None})
+        self._columns_changed()
+
+    def _iter_column(self, col):
+        "Yields (row, cell of col), backends may override with a column read"
+        for row, cells in self._iter_cells():
+            yield row, cells.get(col)
+
+    def _check_column(self, col):
+        if col not in self._get_column_names():
+            raise KeyError("Column %s does not exists" % col)
+
+    def _check_rename(self, old, new):
+        self._check_column(old)
+        if new in self._get_column_names():
+            raise ValueError("Column %s already exists" % new)
+
+    def _columns_changed(self):
+        "After renaming or dropping a column, cached rows are stale"
+        self._invalidate_row_cache()
+
     def __repr__(self):
         ret = dict()
         for row_key, row in self.items():
@@ -137,14 +430,14 @@ class MutableTable(MutableMapping):
           If row is not found, d is returned if given, otherwise KeyError is raised.
         '''
         try:
-            value = self._get_cells(row)
+            value = self._read_cells(row)
         except KeyError:
             if default is self.__marker:
                 raise
             return default
         else:
             del self[row]
-            return value
+            return self._decode_cells(value)
         
     def popitem(self):
         '''D.popitem() -> (k, v), remove and return some (key, dict) pair
@@ -154,9 +447,9 @@ class MutableTable(MutableMapping):
             row = next(iter(self))
         except StopIteration:
             raise KeyError
-        value = self._get_cells(row)
+        value = self._read_cells(row)
         del self[row]
-        return row, value
+        return row, self._decode_cells(value)
 
     def update(*args, **kwds):
         ''' D.update([E, ]**F) -> None.  Update D from mapping/iterable E and F.
@@ -166,18 +459,6 @@ class MutableTable(MutableMapping):
 
             N.B. if E[k] / F is None, row is removed
         '''
-        def update_row(key, value):
-            if value is None:
-                self[key] = None
-            else:
-                try:
-                    row = self[key]
-                except KeyError:
-                    self[key] = value
-                else:
-                    self[key].update(value)
-            
-        
         if not args:
             raise TypeError("descriptor 'update' of 'MutableMapping' object "
                             "needs an argument")
@@ -188,16 +469,26 @@ class MutableTable(MutableMapping):
         if args:
             other = args[0]
             if isinstance(other, Mapping):
-                for key in other:
-                    update_row(key, other[key])
+                self._update_rows((key, other[key]) for key in other)
             elif hasattr(other, "keys"):
-                for key in other.keys():
-                    update_row(key, other[key])
+                self._update_rows((key, other[key]) for key in other.keys())
             else:
-                for key, value in other:
-                    update_row(key, value)
-        for key, value in kwds.items():
-            update_row(key, other[key])
+                self._update_rows(other)
+        if kwds:
+            self._update_rows(kwds.items())
+
+    def _update_rows(self, items):
+        "Apply (row, values) pairs in order, backends may override with a batched path"
+        for key, value in items:
+            if value is None:
+                self[key] = None
+            else:
+                try:
+                    row = self[key]
+                except KeyError:
+                    self[key] = value
+                else:
+                    row.update(value)
 
     def setdefault(self, key, default=None):
         'D.setdefault(k[,d]) -> D.get(k,d), also set D[k]=d if k not in D'
@@ -206,6 +497,232 @@ class MutableTable(MutableMapping):
         except KeyError:
             self[key] = default
         return self[key]
+
+    def enable_row_cache(self, maxrows=1024, maxbytes=None):
+        """ Cache rows read through row views in a bounded LRU
+        Writes made through this table are written through to the cache;
+        changes made behind its back (other connections) are not seen.
+        """
+        self._row_cache = RowCache(maxrows, maxbytes)
+
+    def disable_row_cache(self):
+        self._row_cache = None
+
+    def row_cache_info(self):
+        "RowCacheInfo, or None if the cache is disabled"
+        if self._row_cache is None:
+            return None
+        return self._row_cache.info()
+
+    def enable_metrics(self, callback=None):
+        """ Count and time backend operations, see sqlite_shelf.instrumentation
+        callback(name, seconds) is called for every recorded operation.
+        Returns: Metrics
+        """
+        return instrumentation.instrument(self, instrumentation.Metrics(callback))
+
+    def disable_metrics(self):
+        instrumentation.uninstrument(self)
+
+    def metrics_info(self):
+        "{operation: OperationStats}, or None if metrics are disabled"
+        if self._metrics is None:
+            return None
+        return self._metrics.stats()
+
+    @contextmanager
+    def transaction(self, autocommit_every=None):
+        """ Groups the writes of the block, rolled back if it raises
+            with table.transaction():
+                ...
+        autocommit_every: commit every that many writes, a rollback then
+                          only undoes the writes since the latest commit
+        Inside another transaction, this is a savepoint.
+
+        Backends without native transactions keep an undo log of the rows
+        written in the block; a rollback restores their cells, but columns
+        added meanwhile stay (empty).
+        """
+        if self._transaction is not None or self._in_outer_transaction():
+            with self.savepoint():
+                yield self
+            return
+        self._transaction = Transaction(autocommit_every)
+        try:
+            self._begin()
+            try:
+                yield self
+                self._commit()
+            except BaseException:
+                self._rollback()
+                self._invalidate_row_cache()
+                raise
+        finally:
+            self._transaction = None
+
+    @contextmanager
+    def savepoint(self):
+        """ Writes of the block are undone if it raises, the enclosing transaction goes on
+        Outside a transaction, this is a transaction.
+        """
+        outer = False
+        if self._transaction is None:
+            if not self._in_outer_transaction():
+                with self.transaction():
+                    yield self
+                return
+            # Inside a transaction the backend did not start
+            self._transaction = Transaction()
+            outer = True
+        try:
+            savepoint = self._savepoint('sp%d' % len(self._transaction.savepoints))
+            try:
+                yield self
+                self._release_savepoint(savepoint)
+            except BaseException:
+                self._rollback_savepoint(savepoint)
+                self._invalidate_row_cache()
+                raise
+        finally:
+            if outer:
+                self._transaction = None
+
+    def _in_outer_transaction(self):
+        return False
+
+    def _begin(self):
+        self._transaction.savepoints.append(self._new_savepoint('transaction'))
+
+    def _commit(self):
+        pass
+
+    def _rollback(self):
+        for savepoint in reversed(self._transaction.savepoints):
+            self._restore_savepoint(savepoint)
+
+    def _savepoint(self, name):
+        savepoint = self._new_savepoint(name)
+        self._transaction.savepoints.append(savepoint)
+        return savepoint
+
+    def _release_savepoint(self, savepoint):
+        savepoints = self._transaction.savepoints
+        assert savepoints.pop() is savepoint
+        if savepoints:
+            for row, cells in savepoint.rows.items():
+                savepoints[-1].rows.setdefault(row, cells)
+
+    def _rollback_savepoint(self, savepoint):
+        assert self._transaction.savepoints.pop() is savepoint
+        self._restore_savepoint(savepoint)
+
+    def _checkpoint(self):
+        "Autocommit: commits and goes on in a new transaction"
+        self._commit()
+        self._transaction.savepoints = []
+        self._begin()
+
+    def _count_ops(self, ops):
+        tx = self._transaction
+        if tx.autocommit_every is not None and tx.ops >= tx.autocommit_every and len(tx.savepoints) == 1:
+            self._checkpoint()
+            tx.ops = 0
+            tx.commits += 1
+        tx.ops += ops
+
+    def _before_write(self, row):
+        "In a transaction, counts the write and logs how to undo it"
+        self._count_ops(1)
+        if self._undo_log:
+            savepoint = self._transaction.savepoints[-1]
+            if row not in savepoint.rows:
+                savepoint.rows[row] = self._undo_state(row)
+
+    def _undo_all(self):
+        "In a transaction, logs how to undo a write to every row, e.g. a column operation"
+        if self._transaction is not None and self._undo_log:
+            savepoint = self._transaction.savepoints[-1]
+            for row in list(self):
+                if row not in savepoint.rows:
+                    savepoint.rows[row] = self._undo_state(row)
+
+    def _new_savepoint(self, name):
+        return Savepoint(name)
+
+    def _undo_state(self, row):
+        try:
+            return dict(self._get_cells(row))
+        except KeyError:
+            return None
+
+    def _restore_savepoint(self, savepoint):
+        for row, cells in savepoint.rows.items():
+            if cells is None:
+                with suppress(KeyError):
+                    self._del_row(row)
+            else:
+                restored = dict.fromkeys(self._get_column_names())
+                restored.update(cells)
+                self._update_cells(row, restored)
+
+    def _invalidate_row_cache(self):
+        self._generation += 1
+        if self._row_cache is not None:
+            self._row_cache.clear()
+
+    def set_codec(self, codec):
+        """ Encode cells the backend cannot store natively with codec, see
+        sqlite_shelf.serialization, None to disable
+        Cells are stored encoded and decoded only when read.
+        """
+        self._codec = codec
+
+    def _decode_cells(self, cells):
+        if self._codec is None:
+            return cells
+        return self._codec.decode_cells(cells)
+
+    def _decode_items(self, items):
+        "Decodes (row, cells) pairs, as produced by scans and queries"
+        if self._codec is None:
+            return items
+        return ((row, self._codec.decode_cells(cells)) for row, cells in items)
+
+    def _read_cells(self, row, copy=True):
+        """ _get_cells through the row cache. Raises: KeyError
+        copy: False returns the cached dict itself, which must not be modified
+        """
+        cache = self._row_cache
+        if cache is None:
+            return self._get_cells(row)
+        cells = cache.get(row)
+        if cells is None:
+            cells = self._get_cells(row)
+            cache.put(row, cells)
+        return dict(cells) if copy else cells
+
+    def _write_cells(self, row, values):
+        """ _update_cells, encoding values and dropping row from the row cache
+        Returns: values as encoded
+        """
+        if self._transaction is not None:
+            self._before_write(row)
+        if self._codec is not None:
+            values = self._codec.encode_cells(values)
+        self._update_cells(row, values)
+        self._generation += 1
+        if self._row_cache is not None:
+            self._row_cache.write(row, values)
+        return values
+
+    def _remove_row(self, row):
+        "_del_row, invalidating the row cache. Raises: KeyError"
+        if self._transaction is not None:
+            self._before_write(row)
+        self._generation += 1
+        if self._row_cache is not None:
+            self._row_cache.discard(row)
+        self._del_row(row)
         
     @abstractmethod
     def _del_row(self, row):
@@ -231,35 +748,95 @@ class MutableTable(MutableMapping):
     
 
 class DictTable(MutableTable):
+    """ In-memory table, storing a dict of cells per row
+    Columns a row has never been written to are absent from its dict.
+    """
     
     def __init__(self):
-        self._rows = set()
-        self._cols = set()
-        self._cells = dict()
+        MutableTable.__init__(self)
+        self._rows = dict()
+        # Keys only, ordered so columns come out in the order they were added
+        self._cols = OrderedDict()
     
     def _del_row(self, row):
-        if row not in self._rows:
+        try:
+            del self._rows[row]
+        except KeyError:
             raise KeyError("Row with id %s does not exists" % row)
-        self._rows.discard(row)
-        for key in list(filter(lambda key: key[0] == row, self._cells)):
-            del self._cells[key]
+
     def _update_cells(self, row, values):
-        self._rows.add(row)
-        for col,value in values.items():
-            self._cols.add(col)
-            self._cells[(row,col)] = value
+        cols = self._cols
+        for col in values:
+            if col not in cols:
+                cols[col] = None
+        try:
+            self._rows[row].update(values)
+        except KeyError:
+            self._rows[row] = dict(values)
     
     def _get_cells(self, row):
-        if row not in self._rows:
+        try:
+            cells = self._rows[row]
+        except KeyError:
             raise KeyError("Row with id %s does not exists" % row)
-        return dict(map(
-            lambda col: (col, self._cells[(row,col)] if (row,col) in self._cells else None),
-            self._cols))
+        ret = dict.fromkeys(self._cols)
+        ret.update(cells)
+        return ret
                
+    def fill_column(self, col, value, overwrite=False):
+        self._undo_all()
+        if self._codec is not None:
+            value = self._codec.encode(value, col)
+        for cells in self._rows.values():
+            if overwrite or cells.get(col) is None:
+                cells[col] = value
+        self._cols.setdefault(col)
+        self._columns_changed()
+
+    def rename_column(self, old, new):
+        "Raises: KeyError if old does not exist, ValueError if new does"
+        self._check_rename(old, new)
+        self._undo_all()
+        for cells in self._rows.values():
+            if old in cells:
+                cells[new] = cells.pop(old)
+        self._cols = OrderedDict((new if col == old else col, None) for col in self._cols)
+        self._columns_changed()
+
+    def drop_column(self, col):
+        "Raises: KeyError"
+        self._check_column(col)
+        self._undo_all()
+        for cells in self._rows.values():
+            cells.pop(col, None)
+        del self._cols[col]
+        self._columns_changed()
+
+    def _new_savepoint(self, name):
+        return Savepoint(name, OrderedDict(self._cols))
+
+    def _undo_state(self, row):
+        cells = self._rows.get(row)
+        return None if cells is None else dict(cells)
+
+    def _restore_savepoint(self, savepoint):
+        for row, cells in savepoint.rows.items():
+            if cells is None:
+                self._rows.pop(row, None)
+            else:
+                self._rows[row] = cells
+        self._cols = OrderedDict(savepoint.columns)
+        for cells in savepoint.rows.values():
+            if cells is not None:
+                for col in cells:
+                    self._cols.setdefault(col)
+
+    def _iter_column(self, col):
+        for row, cells in self._rows.items():
+            yield row, cells.get(col)
+
     def _get_column_names(self):
-        return self._cols
+        return self._cols.keys()
 
     def _get_row_names(self):
-        return self._rows
-        
-
+        return self._rows.keys()
@@ -0,0 +1,324 @@
+from collections import namedtuple
+from concurrent.futures import Future
+from contextlib import contextmanager
+from time import perf_counter
+import queue
+import sqlite3
+import threading
+from sqlite_shelf.sqliteshelf import SqliteTable
+
+
+PoolStats = namedtuple('PoolStats', ('connections', 'in_use', 'checkouts', 'waits', 'wait_seconds',
+                                     'writes', 'commits', 'max_queue'))
+
+
+_HOLD = object()
+
+
+class PooledSqliteTable(SqliteTable):
+    """ SqliteTable handle of a SqliteTablePool
+    Reads run on the handle's own connection, writes are sent to the pool's
+    writer thread and return once committed. In a transaction, writes run on
+    the handle's own connection.
+    """
+    __slots__ = ('_pool',)
+
+    def __init__(self, pool, conn, **kwds):
+        self._pool = pool
+        SqliteTable.__init__(self, conn, pool._table, **kwds)
+
+    @contextmanager
+    def transaction(self, autocommit_every=None):
+        """ See MutableTable.transaction()
+        The pool's writer thread is held for the block, once it committed what
+        was queued before, and the block reads and writes through this handle's
+        connection. Writes of other handles wait for the block: writing through
+        another handle of the pool from the same thread would deadlock.
+        """
+        if self._transaction is not None:
+            with SqliteTable.transaction(self, autocommit_every):
+                yield self
+            return
+        self.flush()
+        with self._pool._exclusive():
+            with SqliteTable.transaction(self, autocommit_every):
+                yield self
+
+    def create_index(self, columns, name=None, unique=False, where=None):
+        if self._transaction is not None:
+            return SqliteTable.create_index(self, columns, name, unique, where)
+        self.flush()
+        return self._pool._write(lambda table: table.create_index(columns, name, unique, where))
+
+    def drop_index(self, name):
+        if self._transaction is not None:
+            return SqliteTable.drop_index(self, name)
+        return self._pool._write(lambda table: table.drop_index(name))
+
+    def fill_column(self, col, value, overwrite=False):
+        if self._codec is not None and self._transaction is None:
+            value = self._codec.encode(value, col)
+        self._write_through(SqliteTable.fill_column, col, value, overwrite)
+        self._columns_changed()
+
+    def rename_column(self, old, new):
+        "Raises: KeyError if old does not exist, ValueError if new does"
+        self._write_through(SqliteTable.rename_column, old, new)
+        self._columns_changed()
+
+    def drop_column(self, col):
+        "Raises: KeyError"
+        self._write_through(SqliteTable.drop_column, col)
+        self._columns_changed()
+
+    def enable_change_tracking(self):
+        self._write_through(SqliteTable.enable_change_tracking)
+
+    def disable_change_tracking(self):
+        self._write_through(SqliteTable.disable_change_tracking)
+
+    def compact_changes(self, deletes_before=None):
+        return self._write_through(SqliteTable.compact_changes, deletes_before)
+
+    def _write_through(self, method, *args):
+        "method(table, *args) on the pool's writer thread, or on this handle in a transaction"
+        if self._transaction is not None:
+            return method(self, *args)
+        self.flush()
+        return self._pool._write(lambda table: method(table, *args))
+
+    def _bulk_write(self, rows, column_values=None):
+        if self._transaction is not None:
+            return SqliteTable._bulk_write(self, rows, column_values)
+        if hasattr(rows, "keys"):
+            rows = [(key, rows[key]) for key in rows.keys()]
+        else:
+            rows = list(rows)
+        self._ingest_stats = self._pool._write(lambda table: table._bulk_write(rows, column_values))
+        self._generation += 1
+        if self._row_cache is not None:
+            self._row_cache.clear()
+        return self._ingest_stats
+
+    def _update_cells(self, row, values):
+        if self._pending is not None or self._transaction is not None:
+            SqliteTable._update_cells(self, row, values)
+        else:
+            self._pool._write(lambda table: table._update_cells(row, values))
+
+    def _del_row(self, row):
+        "Raises: KeyError"
+        if self._transaction is not None:
+            SqliteTable._del_row(self, row)
+            return
+        if self._pending and row in self._pending:
+            self.flush()
+        self._pool._write(lambda table: table._del_row(row))
+
+
+class SqliteTablePool(object):
+    """ Pooled WAL-mode connections to one database file, handed out as table handles
+
+        with pool.table() as table:
+            table[row][col] = value
+
+    Up to size reader connections are opened on demand and reused; a thread
+    asking for more waits up to timeout seconds (None waits forever).
+    Writes of all handles go through one queue to a single writer thread,
+    which owns its own connection and commits whatever is queued as one
+    transaction, so readers keep running concurrently in WAL mode. Each write
+    runs in its own savepoint: one that raises is undone alone.
+    """
+
+    def __init__(self, path, table="DefaultTable", size=4, timeout=None, **table_kwds):
+        self._path = path
+        self._table = table
+        self._table_kwds = table_kwds
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = self._in_use = self._checkouts = self._waits = 0
+        self._wait_seconds = 0.0
+        self._writes = self._commits = self._max_queue = 0
+        self._closed = False
+        self._queue = queue.Queue()
+        ready = Future()
+        self._writer = threading.Thread(target=self._write_loop, args=(ready,),
+                                        name='SqliteTablePool writer', daemon=True)
+        self._writer.start()
+        ready.result()
+
+    @contextmanager
+    def table(self, **kwds):
+        "Checks out a connection, wrapped in a PooledSqliteTable for the block"
+        conn = self._checkout()
+        try:
+            options = dict(self._table_kwds)
+            options.update(kwds)
+            handle = PooledSqliteTable(self, conn, **options)
+            try:
+                yield handle
+            finally:
+                handle.close()
+        finally:
+            self._checkin(conn)
+
+    def stats(self):
+        with self._lock:
+            return PoolStats(self._created, self._in_use, self._checkouts, self._waits, self._wait_seconds,
+                             self._writes, self._commits, self._max_queue)
+
+    def close(self):
+        "Stops the writer once queued writes are committed and closes idle connections"
+        with self._lock:
+            self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _connect(self):
+        conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        return conn
+
+    def _checkout(self):
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                self._waits += 1
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except BaseException:
+                with self._lock:
+                    self._created -= 1
+                    self._in_use -= 1
+                raise
+        start = perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self._in_use -= 1
+            raise TimeoutError("No connection to %s available within %s seconds" % (self._path, self.timeout))
+        with self._lock:
+            self._wait_seconds += perf_counter() - start
+        return conn
+
+    def _checkin(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    def _write(self, job):
+        """ Runs job(writer table) on the writer thread, returns its result once committed
+        Raises: sqlite3.ProgrammingError if the pool is closed or its writer stopped
+        """
+        future = Future()
+        with self._lock:
+            if self._closed or not self._writer.is_alive():
+                raise sqlite3.ProgrammingError("The writer of the SqliteTablePool of %s is stopped" % self._path)
+            self._queue.put((job, future))
+            self._max_queue = max(self._max_queue, self._queue.qsize())
+        return future.result()
+
+    @contextmanager
+    def _exclusive(self):
+        "Holds the writer thread, idle with queued writes committed, for the block"
+        release = self._write(_HOLD)
+        try:
+            yield
+        finally:
+            release.set()
+
+    def _write_loop(self, ready):
+        try:
+            conn = sqlite3.connect(self._path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            table = SqliteTable(conn, self._table, **self._table_kwds)
+            conn.commit()
+        except BaseException as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(None)
+        try:
+            stop = False
+            while not stop:
+                batch = [self._queue.get()]
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                results = []
+                holds = []
+                for item in batch:
+                    if item is None:
+                        stop = True
+                        continue
+                    job, future = item
+                    if job is _HOLD:
+                        holds.append(future)
+                        continue
+                    if not conn.in_transaction:
+                        conn.execute('BEGIN')
+                        table._schema_checked = False
+                    conn.execute('SAVEPOINT job')
+                    try:
+                        result = job(table)
+                    except BaseException as e:
+                        conn.execute('ROLLBACK TO job')
+                        conn.execute('RELEASE job')
+                        # Columns the job added are gone again
+                        table._discard_pending()
+                        table._schema = None
+                        results.append((future, False, e))
+                    else:
+                        conn.execute('RELEASE job')
+                        results.append((future, True, result))
+                if results:
+                    try:
+                        conn.commit()
+                    except BaseException as e:
+                        conn.rollback()
+                        table._schema = None
+                        results = [(future, False, e) for future, ok, result in results]
+                    with self._lock:
+                        self._writes += len(results)
+                        self._commits += 1
+                for future, ok, result in results:
+                    if ok:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(result)
+                for future in holds:
+                    release = threading.Event()
+                    future.set_result(release)
+                    release.wait()
+        finally:
+            # Writes queued after the stop fail instead of waiting forever
+            with self._lock:
+                self._closed = True
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    item[1].set_exception(sqlite3.ProgrammingError(
+                        "The writer of the SqliteTablePool of %s is stopped" % self._path))
+            table.close()
+            conn.close()
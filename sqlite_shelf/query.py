@@ -0,0 +1,180 @@
+""" Predicates and ordering for MutableTable.query()
+
+where maps column -> condition, all conditions must hold:
+    value               col = value
+    None                col IS NULL
+    (op, operand)       op one of = != < <= > >=, 'in' / 'not in' (iterable operand),
+                        'between' ((low, high) operand), 'is' / 'is not' (None operand)
+
+order_by is a column or a list of columns, prefixed with '-' for descending.
+In columns, where and order_by, '_id' is the row name.
+Comparisons follow SQLite: NULL never matches anything but 'is', and values
+of different types order as NULL < numbers < text < blobs.
+"""
+import operator
+
+
+_comparisons = {'=':operator.eq, '!=':operator.ne, '<':operator.lt,
+                '<=':operator.le, '>':operator.gt, '>=':operator.ge}
+
+
+def conditions(where):
+    "Normalizes where into a list of (col, op, operand)"
+    ret = []
+    for col, condition in (where or {}).items():
+        if condition is None:
+            ret.append((col, 'is', None))
+        elif isinstance(condition, tuple):
+            op, operand = condition
+            op = op.lower()
+            if op in ('in', 'not in'):
+                operand = tuple(operand)
+            elif op == 'between':
+                operand = tuple(operand)
+                if len(operand) != 2:
+                    raise ValueError("between expects (low, high), got %r" % (operand,))
+            elif op in ('is', 'is not'):
+                if operand is not None:
+                    raise ValueError("%s only compares with None" % op)
+            elif op not in _comparisons:
+                raise ValueError("Unknown operator %s" % op)
+            ret.append((col, op, operand))
+        else:
+            ret.append((col, '=', condition))
+    return ret
+
+
+def ordering(order_by):
+    "Normalizes order_by into a list of (col, descending)"
+    if order_by is None:
+        return []
+    if isinstance(order_by, str):
+        order_by = [order_by]
+    return [(col[1:], True) if col.startswith('-') else (col, False) for col in order_by]
+
+
+def sort_key(value):
+    "Orders values of mixed types like SQLite does"
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, value)
+
+
+def matches(conds, row, cells):
+    "Evaluates normalized conditions on a row in Python"
+    for col, op, operand in conds:
+        value = row if col == '_id' else cells.get(col)
+        if op == 'is':
+            if value is not None:
+                return False
+            continue
+        if op == 'is not':
+            if value is None:
+                return False
+            continue
+        if value is None:
+            return False
+        if op == 'in':
+            if not any(value == x for x in operand if x is not None):
+                return False
+        elif op == 'not in':
+            if None in operand or any(value == x for x in operand):
+                return False
+        elif op == 'between':
+            low, high = operand
+            if low is None or high is None:
+                return False
+            if not sort_key(low) <= sort_key(value) <= sort_key(high):
+                return False
+        else:
+            if operand is None:
+                return False
+            if not _comparisons[op](sort_key(value), sort_key(operand)):
+                return False
+    return True
+
+
+def evaluate(items, columns=None, where=None, order_by=None, limit=None):
+    """ Generic query over (row, cells) pairs
+    Streams unless order_by needs the matching rows to be sorted first.
+    """
+    conds = conditions(where)
+    order = ordering(order_by)
+    results = ((row, cells) for row, cells in items if matches(conds, row, cells))
+    if order:
+        results = list(results)
+        for col, descending in reversed(order):
+            results.sort(key=lambda item: sort_key(item[0] if col == '_id' else item[1].get(col)),
+                         reverse=descending)
+    if columns is not None:
+        results = ((row, {col: row if col == '_id' else cells.get(col) for col in columns})
+                   for row, cells in results)
+    if limit is not None:
+        results = (item for _, item in zip(range(limit), results))
+    return results
+
+
+def literal(value):
+    "SQL literal of value, for statements that cannot take parameters"
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return "'%s'" % value.replace("'", "''")
+    if isinstance(value, bytes):
+        return "X'%s'" % value.hex()
+    raise TypeError("No SQL literal for %r" % (value,))
+
+
+def compile_where(where, ref, params=None):
+    """ SQL condition for where, column names rendered by ref
+    Operands are appended to params, or inlined as literals if params is None.
+    """
+    def arg(value):
+        if params is None:
+            return literal(value)
+        params.append(value)
+        return '?'
+
+    clauses = []
+    for col, op, operand in conditions(where):
+        if op == 'is' or op == 'is not':
+            clauses.append('%s %s NULL' % (ref(col), op.upper()))
+        elif op == 'in' or op == 'not in':
+            clauses.append('%s %s (%s)' % (ref(col), op.upper(), ', '.join(map(arg, operand))))
+        elif op == 'between':
+            clauses.append('%s BETWEEN %s AND %s' % (ref(col), arg(operand[0]), arg(operand[1])))
+        else:
+            clauses.append('%s %s %s' % (ref(col), op, arg(operand)))
+    return ' AND '.join(clauses)
+
+
+def compile_sql(table, known_columns, columns=None, where=None, order_by=None, limit=None):
+    """ Compiles a query to a single parameterized SELECT _id, ... statement
+    Columns unknown to the table read as NULL.
+    Returns: (sql, params, selected column names)
+    """
+    def ref(col):
+        if col == '_id' or col in known_columns:
+            return '"%s"' % col
+        return 'NULL'
+
+    selected = list(known_columns) if columns is None else list(columns)
+    sql = 'SELECT _id%s FROM %s' % (''.join(', %s' % ref(col) for col in selected), table)
+    params = []
+    clauses = compile_where(where, ref, params)
+    if clauses:
+        sql += ' WHERE ' + clauses
+    order = ['%s%s' % (ref(col), ' DESC' if descending else '')
+             for col, descending in ordering(order_by) if ref(col) != 'NULL']
+    if order:
+        sql += ' ORDER BY ' + ', '.join(order)
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return sql, params, selected
@@ -0,0 +1,141 @@
+""" Value codecs for cells backends cannot store natively
+
+Encoded cells are self-describing bytes:
+
+    MAGIC | format tag (1 byte) | compression tag (1 byte) | payload
+
+so columns may mix formats. A codec only decodes the formats it is
+configured with and rejects cells tagged with any other, as decoding e.g.
+pickle runs code chosen by whoever wrote the cell. Formats and compressions
+are pluggable through register_format() / register_compression().
+"""
+import json
+import pickle
+import zlib
+
+
+MAGIC = b'\x00SQS'
+_HEADER = len(MAGIC) + 2
+
+_formats = dict()
+_format_tags = dict()
+_compressions = dict()
+_compression_tags = dict()
+
+
+def register_format(name, tag, dumps, loads):
+    "dumps(value) -> bytes, loads(bytes) -> value, tag is a unique byte value"
+    _formats[name] = (tag, dumps, loads)
+    _format_tags[tag] = (name, dumps, loads)
+
+
+def unregister_format(name):
+    "Raises: KeyError if the format is not registered"
+    tag = _formats.pop(name)[0]
+    del _format_tags[tag]
+
+
+def register_compression(name, tag, compress, decompress):
+    "compress(bytes) -> bytes, decompress(bytes) -> bytes, tag is a unique byte value > 0"
+    _compressions[name] = (tag, compress, decompress)
+    _compression_tags[tag] = (name, compress, decompress)
+
+
+register_format('pickle', 1, lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL), pickle.loads)
+register_format('json', 2, lambda value: json.dumps(value, separators=(',', ':')).encode('utf-8'),
+                lambda data: json.loads(data.decode('utf-8')))
+register_compression('zlib', 1, zlib.compress, zlib.decompress)
+
+try:
+    import msgpack
+except ImportError:
+    pass
+else:
+    register_format('msgpack', 3, lambda value: msgpack.packb(value, use_bin_type=True),
+                    lambda data: msgpack.unpackb(data, raw=False))
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    register_compression('lz4', 2, lz4.frame.compress, lz4.frame.decompress)
+
+
+def is_encoded(value):
+    return value.__class__ is bytes and value[:len(MAGIC)] == MAGIC
+
+
+def decode(value, formats):
+    """ Decodes an encoded cell, other values are returned as is
+    formats: names of the formats accepted
+    Raises: ValueError for a cell of an unknown or not accepted format
+    """
+    if not is_encoded(value):
+        return value
+    try:
+        name, dumps, loads = _format_tags[value[len(MAGIC)]]
+    except KeyError:
+        raise ValueError("Unknown format tag %d" % value[len(MAGIC)])
+    if name not in formats:
+        raise ValueError("Format %s is not accepted" % name)
+    payload = value[_HEADER:]
+    compression = value[len(MAGIC) + 1]
+    if compression:
+        try:
+            payload = _compression_tags[compression][2](payload)
+        except KeyError:
+            raise ValueError("Unknown compression tag %d" % compression)
+    return loads(payload)
+
+
+class Codec(object):
+    """ Encodes cells that are not natively stored
+
+    format: name of a registered format, column_formats overrides it per column
+    decode_formats: names of further formats decoded, e.g. of older cells;
+                    cells of formats neither written nor listed here are rejected
+    compression: name of a registered compression or None, used for
+                 payloads longer than compress_threshold bytes
+    native: value classes stored as is; bytes are native too unless they
+            could be mistaken for an encoded cell
+    Raises: KeyError for unregistered (or uninstalled) format / compression
+    """
+    __slots__ = ('format', 'column_formats', 'decode_formats', 'compression', 'compress_threshold', 'native')
+
+    def __init__(self, format='pickle', compression='zlib', compress_threshold=1024,
+                 column_formats=None, native=(str, int, float, type(None), bytes), decode_formats=()):
+        formats = [format] + list((column_formats or {}).values()) + list(decode_formats)
+        for name in formats:
+            if name not in _formats:
+                raise KeyError("Format %s is not registered" % name)
+        if compression is not None and compression not in _compressions:
+            raise KeyError("Compression %s is not registered" % compression)
+        self.format = format
+        self.column_formats = dict(column_formats or {})
+        self.decode_formats = frozenset(formats)
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.native = frozenset(native)
+
+    def encode(self, value, col=None):
+        if value.__class__ in self.native and not is_encoded(value):
+            return value
+        tag, dumps, loads = _formats[self.column_formats.get(col, self.format)]
+        payload = dumps(value)
+        compression = 0
+        if self.compression is not None and len(payload) > self.compress_threshold:
+            compression, compress, decompress = _compressions[self.compression]
+            payload = compress(payload)
+        return MAGIC + bytes((tag, compression)) + payload
+
+    def encode_cells(self, values):
+        return {col: self.encode(value, col) for col, value in values.items()}
+
+    def decode(self, value):
+        "Raises: ValueError for a cell of a format the codec does not accept"
+        return decode(value, self.decode_formats)
+
+    def decode_cells(self, cells):
+        formats = self.decode_formats
+        return {col: decode(value, formats) for col, value in cells.items()}
@@ -0,0 +1,352 @@
+""" Table hash-partitioned across several SQLite files
+
+    table = ShardedTable('shelf.d', shards=8)
+
+Each _id lives in shard crc32(_id) % shards, a SqliteTable in its own
+database file, so writes to different shards do not contend for one lock.
+The shard count is recorded in shards.json when the directory is created
+and fixed from then on; change it offline with
+
+    python -m sqlite_shelf.shardedshelf reshard SOURCE TARGET SHARDS
+"""
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
+from time import perf_counter
+import argparse
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import zlib
+from sqlite_shelf import query
+from sqlite_shelf.mutabletable import MutableTable
+from sqlite_shelf.sqliteshelf import SqliteTable, IngestStats
+
+
+METADATA = 'shards.json'
+
+
+def shard_path(directory, shard):
+    return os.path.join(directory, 'shard-%03d.db' % shard)
+
+
+def _load_shard(path, table, rows):
+    "Bulk load worker, runs in a child process with its own connection"
+    conn = sqlite3.connect(path)
+    try:
+        shard = SqliteTable(conn, table)
+        stats = shard.bulk_update(rows)
+        shard.close()
+        conn.commit()
+    finally:
+        conn.close()
+    return stats
+
+
+class _MergeKey(object):
+    "Sort key of a (row, cells) pair for an order_by mixing directions"
+    __slots__ = ('_values', '_descending')
+
+    def __init__(self, order, row, cells):
+        self._values = [query.sort_key(row if col == '_id' else cells.get(col)) for col, _ in order]
+        self._descending = [descending for _, descending in order]
+
+    def __lt__(self, other):
+        for a, b, descending in zip(self._values, other._values, self._descending):
+            if a != b:
+                return b < a if descending else a < b
+        return False
+
+
+class ShardedTable(MutableTable):
+    """ MutableTable over a directory of SqliteTable shards
+    shards: shard count of a new directory, must match an existing one if given
+    parallel_threshold: bulk loads of at least that many rows are written by
+                        a process pool of processes workers, one task per shard
+    Changes are committed by commit() and close().
+    Raises: ValueError if shards conflicts with the directory's shard count
+    """
+    __slots__ = ('_directory', '_table', '_shards', 'processes', 'parallel_threshold', '_ingest_stats',
+                 '_executor')
+
+    def __init__(self, directory, shards=None, table="DefaultTable", processes=None, parallel_threshold=10000):
+        MutableTable.__init__(self)
+        metadata = os.path.join(directory, METADATA)
+        if os.path.exists(metadata):
+            with open(metadata) as f:
+                info = json.load(f)
+            if shards is not None and shards != info['shards']:
+                raise ValueError("%s has %d shards, not %d" % (directory, info['shards'], shards))
+            shards = info['shards']
+        else:
+            shards = shards or 4
+            os.makedirs(directory, exist_ok=True)
+            with open(metadata, 'w') as f:
+                json.dump({'shards':shards, 'hash':'crc32'}, f)
+        self._directory = directory
+        self._table = table
+        self.processes = processes
+        self.parallel_threshold = parallel_threshold
+        self._ingest_stats = None
+        # Process pool kept across bulk loads, None to start one per load
+        self._executor = None
+        self._shards = [SqliteTable(sqlite3.connect(shard_path(directory, n)), table)
+                        for n in range(shards)]
+        self.commit()
+
+    @property
+    def shard_count(self):
+        return len(self._shards)
+
+    def shard_of(self, row):
+        "Index of the shard storing row"
+        return zlib.crc32(str(row).encode('utf-8')) % len(self._shards)
+
+    def _shard(self, row):
+        return self._shards[self.shard_of(row)]
+
+    def commit(self):
+        for shard in self._shards:
+            shard.flush()
+            shard._c.connection.commit()
+
+    def close(self):
+        self.commit()
+        for shard in self._shards:
+            shard.close()
+            shard._c.connection.close()
+
+    @property
+    def last_ingest_stats(self):
+        "IngestStats of the latest bulk_update(), or None"
+        return self._ingest_stats
+
+    def bulk_update(self, rows):
+        """ Upsert many rows at once, with the semantics of update()
+        rows: mapping or iterable of (row, values) pairs, values of None removes the row
+
+        Rows are partitioned per shard, each shard written with
+        SqliteTable.bulk_update; in parallel processes for large loads, in
+        which case pending changes are committed first.
+        Returns: IngestStats
+        """
+        start = perf_counter()
+        if hasattr(rows, "keys"):
+            rows = ((key, rows[key]) for key in rows.keys())
+        codec = self._codec
+        partitions = [[] for _ in self._shards]
+        count = 0
+        for row, values in rows:
+            if codec is not None and values is not None:
+                values = codec.encode_cells(values)
+            partitions[self.shard_of(row)].append((row, values))
+            count += 1
+        # Child processes could not write while a transaction holds the shards
+        if count >= self.parallel_threshold and self.processes != 1 and \
+                self._shards[0]._transaction is None and \
+                sum(1 for partition in partitions if partition) > 1:
+            self.commit()
+            if self._executor is not None:
+                self._load_partitions(self._executor, partitions)
+            else:
+                with ProcessPoolExecutor(self.processes) as executor:
+                    self._load_partitions(executor, partitions)
+        else:
+            for shard, partition in zip(self._shards, partitions):
+                if partition:
+                    shard.bulk_update(partition)
+        self._generation += 1
+        if self._row_cache is not None:
+            self._row_cache.clear()
+        seconds = perf_counter() - start
+        self._ingest_stats = IngestStats(count, seconds, count / seconds if seconds else float('inf'))
+        return self._ingest_stats
+
+    def _load_partitions(self, executor, partitions):
+        futures = [executor.submit(_load_shard, shard_path(self._directory, n), self._table, partition)
+                   for n, partition in enumerate(partitions) if partition]
+        for future in futures:
+            future.result()
+
+    def fill_column(self, col, value, overwrite=False):
+        "Sets the empty (NULL) cells of col, or all of them if overwrite, to value, one UPDATE per shard"
+        if self._codec is not None:
+            value = self._codec.encode(value, col)
+        for shard in self._shards:
+            shard.fill_column(col, value, overwrite)
+        self._columns_changed()
+
+    def rename_column(self, old, new):
+        "Raises: KeyError if old does not exist, ValueError if new does"
+        self._check_rename(old, new)
+        for shard in self._shards:
+            if old in shard._get_column_names():
+                shard.rename_column(old, new)
+        self._columns_changed()
+
+    def drop_column(self, col):
+        "Raises: KeyError"
+        self._check_column(col)
+        for shard in self._shards:
+            if col in shard._get_column_names():
+                shard.drop_column(col)
+        self._columns_changed()
+
+    def _iter_column(self, col):
+        for shard in self._shards:
+            yield from shard._iter_column(col)
+
+    @contextmanager
+    def transaction(self, autocommit_every=None):
+        """ A transaction on every shard, see MutableTable.transaction()
+        Shards commit one after the other, not atomically together.
+        """
+        with self._on_shards(lambda shard: shard.transaction(autocommit_every)):
+            yield self
+
+    @contextmanager
+    def savepoint(self):
+        with self._on_shards(lambda shard: shard.savepoint()):
+            yield self
+
+    @contextmanager
+    def _on_shards(self, context):
+        try:
+            with ExitStack() as stack:
+                for shard in self._shards:
+                    stack.enter_context(context(shard))
+                yield
+        except BaseException:
+            self._invalidate_row_cache()
+            raise
+
+    def _update_rows(self, items):
+        self.bulk_update(items)
+
+    def _del_row(self, row):
+        "Raises: KeyError"
+        self._shard(row)._remove_row(row)
+
+    def _update_cells(self, row, values):
+        # Through _write_cells, so shard transactions count the write
+        self._shard(row)._write_cells(row, values)
+
+    def _get_cells(self, row):
+        "Raises: KeyError"
+        cells = dict.fromkeys(self._get_column_names())
+        cells.update(self._shard(row)._get_cells(row))
+        return cells
+
+    def _get_column_names(self):
+        ret = []
+        seen = set()
+        for shard in self._shards:
+            for col in shard._get_column_names():
+                if col not in seen:
+                    seen.add(col)
+                    ret.append(col)
+        return tuple(ret)
+
+    def _get_row_names(self):
+        for shard in self._shards:
+            yield from shard._get_row_names()
+
+    def iter_rows(self, chunk_size=None):
+        "Streams (row, cells dict) pairs, shard after shard"
+        return self._decode_items(self._iter_rows(chunk_size))
+
+    def _iter_rows(self, chunk_size=None):
+        columns = self._get_column_names()
+        for shard in self._shards:
+            for row, cells in shard._iter_rows(chunk_size):
+                if len(cells) != len(columns):
+                    cells = dict(dict.fromkeys(columns), **cells)
+                yield row, cells
+
+    def _iter_items(self):
+        return self._prefetched_items(self._iter_rows())
+
+    def _iter_cells(self):
+        return self._iter_rows()
+
+    def query(self, columns=None, where=None, order_by=None, limit=None):
+        """ Streams (row, cells dict) pairs matching where, see sqlite_shelf.query
+        Every shard runs the query; results are concatenated, or merged in
+        order_by order, and cut at limit.
+        """
+        order = query.ordering(order_by)
+        selected = list(self._get_column_names()) if columns is None else list(columns)
+        fetched = selected + [col for col, _ in order if col != '_id' and col not in selected]
+        streams = [shard.query(fetched, where, order_by, limit) for shard in self._shards]
+        if order:
+            results = heapq.merge(*streams, key=lambda item: _MergeKey(order, *item))
+        else:
+            results = itertools.chain.from_iterable(streams)
+        if len(fetched) != len(selected):
+            results = ((row, {col: cells[col] for col in selected}) for row, cells in results)
+        if limit is not None:
+            results = itertools.islice(results, limit)
+        return self._decode_items(results)
+
+    def __contains__(self, row):
+        return row in self._shard(row)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+
+def reshard(source, target, shards, table="DefaultTable", chunk_size=10000, processes=None):
+    """ Copies the sharded table in source into a new directory target with shards shards
+    Run offline: source must not be written meanwhile.
+    Chunks are written by one process pool of processes workers, see ShardedTable.
+    Returns: number of rows copied
+    Raises: ValueError if target already holds a sharded table
+    """
+    if os.path.exists(os.path.join(target, METADATA)):
+        raise ValueError("%s already holds a sharded table" % target)
+    src = ShardedTable(source, table=table)
+    dst = ShardedTable(target, shards, table=table, processes=processes, parallel_threshold=chunk_size)
+    count = 0
+    try:
+        if processes != 1:
+            dst._executor = ProcessPoolExecutor(processes)
+        rows = src._iter_rows(chunk_size)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            dst.bulk_update(chunk)
+            count += len(chunk)
+    finally:
+        if dst._executor is not None:
+            dst._executor.shutdown()
+            dst._executor = None
+        src.close()
+        dst.close()
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m sqlite_shelf.shardedshelf',
+                                     description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('reshard', help='copy a sharded table into a new shard count')
+    command.add_argument('source')
+    command.add_argument('target')
+    command.add_argument('shards', type=int)
+    command.add_argument('--table', default="DefaultTable")
+    command.add_argument('--chunk-size', type=int, default=10000)
+    command.add_argument('--processes', type=int)
+    args = parser.parse_args(argv)
+    if args.command != 'reshard':
+        parser.print_help()
+        return 2
+    count = reshard(args.source, args.target, args.shards, args.table, args.chunk_size, args.processes)
+    print('%d rows copied into %d shards' % (count, args.shards))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
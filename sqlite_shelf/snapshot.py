@@ -0,0 +1,242 @@
+""" Read-only snapshot files, served through mmap
+
+    write_snapshot(table, 'table.snap')
+    snapshot = SnapshotTable('table.snap')
+
+Processes opening the same snapshot share its pages through the OS page
+cache instead of each holding a copy of the table. Layout (little-endian):
+
+    header      magic, row count, column count and the offsets below
+    records     per row: cell count, then (column number, tagged value) per non-null cell
+    columns     per column: name length, UTF-8 name
+    ids         the UTF-8 row ids, sorted
+    id offsets  row count + 1 offsets into ids, for binary search
+    row offsets per sorted id, the offset of its record
+
+A tagged value is a type byte followed by a fixed (integer, float, bool)
+or length-prefixed (text, blob, big integer) payload.
+"""
+import mmap
+import os
+import struct
+from sqlite_shelf.mutabletable import MutableTable
+
+
+MAGIC = b'SQSNAP1\x00'
+_HEADER = struct.Struct('<8sQQQQQQ')
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+_I64 = struct.Struct('<q')
+_F64 = struct.Struct('<d')
+
+_NULL, _INT, _FLOAT, _TEXT, _BLOB, _BIGINT, _BOOL = range(7)
+
+
+def _encode_value(value):
+    cls = value.__class__
+    if value is None:
+        return bytes((_NULL,))
+    if cls is bool:
+        return bytes((_BOOL, value))
+    if cls is int:
+        if -2 ** 63 <= value < 2 ** 63:
+            return bytes((_INT,)) + _I64.pack(value)
+        data = str(value).encode('ascii')
+        return bytes((_BIGINT,)) + _U32.pack(len(data)) + data
+    if cls is float:
+        return bytes((_FLOAT,)) + _F64.pack(value)
+    if cls is str:
+        data = value.encode('utf-8')
+        return bytes((_TEXT,)) + _U32.pack(len(data)) + data
+    if cls is bytes:
+        return bytes((_BLOB,)) + _U32.pack(len(value)) + value
+    raise TypeError("Snapshots do not store %s values, set a codec" % cls.__name__)
+
+
+def _decode_value(buf, pos):
+    "Returns: (value, position after it)"
+    tag = buf[pos]
+    pos += 1
+    if tag == _INT:
+        return _I64.unpack_from(buf, pos)[0], pos + 8
+    if tag == _FLOAT:
+        return _F64.unpack_from(buf, pos)[0], pos + 8
+    if tag == _NULL:
+        return None, pos
+    if tag == _BOOL:
+        return bool(buf[pos]), pos + 1
+    size = _U32.unpack_from(buf, pos)[0]
+    pos += 4
+    data = buf[pos:pos + size]
+    if tag == _TEXT:
+        return data.decode('utf-8'), pos + size
+    if tag == _BLOB:
+        return bytes(data), pos + size
+    if tag == _BIGINT:
+        return int(data), pos + size
+    raise ValueError("Unknown value tag %d" % tag)
+
+
+def write_snapshot(table, path):
+    """ Writes the rows of any MutableTable (cells as stored, encoded if it has
+    a codec) to a snapshot file, atomically replacing path
+    Returns: number of rows
+    Raises: TypeError for non-str row ids or values without a tagged type
+    """
+    temp = path + '.tmp'
+    # Columns holding only None keep their place in the dictionary
+    columns = {col: number for number, col in enumerate(table._get_column_names())}
+    index = []
+    try:
+        with open(temp, 'wb') as f:
+            f.write(b'\x00' * _HEADER.size)
+            offset = _HEADER.size
+            for row, cells in table._iter_cells():
+                if not isinstance(row, str):
+                    raise TypeError("Snapshot row ids must be str, got %r" % (row,))
+                parts = []
+                for col, value in cells.items():
+                    if value is None:
+                        continue
+                    number = columns.get(col)
+                    if number is None:
+                        number = columns[col] = len(columns)
+                    parts.append(_U32.pack(number) + _encode_value(value))
+                record = _U32.pack(len(parts)) + b''.join(parts)
+                f.write(record)
+                index.append((row.encode('utf-8'), offset))
+                offset += len(record)
+            index.sort()
+
+            columns_offset = offset
+            for col in sorted(columns, key=columns.get):
+                data = col.encode('utf-8')
+                f.write(_U32.pack(len(data)) + data)
+                offset += 4 + len(data)
+            ids_offset = offset
+            id_offsets = [0]
+            for key, _ in index:
+                f.write(key)
+                id_offsets.append(id_offsets[-1] + len(key))
+            offset += id_offsets[-1]
+            id_offsets_offset = offset
+            f.write(struct.pack('<%dQ' % len(id_offsets), *id_offsets))
+            offset += 8 * len(id_offsets)
+            records_offset = offset
+            f.write(struct.pack('<%dQ' % len(index), *(record for _, record in index)))
+
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, len(index), len(columns), columns_offset, ids_offset,
+                                 id_offsets_offset, records_offset))
+    except BaseException:
+        os.remove(temp)
+        raise
+    os.replace(temp, path)
+    return len(index)
+
+
+class SnapshotTable(MutableTable):
+    """ Read-only MutableTable over a snapshot file, see write_snapshot()
+    Lookups binary search the sorted ids, scans go in id order; cells are
+    decoded from the mapping when read. Writes raise TypeError.
+    Raises: ValueError if path is not a snapshot
+    """
+    __slots__ = ('_file', '_mm', '_rows', '_columns', '_ids_offset', '_id_offsets_offset', '_records_offset')
+
+    def __init__(self, path):
+        MutableTable.__init__(self)
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self._rows, count, offset, self._ids_offset, self._id_offsets_offset, \
+                self._records_offset = _HEADER.unpack_from(self._mm, 0)
+            if magic != MAGIC:
+                raise ValueError("%s is not a snapshot" % path)
+        except (ValueError, struct.error):
+            self._file.close()
+            raise ValueError("%s is not a snapshot" % path)
+        columns = []
+        for _ in range(count):
+            size = _U32.unpack_from(self._mm, offset)[0]
+            columns.append(self._mm[offset + 4:offset + 4 + size].decode('utf-8'))
+            offset += 4 + size
+        self._columns = tuple(columns)
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def _id(self, n):
+        "Row id bytes of the n-th sorted id"
+        start, end = struct.unpack_from('<QQ', self._mm, self._id_offsets_offset + 8 * n)
+        return self._mm[self._ids_offset + start:self._ids_offset + end]
+
+    def _find(self, row):
+        "Position of row in the sorted ids, or -1"
+        if not isinstance(row, str):
+            return -1
+        key = row.encode('utf-8')
+        low, high = 0, self._rows
+        while low < high:
+            middle = (low + high) // 2
+            if self._id(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._rows and self._id(low) == key:
+            return low
+        return -1
+
+    def _record(self, n):
+        mm = self._mm
+        pos = _U64.unpack_from(mm, self._records_offset + 8 * n)[0]
+        cells = dict.fromkeys(self._columns)
+        count = _U32.unpack_from(mm, pos)[0]
+        pos += 4
+        columns = self._columns
+        for _ in range(count):
+            number = _U32.unpack_from(mm, pos)[0]
+            cells[columns[number]], pos = _decode_value(mm, pos + 4)
+        return cells
+
+    def _update_cells(self, row, values):
+        raise TypeError("SnapshotTable is read-only")
+
+    def _del_row(self, row):
+        raise TypeError("SnapshotTable is read-only")
+
+    def fill_column(self, col, value, overwrite=False):
+        raise TypeError("SnapshotTable is read-only")
+
+    def rename_column(self, old, new):
+        raise TypeError("SnapshotTable is read-only")
+
+    def drop_column(self, col):
+        raise TypeError("SnapshotTable is read-only")
+
+    def _get_cells(self, row):
+        "Raises: KeyError"
+        n = self._find(row)
+        if n < 0:
+            raise KeyError("Row with id %s does not exists" % row)
+        return self._record(n)
+
+    def _get_column_names(self):
+        return self._columns
+
+    def _get_row_names(self):
+        for n in range(self._rows):
+            yield self._id(n).decode('utf-8')
+
+    def _iter_cells(self):
+        for n in range(self._rows):
+            yield self._id(n).decode('utf-8'), self._record(n)
+
+    def _iter_items(self):
+        return self._prefetched_items(self._iter_cells())
+
+    def __contains__(self, row):
+        return self._find(row) >= 0
+
+    def __len__(self):
+        return self._rows
@@ -0,0 +1,473 @@
+""" SQLite table storing only its non-null cells, for many sparse columns
+
+    table = SparseSqliteTable(conn)
+    table = open_table(conn, column_threshold=1000)
+
+SqliteTable keeps one physical column per key, so with thousands of sparse
+keys every row is mostly NULL. SparseSqliteTable stores the same table as
+entity-attribute-value rows instead:
+
+    <table>__rows     _id of every row, present even without cells
+    <table>__columns  column names, in the order they were added
+    <table>__cells    (_id, col, value) clustered by (_id, col), with a
+                      covering (col, value) index for column reads and filters
+
+A cell set to None is deleted. Values keep their SQLite type, as there is no
+column affinity. migrate_to_sparse() and migrate_to_wide() convert a table
+between both layouts in place; open_table() picks the layout of a table
+when it is opened, a table open in the wide layout stays wide.
+"""
+from collections import OrderedDict
+from time import perf_counter
+from sqlite_shelf import query
+from sqlite_shelf.mutabletable import MutableTable
+from sqlite_shelf.sqliteshelf import SqliteTable, IngestStats, _own_writes
+
+
+_declared_types = {'text':"TEXT", 'integer':"INT", 'real':"REAL", 'blob':"BLOB"}
+# Stay below SQLITE_MAX_VARIABLE_NUMBER of older SQLite versions
+_MAX_VARIABLES = 500
+
+
+def _table_exists(c, name):
+    c.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', ('table', name))
+    return c.fetchone() is not None
+
+
+def layout_of(conn, table="DefaultTable"):
+    "'sparse', 'wide' or None if the table does not exist"
+    c = conn.cursor()
+    try:
+        if _table_exists(c, '%s__cells' % table):
+            return 'sparse'
+        if _table_exists(c, table):
+            return 'wide'
+        return None
+    finally:
+        c.close()
+
+
+def _create_sparse(c, table):
+    c.execute('CREATE TABLE IF NOT EXISTS %s__rows (_id TEXT PRIMARY KEY NOT NULL)' % table)
+    c.execute('CREATE TABLE IF NOT EXISTS %s__columns (col TEXT PRIMARY KEY NOT NULL)' % table)
+    c.execute('CREATE TABLE IF NOT EXISTS %s__cells (_id TEXT NOT NULL, col TEXT NOT NULL, value, '
+              'PRIMARY KEY (_id, col)) WITHOUT ROWID' % table)
+    c.execute('CREATE INDEX IF NOT EXISTS ix_%s__cells_col ON %s__cells (col, value)' % (table, table))
+
+
+def _check_untracked(c, table):
+    if _table_exists(c, '%s__changes' % table):
+        raise ValueError("%s tracks changes, disable change tracking before migrating it" % table)
+
+
+def migrate_to_sparse(conn, table="DefaultTable"):
+    """ Converts the SqliteTable table into the SparseSqliteTable layout, atomically
+    Its secondary indexes are dropped with it.
+    Raises: ValueError if table is not a wide table or tracks changes
+    """
+    if layout_of(conn, table) != 'wide':
+        raise ValueError("%s is not a SqliteTable" % table)
+    c = conn.cursor()
+    try:
+        _check_untracked(c, table)
+        c.execute('PRAGMA table_info(%s)' % table)
+        columns = [r[1] for r in c.fetchall()[1:]]
+        c.execute('SAVEPOINT migrate')
+        try:
+            _create_sparse(c, table)
+            c.execute('INSERT INTO %s__rows (_id) SELECT _id FROM %s ORDER BY rowid' % (table, table))
+            for col in columns:
+                c.execute('INSERT INTO %s__columns (col) VALUES (?)' % table, (col,))
+                c.execute('INSERT INTO %s__cells (_id, col, value) SELECT _id, ?, "%s" FROM %s '
+                          'WHERE "%s" IS NOT NULL' % (table, col, table, col), (col,))
+            c.execute('DROP TABLE %s' % table)
+        except BaseException:
+            c.execute('ROLLBACK TO migrate')
+            raise
+        finally:
+            c.execute('RELEASE migrate')
+    finally:
+        c.close()
+
+
+def migrate_to_wide(conn, table="DefaultTable"):
+    """ Converts the SparseSqliteTable table into the SqliteTable layout, atomically
+    Columns are declared after the type of one of their values.
+    Raises: ValueError if table is not a sparse table,
+            sqlite3.OperationalError past SQLite's column limit (2000 by default)
+    """
+    if layout_of(conn, table) != 'sparse':
+        raise ValueError("%s is not a SparseSqliteTable" % table)
+    c = conn.cursor()
+    try:
+        c.execute('SELECT col FROM %s__columns ORDER BY rowid' % table)
+        columns = OrderedDict()
+        for col, in c.fetchall():
+            c.execute('SELECT typeof(value) FROM %s__cells WHERE col = ? LIMIT 1' % table, (col,))
+            r = c.fetchone()
+            columns[col] = _declared_types.get(r and r[0], "TEXT")
+        c.execute('SAVEPOINT migrate')
+        try:
+            c.execute('CREATE TABLE %s (_id TEXT PRIMARY KEY NOT NULL%s)' %
+                      (table, ''.join(', "%s" %s' % item for item in columns.items())))
+            c.execute('INSERT INTO %s (_id) SELECT _id FROM %s__rows ORDER BY rowid' % (table, table))
+            for col in columns:
+                c.execute('UPDATE %s SET "%s" = (SELECT value FROM %s__cells AS cells '
+                          'WHERE cells._id = %s._id AND cells.col = ?) '
+                          'WHERE _id IN (SELECT _id FROM %s__cells WHERE col = ?)' %
+                          (table, col, table, table, table), (col, col))
+            for suffix in ('cells', 'columns', 'rows'):
+                c.execute('DROP TABLE %s__%s' % (table, suffix))
+        except BaseException:
+            c.execute('ROLLBACK TO migrate')
+            raise
+        finally:
+            c.execute('RELEASE migrate')
+    finally:
+        c.close()
+
+
+def open_table(conn, table="DefaultTable", layout=None, column_threshold=1000, **kwds):
+    """ SqliteTable or SparseSqliteTable of table, keyword arguments passed on
+    layout: 'wide' or 'sparse' to create or migrate table into that layout,
+            None to keep the layout of an existing table (wide for a new one),
+            moving a wide table past column_threshold columns to the sparse layout
+    column_threshold is only checked here: a wide table returned keeps adding
+    physical columns past it, up to SQLite's column limit (2000 by default,
+    beyond which writes of new columns raise sqlite3.OperationalError), and
+    moves to the sparse layout on the next open_table().
+    Raises: ValueError for an unknown layout
+    """
+    if layout not in (None, 'wide', 'sparse'):
+        raise ValueError("layout must be None, 'wide' or 'sparse', got %r" % (layout,))
+    current = layout_of(conn, table)
+    if layout is None and current == 'wide':
+        c = conn.cursor()
+        try:
+            c.execute('PRAGMA table_info(%s)' % table)
+            if len(c.fetchall()) - 1 > column_threshold:
+                layout = 'sparse'
+        finally:
+            c.close()
+    if layout == 'sparse' and current == 'wide':
+        migrate_to_sparse(conn, table)
+    elif layout == 'wide' and current == 'sparse':
+        migrate_to_wide(conn, table)
+    if (layout or current) == 'sparse':
+        return SparseSqliteTable(conn, table, **kwds)
+    return SqliteTable(conn, table, **kwds)
+
+
+class SparseSqliteTable(MutableTable):
+    """ MutableTable over the entity-attribute-value layout, see the module
+    Scans go in _id order, chunk_size rows per SELECT.
+    Raises: ValueError if table exists with the SqliteTable layout
+    """
+    __slots__ = ('_c', '_table', 'chunk_size', '_ingest_stats', '_columns', '_data_version', '_implicit')
+
+    def __init__(self, conn, table="DefaultTable", chunk_size=1000):
+        MutableTable.__init__(self)
+        self._c = conn.cursor()
+        self._table = table
+        self.chunk_size = chunk_size
+        self._ingest_stats = None
+        self._columns = None
+        self._data_version = None
+        self._implicit = None
+        if layout_of(conn, table) == 'wide':
+            self._c.close()
+            raise ValueError("%s has the SqliteTable layout, see migrate_to_sparse()" % table)
+        _create_sparse(self._c, table)
+
+    def close(self):
+        self._c.close()
+
+    # transaction() and savepoint() as BEGIN / SAVEPOINT, COMMIT / RELEASE, ROLLBACK [TO]
+    _undo_log = False
+
+    _in_outer_transaction = SqliteTable._in_outer_transaction
+
+    def _begin(self):
+        if self._c.connection.in_transaction:
+            self._c.connection.commit()
+        self._implicit = None
+        self._c.execute('BEGIN')
+        MutableTable._begin(self)
+
+    def _commit(self):
+        self._c.connection.commit()
+
+    def _rollback(self):
+        self._c.connection.rollback()
+        self._columns = None
+
+    def _savepoint(self, name):
+        self._c.execute('SAVEPOINT "%s"' % name)
+        return MutableTable._savepoint(self, name)
+
+    def _release_savepoint(self, savepoint):
+        self._c.execute('RELEASE "%s"' % savepoint.name)
+        MutableTable._release_savepoint(self, savepoint)
+
+    def _rollback_savepoint(self, savepoint):
+        self._c.execute('ROLLBACK TO "%s"' % savepoint.name)
+        self._c.execute('RELEASE "%s"' % savepoint.name)
+        self._columns = None
+        MutableTable._rollback_savepoint(self, savepoint)
+
+    @property
+    def last_ingest_stats(self):
+        "IngestStats of the latest bulk_update(), or None"
+        return self._ingest_stats
+
+    @_own_writes
+    def bulk_update(self, rows):
+        """ Upsert many rows at once, with the semantics of update()
+        rows: mapping or iterable of (row, values) pairs, values of None removes the row
+        All rows are written in a single savepoint with executemany.
+        Returns: IngestStats
+        """
+        start = perf_counter()
+        items = rows
+        if hasattr(rows, "keys"):
+            items = ((key, rows[key]) for key in rows.keys())
+        codec = self._codec
+
+        # Coalesce to the final state of each row, as SqliteTable.bulk_update
+        pending = OrderedDict()
+        removed = set()
+        count = 0
+        for row, values in items:
+            count += 1
+            if values is None:
+                pending[row] = None
+                removed.add(row)
+                continue
+            if codec is not None:
+                values = codec.encode_cells(values)
+            cells = pending.get(row)
+            if cells is None:
+                cells = pending[row] = dict()
+            cells.update((str(k), v) for k, v in values.items())
+            cells.pop("_id", None)
+
+        known = set(self._get_column_names())
+        new_columns = OrderedDict()
+        for cells in pending.values():
+            if cells is not None:
+                new_columns.update((col, None) for col in cells if col not in known)
+
+        table = self._table
+        self._c.execute('SAVEPOINT bulk_update')
+        try:
+            if removed:
+                self._c.executemany('DELETE FROM %s__rows WHERE _id = ?' % table, ((row,) for row in removed))
+                self._c.executemany('DELETE FROM %s__cells WHERE _id = ?' % table, ((row,) for row in removed))
+            self._add_columns(new_columns)
+            written = [(row, cells) for row, cells in pending.items() if cells is not None]
+            self._c.executemany('INSERT OR IGNORE INTO %s__rows (_id) VALUES (?)' % table,
+                                ((row,) for row, _ in written))
+            self._c.executemany('INSERT OR REPLACE INTO %s__cells (_id, col, value) VALUES (?, ?, ?)' % table,
+                                ((row, col, value) for row, cells in written
+                                 for col, value in cells.items() if value is not None))
+            self._c.executemany('DELETE FROM %s__cells WHERE _id = ? AND col = ?' % table,
+                                ((row, col) for row, cells in written
+                                 for col, value in cells.items() if value is None))
+        except BaseException:
+            self._c.execute('ROLLBACK TO bulk_update')
+            self._columns = None
+            raise
+        finally:
+            self._c.execute('RELEASE bulk_update')
+            self._invalidate_row_cache()
+
+        if self._transaction is not None:
+            self._count_ops(count)
+        seconds = perf_counter() - start
+        self._ingest_stats = IngestStats(count, seconds, count / seconds if seconds else float('inf'))
+        return self._ingest_stats
+
+    def _update_rows(self, items):
+        self.bulk_update(items)
+
+    def _add_columns(self, columns):
+        "Registers new column names, keeping the column cache current"
+        if not columns:
+            return
+        self._c.executemany('INSERT OR IGNORE INTO %s__columns (col) VALUES (?)' % self._table,
+                            ((col,) for col in columns))
+        if self._columns is not None:
+            self._columns += tuple(col for col in columns if col not in self._columns)
+
+    @_own_writes
+    def _del_row(self, row):
+        "Raises: KeyError"
+        self._c.execute('DELETE FROM %s__rows WHERE _id = ?' % self._table, (row,))
+        if self._c.rowcount == 0:
+            raise KeyError("Row with id %s does not exists in %s" % (row, self._table))
+        self._c.execute('DELETE FROM %s__cells WHERE _id = ?' % self._table, (row,))
+
+    @_own_writes
+    def _update_cells(self, row, values):
+        values = {str(k): v for k, v in values.items()}
+        values.pop("_id", None)
+        columns = self._get_column_names()
+        self._add_columns([col for col in values if col not in columns])
+        table = self._table
+        self._c.execute('INSERT OR IGNORE INTO %s__rows (_id) VALUES (?)' % table, (row,))
+        cleared = [col for col, value in values.items() if value is None]
+        if len(values) >= len(columns) and all(col in values for col in columns):
+            # A whole row written by __setitem__, the usual case: replace its cells
+            self._c.execute('DELETE FROM %s__cells WHERE _id = ?' % table, (row,))
+        else:
+            for n in range(0, len(cleared), _MAX_VARIABLES):
+                chunk = cleared[n:n + _MAX_VARIABLES]
+                self._c.execute('DELETE FROM %s__cells WHERE _id = ? AND col IN (%s)' %
+                                (table, ', '.join('?' * len(chunk))), [row] + chunk)
+        self._c.executemany('INSERT OR REPLACE INTO %s__cells (_id, col, value) VALUES (?, ?, ?)' % table,
+                            ((row, col, value) for col, value in values.items() if value is not None))
+
+    def _get_cells(self, row):
+        "Raises: KeyError"
+        self._c.execute('SELECT col, value FROM %s__cells WHERE _id = ?' % self._table, (row,))
+        found = self._c.fetchall()
+        if not found and row not in self:
+            raise KeyError("Row with id %s does not exists in %s" % (row, self._table))
+        cells = dict.fromkeys(self._get_column_names())
+        cells.update(found)
+        return cells
+
+    @_own_writes
+    def fill_column(self, col, value, overwrite=False):
+        "Sets the empty (None) cells of col, or all of them if overwrite, to value, in one statement"
+        if self._codec is not None:
+            value = self._codec.encode(value, col)
+        self._add_columns([col])
+        if value is None:
+            if overwrite:
+                self._c.execute('DELETE FROM %s__cells WHERE col = ?' % self._table, (col,))
+        else:
+            self._c.execute('INSERT OR %s INTO %s__cells (_id, col, value) SELECT _id, ?, ? FROM %s__rows' %
+                            ('REPLACE' if overwrite else 'IGNORE', self._table, self._table), (col, value))
+        self._columns_changed()
+
+    @_own_writes
+    def rename_column(self, old, new):
+        "Raises: KeyError if old does not exist, ValueError if new does"
+        self._check_rename(old, new)
+        self._c.execute('UPDATE %s__columns SET col = ? WHERE col = ?' % self._table, (new, old))
+        self._c.execute('UPDATE %s__cells SET col = ? WHERE col = ?' % self._table, (new, old))
+        self._columns_changed()
+
+    @_own_writes
+    def drop_column(self, col):
+        "Raises: KeyError"
+        self._check_column(col)
+        self._c.execute('DELETE FROM %s__columns WHERE col = ?' % self._table, (col,))
+        self._c.execute('DELETE FROM %s__cells WHERE col = ?' % self._table, (col,))
+        self._columns_changed()
+
+    def _columns_changed(self):
+        MutableTable._columns_changed(self)
+        self._columns = None
+
+    def _iter_column(self, col):
+        c = self._c.connection.cursor()
+        try:
+            c.execute('SELECT r._id, c.value FROM %s__rows AS r LEFT JOIN %s__cells AS c '
+                      'ON c._id = r._id AND c.col = ?' % (self._table, self._table), (col,))
+            while True:
+                chunk = c.fetchmany(self.chunk_size)
+                if not chunk:
+                    return
+                yield from chunk
+        finally:
+            c.close()
+
+    def _get_column_names(self):
+        """ Cached column names
+        Reloaded when PRAGMA data_version shows another connection wrote
+        """
+        self._c.execute('PRAGMA data_version')
+        version = self._c.fetchone()[0]
+        if self._columns is None or version != self._data_version:
+            self._c.execute('SELECT col FROM %s__columns ORDER BY rowid' % self._table)
+            self._columns = tuple(r[0] for r in self._c.fetchall())
+            self._data_version = version
+        return self._columns
+
+    def _get_row_names(self):
+        # Own cursor, so callers may keep using the table while iterating
+        c = self._c.connection.cursor()
+        try:
+            c.execute('SELECT _id FROM %s__rows' % self._table)
+            for row in c:
+                yield row[0]
+        finally:
+            c.close()
+
+    def iter_rows(self, chunk_size=None):
+        "Streams (row, cells dict) pairs in _id order, see SqliteTable.iter_rows()"
+        return self._decode_items(self._iter_rows(chunk_size))
+
+    def _iter_rows(self, chunk_size=None, rows_sql=None, params=()):
+        """ Keyset-paginated scan, one SELECT per chunk of chunk_size rows
+        rows_sql: SELECT of the _id to scan instead of all of them
+        """
+        chunk_size = chunk_size or self.chunk_size
+        rows_sql = rows_sql or 'SELECT _id FROM %s__rows' % self._table
+        c = self._c.connection.cursor()
+        try:
+            last = None
+            while True:
+                columns = self._get_column_names()
+                after = '' if last is None else ' WHERE _id > ?'
+                c.execute('SELECT r._id, c.col, c.value FROM (SELECT _id FROM (%s)%s ORDER BY _id LIMIT ?) AS r '
+                          'LEFT JOIN %s__cells AS c ON c._id = r._id ORDER BY r._id' % (rows_sql, after, self._table),
+                          tuple(params) + (() if last is None else (last,)) + (chunk_size,))
+                count = 0
+                cells = None
+                for row, col, value in c.fetchall():
+                    if row != last:
+                        if cells is not None:
+                            yield last, cells
+                        last = row
+                        cells = dict.fromkeys(columns)
+                        count += 1
+                    if col is not None:
+                        cells[col] = value
+                if cells is not None:
+                    yield last, cells
+                if count < chunk_size:
+                    return
+        finally:
+            c.close()
+
+    def _iter_items(self):
+        return self._prefetched_items(self._iter_rows())
+
+    def _iter_cells(self):
+        return self._iter_rows()
+
+    def query(self, columns=None, where=None, order_by=None, limit=None):
+        """ Streams (row, cells dict) pairs matching where, see sqlite_shelf.query
+        An equality condition narrows the scan to its rows through the
+        (col, value) index, the rest is evaluated on the scanned rows.
+        """
+        rows_sql = None
+        params = ()
+        for col, op, operand in query.conditions(where):
+            if op == '=' and operand is not None and col != '_id':
+                rows_sql = 'SELECT _id FROM %s__cells WHERE col = ? AND value = ?' % self._table
+                params = (col, operand)
+                break
+        return self._decode_items(query.evaluate(self._iter_rows(None, rows_sql, params),
+                                                 columns, where, order_by, limit))
+
+    def __contains__(self, row):
+        self._c.execute('SELECT 1 FROM %s__rows WHERE _id = ? LIMIT 1' % self._table, (row,))
+        return self._c.fetchone() is not None
+
+    def __len__(self):
+        self._c.execute('SELECT COUNT(*) FROM %s__rows' % self._table)
+        return self._c.fetchone()[0]
@@ -1,72 +1,904 @@
-from collections import Mapping, MutableMapping
-from es_commons.suppress2 import suppress
+from collections import OrderedDict, namedtuple
+from functools import wraps
+from sqlite_shelf.suppress import suppress
+from time import perf_counter
+import json
 import sqlite3
-import re
 from sqlite_shelf.mutabletable import MutableTable
+from sqlite_shelf import query
+
+
+IngestStats = namedtuple('IngestStats', ('rows', 'seconds', 'rows_per_sec'))
+SchemaCacheInfo = namedtuple('SchemaCacheInfo', ('hits', 'misses', 'invalidations'))
+IndexInfo = namedtuple('IndexInfo', ('name', 'columns', 'unique', 'partial'))
+Change = namedtuple('Change', ('version', 'row', 'op', 'columns'))
+
+
+def _own_writes(method):
+    """ Keeps track of the implicit transaction the writes of method leave open
+    self._implicit is the connection's total_changes after this table's latest
+    write, as long as only this table wrote in the open transaction, else None.
+    Every method writing to the connection is wrapped, else transaction() would
+    take the table's own implicit transaction for somebody else's.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwds):
+        conn = self._c.connection
+        opened = not conn.in_transaction
+        before = conn.total_changes
+        try:
+            return method(self, *args, **kwds)
+        finally:
+            self._implicit = conn.total_changes if opened or self._implicit == before else None
+    return wrapper
+
+
+# Values sqlite3 binds without an adapter
+_bindable_types = (str, int, float, bytes, bytearray, memoryview, None.__class__)
+
+
+def _check_bindable(values):
+    "Raises: sqlite3.ProgrammingError for a value sqlite3 cannot bind, as a write of it would"
+    for col, value in values.items():
+        if not isinstance(value, _bindable_types) and not hasattr(value, '__conform__') and \
+                (value.__class__, sqlite3.PrepareProtocol) not in sqlite3.adapters:
+            raise sqlite3.ProgrammingError("Error binding column %s: type '%s' is not supported"
+                                           % (col, value.__class__.__name__))
+
+
+def _where_identifiers(sql):
+    """ Identifiers, lowercased, in the WHERE clause of a CREATE INDEX statement
+    String literals are skipped; keywords count as identifiers.
+    """
+    depth = 0
+    columns = where = False
+    ret = set()
+    i = 0
+    while i < len(sql):
+        ch = sql[i]
+        if ch in '\'"`[':
+            end = ']' if ch == '[' else ch
+            j = i + 1
+            while True:
+                j = sql.find(end, j)
+                if j < 0:
+                    j = len(sql)
+                elif end != ']' and sql[j + 1:j + 2] == end:
+                    j += 2
+                    continue
+                break
+            if where and ch != "'":
+                ret.add(sql[i + 1:j].replace(end * 2, end).lower())
+            i = j + 1
+        elif ch.isalnum() or ch == '_':
+            j = i
+            while j < len(sql) and (sql[j].isalnum() or sql[j] in '_$'):
+                j += 1
+            word = sql[i:j]
+            if where:
+                ret.add(word.lower())
+            elif columns and depth == 0 and word.upper() == 'WHERE':
+                where = True
+            i = j
+        else:
+            if ch == '(':
+                depth += 1
+            elif ch == ')':
+                depth -= 1
+                columns = depth == 0
+            i += 1
+    return ret
+
+
+class IndexAdvisor(object):
+    """ Counts the column sets queries filter on and suggests indexes for them
+    A candidate is the equality columns followed by at most one range column,
+    the usual shape of a useful composite index.
+    """
+    __slots__ = ('threshold', 'auto_create', '_counts')
+    _range_ops = ('<', '<=', '>', '>=', 'between')
+
+    def __init__(self, threshold=100, auto_create=False):
+        self.threshold = threshold
+        self.auto_create = auto_create
+        self._counts = dict()
+
+    def observe(self, conds, known_columns):
+        "Returns the candidate once it reaches the threshold, else None"
+        equal = sorted(set(col for col, op, _ in conds
+                           if col in known_columns and op in ('=', 'in', 'is')))
+        ranges = [col for col, op, _ in conds
+                  if col in known_columns and op in self._range_ops and col not in equal]
+        candidate = tuple(equal + ranges[:1])
+        if not candidate:
+            return None
+        count = self._counts[candidate] = self._counts.get(candidate, 0) + 1
+        if count == self.threshold:
+            return candidate
+        return None
+
+    def suggestions(self):
+        "Candidates past the threshold, most used first, as (columns, count)"
+        return sorted(((columns, count) for columns, count in self._counts.items()
+                       if count >= self.threshold), key=lambda item: -item[1])
+
+    def forget(self, columns):
+        self._counts.pop(tuple(columns), None)
 
 
 class SqliteTable(MutableTable):
-    __slots__ = ('_c', '_table')
-    _type_mapping = {str:"TEXT", int:"INT", float:"REAL", None.__class__:"TEXT"}
+    __slots__ = ('_c', '_table', 'chunk_size', '_ingest_stats', '_advisor', '_sql_cache', 'sql_cache_size',
+                 '_pending', '_pending_columns', '_pending_since', '_flush_rows', '_flush_age',
+                 '_schema', '_columns', '_schema_version',
+                 '_schema_hits', '_schema_misses', '_schema_invalidations', '_changes', '_implicit',
+                 '_schema_checked')
+    _type_mapping = {str:"TEXT", int:"INT", float:"REAL", bytes:"BLOB", None.__class__:"TEXT"}
     
-    def __init__(self, conn, table="DefaultTable"):
+    def __init__(self, conn, table="DefaultTable", chunk_size=1000, sql_cache_size=128):
+        MutableTable.__init__(self)
         self._c = conn.cursor()
         self._table = table
+        self.chunk_size = chunk_size
+        self._sql_cache = OrderedDict()
+        self.sql_cache_size = sql_cache_size
+        self._ingest_stats = None
+        self._schema = None
+        self._columns = ()
+        self._schema_version = None
+        self._schema_hits = self._schema_misses = self._schema_invalidations = 0
+        self._advisor = None
+        self._pending = None
+        self._pending_columns = OrderedDict()
+        self._pending_since = None
+        self._flush_rows = self._flush_age = None
+        self._implicit = None
+        self._schema_checked = False
         with suppress(sqlite3.Error, regex=r"table %s already exists" % table):
             self._c.execute('CREATE TABLE %s (_id TEXT PRIMARY KEY NOT NULL)' % self._table)
+        self._changes = self._find_changelog()
         
     def close(self):
+        self.flush()
         self._c.close()
+
+    def enable_write_behind(self, max_rows=1000, max_age=1.0):
+        """ Buffer cell writes per row in memory and write them as one bulk upsert
+        once max_rows rows are pending or the oldest pending write is max_age
+        seconds old, on flush() and on close().
+        Reads see pending writes; scans, len() and queries flush first.
+        max_age is checked only when the next write is buffered, there is no
+        timer: pending cells of an idle table wait for one of the above.
+        """
+        if self._pending is None:
+            self._pending = OrderedDict()
+        self._flush_rows = max_rows
+        self._flush_age = max_age
+
+    def disable_write_behind(self):
+        self.flush()
+        self._pending = None
+
+    def flush(self):
+        """ Write pending cells of write-behind mode
+        If that raises, none of them was written and they stay pending, for
+        flush() to retry; rolling back the transaction drops them.
+        """
+        if not self._pending:
+            return
+        self._bulk_write(self._pending.items(), self._pending_columns)
+        self._discard_pending()
+
+    def _discard_pending(self):
+        if self._pending:
+            self._pending.clear()
+            self._pending_columns = OrderedDict()
+            self._pending_since = None
+
+    # transaction() and savepoint() as BEGIN / SAVEPOINT, COMMIT / RELEASE, ROLLBACK [TO]
+    _undo_log = False
+
+    def _in_outer_transaction(self):
+        """ An open transaction of the connection, unless it is the implicit one
+        holding only this table's writes, which transaction() commits first
+        """
+        conn = self._c.connection
+        return conn.in_transaction and self._implicit != conn.total_changes
+
+    def _begin(self):
+        self.flush()
+        if self._c.connection.in_transaction:
+            self._c.connection.commit()
+        self._implicit = None
+        self._c.execute('BEGIN')
+        self._schema_checked = False
+        MutableTable._begin(self)
+
+    def _commit(self):
+        self.flush()
+        self._c.connection.commit()
+
+    def _rollback(self):
+        self._discard_pending()
+        self._c.connection.rollback()
+
+    def _savepoint(self, name):
+        self.flush()
+        self._c.execute('SAVEPOINT "%s"' % name)
+        return MutableTable._savepoint(self, name)
+
+    def _release_savepoint(self, savepoint):
+        self.flush()
+        self._c.execute('RELEASE "%s"' % savepoint.name)
+        MutableTable._release_savepoint(self, savepoint)
+
+    def _rollback_savepoint(self, savepoint):
+        self._discard_pending()
+        self._c.execute('ROLLBACK TO "%s"' % savepoint.name)
+        self._c.execute('RELEASE "%s"' % savepoint.name)
+        MutableTable._rollback_savepoint(self, savepoint)
+
+    @property
+    def last_ingest_stats(self):
+        "IngestStats of the latest bulk_update(), or None"
+        return self._ingest_stats
+
+    def bulk_update(self, rows):
+        """ Upsert many rows at once, with the semantics of update()
+        rows: mapping or iterable of (row, values) pairs, values of None removes the row
+
+        New columns are added once up front and all rows are written in a
+        single transaction (savepoint) with executemany.
+        Returns: IngestStats
+        """
+        self.flush()
+        if self._codec is not None:
+            items = rows
+            if hasattr(rows, "keys"):
+                items = ((key, rows[key]) for key in rows.keys())
+            codec = self._codec
+            rows = ((row, values if values is None else codec.encode_cells(values))
+                    for row, values in items)
+        stats = self._bulk_write(rows)
+        if self._transaction is not None:
+            self._count_ops(stats.rows)
+        return stats
+
+    @_own_writes
+    def _bulk_write(self, rows, column_values=None):
+        """ Writes rows in one savepoint
+        column_values: {new column: value}, typing new columns before the values in rows
+        """
+        start = perf_counter()
+        items = rows
+        if hasattr(rows, "keys"):
+            items = ((key, rows[key]) for key in rows.keys())
+
+        # Coalesce to the final state of each row; rows removed along the
+        # way are deleted first and then re-inserted from scratch
+        pending = OrderedDict()
+        removed = set()
+        count = 0
+        for row, values in items:
+            count += 1
+            if values is None:
+                pending[row] = None
+                removed.add(row)
+                continue
+            cells = pending.get(row)
+            if cells is None:
+                cells = pending[row] = dict()
+            cells.update((str(k), v) for k, v in values.items())
+            cells.pop("_id", None)
+
+        columns = set(self._get_schema())
+        new_columns = OrderedDict((col, value) for col, value in (column_values or {}).items()
+                                  if col not in columns)
+        groups = OrderedDict()
+        for row, cells in pending.items():
+            if cells is None:
+                continue
+            for col, value in cells.items():
+                if col not in columns and new_columns.get(col) is None:
+                    new_columns[col] = value
+            signature = tuple(sorted(cells))
+            groups.setdefault(signature, []).append(
+                (row,) + tuple(cells[col] for col in signature))
+        # Unsupported types raise KeyError before anything is written
+        for value in new_columns.values():
+            self._type_mapping[value.__class__]
+
+        self._c.execute('SAVEPOINT bulk_update')
+        try:
+            if self._changes is not None:
+                self._log_bulk(pending, removed)
+            for col, value in new_columns.items():
+                self._add_column(col, value)
+            if removed:
+                self._c.executemany('DELETE FROM %s WHERE _id = ?' % self._table,
+                                    ((row,) for row in removed))
+            for signature, params in groups.items():
+                self._c.executemany(self._upsert_sql(signature), params)
+        except BaseException:
+            self._c.execute('ROLLBACK TO bulk_update')
+            if new_columns:
+                # Columns added to the schema cache are gone again
+                self._schema = None
+            raise
+        finally:
+            self._c.execute('RELEASE bulk_update')
+            self._generation += 1
+            if self._row_cache is not None:
+                if new_columns:
+                    self._row_cache.clear()
+                else:
+                    for row in pending:
+                        self._row_cache.discard(row)
+
+        seconds = perf_counter() - start
+        self._ingest_stats = IngestStats(count, seconds, count / seconds if seconds else float('inf'))
+        return self._ingest_stats
+
+    def _upsert_sql(self, columns):
+        """ INSERT ... ON CONFLICT(_id) DO UPDATE for positional (_id, *columns)
+        Kept in a bounded LRU keyed by the column tuple
+        """
+        cache = self._sql_cache
+        try:
+            sql = cache[columns]
+        except KeyError:
+            pass
+        else:
+            cache.move_to_end(columns)
+            return sql
+        sql = 'INSERT INTO %s ("_id"%s) VALUES (?%s) ON CONFLICT(_id) DO ' % (
+            self._table, ''.join(', "%s"' % col for col in columns), ', ?' * len(columns))
+        if not columns:
+            sql += 'NOTHING'
+        else:
+            sql += 'UPDATE SET ' + ', '.join('"%s" = excluded."%s"' % (col, col) for col in columns)
+        if self.sql_cache_size:
+            cache[columns] = sql
+            if len(cache) > self.sql_cache_size:
+                cache.popitem(last=False)
+        return sql
+
+    def _update_rows(self, items):
+        self.bulk_update(items)
     
+    @_own_writes
     def _del_row(self, row):
         "Raises: KeyError"
+        if self._pending and row in self._pending:
+            # Write it first, keeping any column it introduced
+            self.flush()
         self._c.execute('DELETE FROM %s WHERE _id = ?' % self._table, (row,))
         assert self._c.rowcount < 2
         if self._c.rowcount == 0:
             raise KeyError("Row with id %s does not exists in %s" % (row,self._table))
+        if self._changelog() is not None:
+            self._log_change(row, 'delete', None)
         
         
     
+    @_own_writes
     def _update_cells(self, row, values):
         values = {str(k): v for k, v in values.items()}
-        values["_id"] = row
-        while True:
-            try:
-                self._c.execute('UPDATE %s SET "%s WHERE _id = :_id' % 
-                                    (self._table, ', "'.join(map(lambda x: x+'" = :'+x, filter(lambda x: x!="_id", values.keys())))),
-                                    values)
-                assert self._c.rowcount < 2
-                if self._c.rowcount == 0:
-                    self._c.execute('INSERT INTO "%s" ("%s") VALUES (:%s)' % (self._table, '", "'.join(values.keys()), ", :".join(values.keys())), values)
-                return
-            except sqlite3.OperationalError as e:
-                match = re.match(r"no such column: (\w+)", e.args[0])
-                if match:
-                    self._c.execute('ALTER TABLE %s ADD COLUMN "%s" %s' % (self._table, match.group(1), self._type_mapping[values[match.group(1)].__class__]))
-                    continue
+        if self._pending is not None:
+            self._buffer_cells(row, values)
+            return
+        values.pop("_id", None)
+        columns = tuple(sorted(values))
+        params = [row]
+        params.extend([values[col] for col in columns])
+        op = None
+        if self._changelog() is not None:
+            op = 'update' if row in self else 'insert'
+        try:
+            self._upsert_row(columns, values, params)
+        except sqlite3.OperationalError:
+            # Retry once if the cached schema turns out to be stale
+            cached = self._schema
+            if cached is None or self._get_schema() is cached:
                 raise
-    
+            self._upsert_row(columns, values, params)
+        if op is not None and (columns or op == 'insert'):
+            self._log_change(row, op, columns)
+
+    def _upsert_row(self, columns, values, params):
+        "Adds columns missing from the cached schema up front, then upserts"
+        schema = self._schema
+        if schema is None or not schema.keys() >= values.keys():
+            schema = self._get_schema()
+            for col in columns:
+                if col not in schema:
+                    self._add_column(col, values[col])
+        self._c.execute(self._upsert_sql(columns), params)
+
+    def _buffer_cells(self, row, values):
+        """ Raises, as unbuffered writes, before anything is buffered:
+            KeyError if a new column's value has no SQLite type
+            sqlite3.ProgrammingError if a value cannot be bound
+        """
+        values.pop("_id", None)
+        schema = self._schema if self._schema is not None else self._get_schema()
+        new = [col for col in values if col not in schema and col not in self._pending_columns]
+        for col in new:
+            self._type_mapping[values[col].__class__]
+        _check_bindable(values)
+        # The first value of a new column types it, as unbuffered writes do
+        self._pending_columns.update((col, values[col]) for col in new)
+        try:
+            self._pending[row].update(values)
+        except KeyError:
+            self._pending[row] = values
+        if self._pending_since is None:
+            self._pending_since = perf_counter()
+        if len(self._pending) >= self._flush_rows or \
+                perf_counter() - self._pending_since >= self._flush_age:
+            self.flush()
+
     def _get_cells(self, row):
         "Raises: KeyError"
+        pending = self._pending.get(row) if self._pending else None
         self._c.execute('SELECT * FROM %s WHERE _id = ?' % self._table, (row,))
         r = self._c.fetchone()
         if r is None:
-            raise KeyError("Row with id %s does not exists in %s" % (row,self._table))
-        r = sqlite3.Row(self._c, r)
-        assert r["_id"] == row
-        r = dict(r)
-        del r["_id"]
+            if pending is None:
+                raise KeyError("Row with id %s does not exists in %s" % (row,self._table))
+            r = dict.fromkeys(self._get_column_names())
+        else:
+            r = dict(zip([d[0] for d in self._c.description], r))
+            assert r["_id"] == row
+            del r["_id"]
+        if pending is not None:
+            r.update(pending)
+        for col in self._pending_columns:
+            r.setdefault(col, None)
         return r
     
     
-    def _get_column_names(self):
+    def column_types(self):
+        "Columns in table order, mapped to their declared type"
+        self.flush()
+        return OrderedDict(self._get_schema())
+
+    def schema_cache_info(self):
+        return SchemaCacheInfo(self._schema_hits, self._schema_misses, self._schema_invalidations)
+
+    @_own_writes
+    def create_index(self, columns, name=None, unique=False, where=None):
+        """ Index one or more columns, partial if where is given (see sqlite_shelf.query)
+        Returns: index name
+        Raises: KeyError if a column does not exist
+        """
+        if isinstance(columns, str):
+            columns = [columns]
+        self.flush()
+        schema = self._get_schema()
+        for col in columns:
+            if col not in schema:
+                raise KeyError("Column %s does not exists in %s" % (col, self._table))
+        if name is None:
+            name = 'ix_%s_%s' % (self._table, '_'.join(columns))
+        sql = 'CREATE %sINDEX "%s" ON %s (%s)' % ('UNIQUE ' if unique else '', name, self._table,
+                                                  ', '.join('"%s"' % col for col in columns))
+        if where:
+            sql += ' WHERE ' + query.compile_where(where, lambda col: '"%s"' % col)
+        self._c.execute(sql)
+        if self._advisor is not None:
+            self._advisor.forget(columns)
+        return name
+
+    @_own_writes
+    def drop_index(self, name):
+        "Raises: KeyError"
+        if name not in (index.name for index in self.list_indexes()):
+            raise KeyError("Index %s does not exists on %s" % (name, self._table))
+        self._c.execute('DROP INDEX "%s"' % name)
+
+    def list_indexes(self):
+        "IndexInfo of the secondary indexes, the _id primary key excluded"
+        self._c.execute('PRAGMA index_list(%s)' % self._table)
+        indexes = [row for row in self._c.fetchall() if row[3] == 'c']
+        ret = []
+        for seq, name, unique, origin, partial in indexes:
+            self._c.execute('PRAGMA index_info("%s")' % name)
+            columns = tuple(row[2] for row in sorted(self._c.fetchall()))
+            ret.append(IndexInfo(name, columns, bool(unique), bool(partial)))
+        return ret
+
+    def enable_index_advisor(self, threshold=100, auto_create=False):
+        """ Watch query() predicates and suggest (or create, if auto_create)
+        an index once a column set has been queried threshold times
+        """
+        self._advisor = IndexAdvisor(threshold, auto_create)
+
+    def disable_index_advisor(self):
+        self._advisor = None
+
+    def suggest_indexes(self):
+        "(columns, count) the advisor would index, not covered by an existing index"
+        if self._advisor is None:
+            return []
+        covered = [index.columns for index in self.list_indexes() if not index.partial]
+        return [(columns, count) for columns, count in self._advisor.suggestions()
+                if not any(existing[:len(columns)] == columns for existing in covered)]
+
+    @_own_writes
+    def fill_column(self, col, value, overwrite=False):
+        "Sets the empty (NULL) cells of col, or all of them if overwrite, to value, in one UPDATE"
+        self.flush()
+        if self._codec is not None:
+            value = self._codec.encode(value, col)
+        self._add_column(col, value)
+        where = '' if overwrite else ' WHERE "%s" IS NULL' % col
+        if self._changelog() is not None:
+            self._log_all([col], where)
+        self._c.execute('UPDATE %s SET "%s" = ?%s' % (self._table, col, where), (value,))
+        self._columns_changed()
+
+    @_own_writes
+    def rename_column(self, old, new):
+        """ ALTER TABLE RENAME COLUMN, or a table rebuild before SQLite 3.25
+        Raises: KeyError if old does not exist, ValueError if new does
+        """
+        self.flush()
+        self._check_rename(old, new)
+        if self._changelog() is not None:
+            self._log_all([old, new])
+        if sqlite3.sqlite_version_info >= (3, 25, 0):
+            self._c.execute('ALTER TABLE %s RENAME COLUMN "%s" TO "%s"' % (self._table, old, new))
+        else:
+            self._rebuild(OrderedDict((col, new if col == old else col) for col in self._get_schema()))
+        self._columns_changed()
+
+    @_own_writes
+    def drop_column(self, col):
+        """ ALTER TABLE DROP COLUMN, or a table rebuild before SQLite 3.35
+        Indexes on the column are dropped with it.
+        Raises: KeyError
+        """
+        self.flush()
+        self._check_column(col)
+        if self._changelog() is not None:
+            self._log_all([col])
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            for name in self._indexes_using(col):
+                self._c.execute('DROP INDEX "%s"' % name)
+            self._c.execute('ALTER TABLE %s DROP COLUMN "%s"' % (self._table, col))
+        else:
+            self._rebuild(OrderedDict((name, name) for name in self._get_schema() if name != col))
+        self._columns_changed()
+
+    def _indexes_using(self, col):
+        "Names of the secondary indexes on col, or whose WHERE clause names it"
+        self._c.execute('PRAGMA index_list(%s)' % self._table)
+        indexes = [row for row in self._c.fetchall() if row[3] == 'c']
+        ret = []
+        for seq, name, unique, origin, partial in indexes:
+            self._c.execute('PRAGMA index_xinfo("%s")' % name)
+            # Key columns only, not the rowid appended to every index
+            if any(row[2] == col and row[5] for row in self._c.fetchall()):
+                ret.append(name)
+            elif partial:
+                self._c.execute('SELECT sql FROM sqlite_master WHERE type = ? AND name = ?', ('index', name))
+                if col.lower() in _where_identifiers(self._c.fetchone()[0]):
+                    ret.append(name)
+        return ret
+
+    def _rebuild(self, columns):
+        """ Copies the table into a new one with columns (old name -> new name) only
+        Indexes are recreated on the kept columns, partial ones are lost.
+        """
+        schema = self._get_schema()
+        indexes = self.list_indexes()
+        temp = '%s__rebuild' % self._table
+        self._c.execute('CREATE TABLE %s (_id TEXT PRIMARY KEY NOT NULL%s)' %
+                        (temp, ''.join(', "%s" %s' % (new, schema[old]) for old, new in columns.items())))
+        self._c.execute('INSERT INTO %s (_id%s) SELECT _id%s FROM %s' %
+                        (temp, ''.join(', "%s"' % new for new in columns.values()),
+                         ''.join(', "%s"' % old for old in columns), self._table))
+        self._c.execute('DROP TABLE %s' % self._table)
+        self._c.execute('ALTER TABLE %s RENAME TO %s' % (temp, self._table))
+        for index in indexes:
+            if not index.partial and all(col in columns for col in index.columns):
+                self.create_index([columns[col] for col in index.columns], index.name, index.unique)
+
+    def _columns_changed(self):
+        MutableTable._columns_changed(self)
+        self._sql_cache.clear()
+
+    def _iter_column(self, col):
+        self.flush()
+        if col not in self._get_schema():
+            for row in self._get_row_names():
+                yield row, None
+            return
+        c = self._c.connection.cursor()
+        try:
+            c.execute('SELECT _id, "%s" FROM %s' % (col, self._table))
+            while True:
+                chunk = c.fetchmany(self.chunk_size)
+                if not chunk:
+                    return
+                yield from chunk
+        finally:
+            c.close()
+
+    @_own_writes
+    def enable_change_tracking(self):
+        """ Log inserted, updated (with the columns written) and deleted rows to
+        the <table>__changes table, in the transaction of each write, see changes_since()
+        Tracking is kept in the database, later opened tables keep logging.
+        """
+        if self._changelog() is not None:
+            return
+        self.flush()
+        changes = '%s__changes' % self._table
+        self._c.execute('CREATE TABLE %s (version INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        '_id TEXT NOT NULL, op TEXT NOT NULL, columns TEXT)' % changes)
+        self._c.execute('CREATE INDEX ix_%s__id ON %s (_id)' % (changes, changes))
+        self._changes = changes
+
+    @_own_writes
+    def disable_change_tracking(self):
+        "Stops tracking and drops the changelog"
+        if self._changelog() is None:
+            return
+        self.flush()
+        self._c.execute('DROP TABLE %s' % self._changes)
+        self._changes = None
+
+    def change_version(self):
+        "Version of the latest change, 0 if none. Raises: TypeError if tracking is disabled"
+        self._check_tracking()
+        self.flush()
+        self._c.execute('SELECT MAX(version) FROM %s' % self._changes)
+        return self._c.fetchone()[0] or 0
+
+    def row_version(self, row):
+        "Version of the latest change of row, or None. Raises: TypeError if tracking is disabled"
+        self._check_tracking()
+        self.flush()
+        self._c.execute('SELECT MAX(version) FROM %s WHERE _id = ?' % self._changes, (row,))
+        return self._c.fetchone()[0]
+
+    def changes_since(self, version=0):
+        """ Streams the Change(version, row, op, columns) after version, in version order
+        op is 'insert', 'update' or 'delete' (columns None); read the cells
+        of inserted and updated rows from the table, an insert replaces the row.
+        Raises: TypeError if tracking is disabled
+        """
+        self._check_tracking()
+        self.flush()
+        c = self._c.connection.cursor()
+        try:
+            c.execute('SELECT version, _id, op, columns FROM %s WHERE version > ? ORDER BY version' %
+                      self._changes, (version,))
+            while True:
+                chunk = c.fetchmany(self.chunk_size)
+                if not chunk:
+                    return
+                for version, row, op, columns in chunk:
+                    yield Change(version, row, op, None if columns is None else tuple(json.loads(columns)))
+        finally:
+            c.close()
+
+    @_own_writes
+    def compact_changes(self, deletes_before=None):
+        """ Folds the changes of each row into its latest one, and drops deletes
+        older than deletes_before (once every consumer has synced past it)
+        Returns: number of changes removed
+        """
+        self._check_tracking()
+        self.flush()
+        self._c.execute('SELECT _id FROM %s GROUP BY _id HAVING COUNT(*) > 1' % self._changes)
+        rows = [r[0] for r in self._c.fetchall()]
+        removed = 0
+        for row in rows:
+            self._c.execute('SELECT version, op, columns FROM %s WHERE _id = ? ORDER BY version' %
+                            self._changes, (row,))
+            changes = self._c.fetchall()
+            version, op, columns = changes[-1]
+            if op != 'delete':
+                if any(change[1] != 'update' for change in changes):
+                    op = 'insert'
+                merged = set()
+                for change in changes:
+                    if change[2] is not None:
+                        merged.update(json.loads(change[2]))
+                columns = json.dumps(sorted(merged))
+            self._c.execute('DELETE FROM %s WHERE _id = ? AND version < ?' % self._changes, (row, version))
+            removed += self._c.rowcount
+            self._c.execute('UPDATE %s SET op = ?, columns = ? WHERE version = ?' % self._changes,
+                            (op, columns, version))
+        if deletes_before is not None:
+            self._c.execute('DELETE FROM %s WHERE op = ? AND version < ?' % self._changes,
+                            ('delete', deletes_before))
+            removed += self._c.rowcount
+        return removed
+
+    def _find_changelog(self):
+        self._c.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?',
+                        ('table', '%s__changes' % self._table))
+        return '%s__changes' % self._table if self._c.fetchone() else None
+
+    def _changelog(self):
+        """ The changelog table, None if changes are not tracked
+        Looked up again whenever the schema changed, e.g. once another table
+        on the database enabled tracking. Other connections' changes only show
+        in a new transaction, so the schema is checked once per transaction;
+        another table on this connection enabling tracking meanwhile is seen
+        in the next one.
+        """
+        if not self._schema_checked or not self._c.connection.in_transaction:
+            self._get_schema()
+            self._schema_checked = True
+        return self._changes
+
+    def _check_tracking(self):
+        if self._changelog() is None:
+            raise TypeError("Change tracking is not enabled on %s" % self._table)
+
+    def _log_change(self, row, op, columns):
+        self._c.execute('INSERT INTO %s (_id, op, columns) VALUES (?, ?, ?)' % self._changes,
+                        (row, op, None if columns is None else json.dumps(sorted(columns))))
+
+    def _log_all(self, columns, where=''):
+        "Logs an update of columns for every row (matching where)"
+        self._c.execute('INSERT INTO %s (_id, op, columns) SELECT _id, ?, ? FROM %s%s' %
+                        (self._changes, self._table, where), ('update', json.dumps(sorted(columns))))
+
+    def _log_bulk(self, pending, removed):
+        "Logs the coalesced rows of a bulk write, before it is applied"
+        rows = list(pending)
+        existing = set()
+        for n in range(0, len(rows), 500):
+            chunk = rows[n:n + 500]
+            self._c.execute('SELECT _id FROM %s WHERE _id IN (%s)' % (self._table, ', '.join('?' * len(chunk))),
+                            chunk)
+            existing.update(r[0] for r in self._c.fetchall())
+        log = []
+        for row, cells in pending.items():
+            if cells is None:
+                if row in existing:
+                    log.append((row, 'delete', None))
+            elif row in removed or row not in existing:
+                log.append((row, 'insert', json.dumps(sorted(cells))))
+            elif cells:
+                log.append((row, 'update', json.dumps(sorted(cells))))
+        self._c.executemany('INSERT INTO %s (_id, op, columns) VALUES (?, ?, ?)' % self._changes, log)
+
+    def _get_schema_version(self):
+        self._c.execute('PRAGMA schema_version')
+        return self._c.fetchone()[0]
+
+    def _get_schema(self):
+        """ Cached column name -> declared type, excluding _id
+        Reloaded when PRAGMA schema_version shows the schema was changed elsewhere
+        """
+        version = self._get_schema_version()
+        if self._schema is not None:
+            if version == self._schema_version:
+                self._schema_hits += 1
+                return self._schema
+            self._schema_invalidations += 1
+        self._schema_misses += 1
+        self._changes = self._find_changelog()
         self._c.execute('PRAGMA table_info(%s)' % self._table)
-        assert self._c.fetchone()[1] == "_id"
-        return map(lambda row: row[1], self._c.fetchall())
+        info = self._c.fetchall()
+        assert info[0][1] == "_id"
+        self._schema = OrderedDict((row[1], row[2]) for row in info[1:])
+        self._columns = tuple(self._schema)
+        self._schema_version = version
+        return self._schema
+
+    def _add_column(self, col, value):
+        """ ALTER TABLE ADD COLUMN typed after value, keeping the schema cache current
+        Raises: KeyError if value has no SQLite type and col does not exist
+        """
+        if col in self._get_schema():
+            return
+        declared = self._type_mapping[value.__class__]
+        self._c.execute('ALTER TABLE %s ADD COLUMN "%s" %s' % (self._table, col, declared))
+        version = self._get_schema_version()
+        if version == self._schema_version + 1:
+            self._schema[col] = declared
+            self._columns += (col,)
+            self._schema_version = version
+        else:
+            # Somebody else changed the schema in between
+            self._schema = None
+
+    def _get_column_names(self):
+        schema = self._get_schema()
+        if self._pending_columns:
+            return self._columns + tuple(col for col in self._pending_columns if col not in schema)
+        return self._columns
     
     def _get_row_names(self):
-        self._c.execute('SELECT _id FROM %s' % self._table)
-        r = list(map(lambda row: row[0], self._c.fetchall()))
-        return r
+        self.flush()
+        # Own cursor, so callers may keep using the table while iterating
+        c = self._c.connection.cursor()
+        try:
+            c.execute('SELECT _id FROM %s' % self._table)
+            for row in c:
+                yield row[0]
+        finally:
+            c.close()
+
+    def iter_rows(self, chunk_size=None):
+        """ Streams (row, cells dict) pairs in rowid order
+        Each chunk of chunk_size rows is read by one keyset-paginated SELECT,
+        so no statement stays open between chunks and memory stays bounded.
+        """
+        return self._decode_items(self._iter_rows(chunk_size))
+
+    def _iter_rows(self, chunk_size=None):
+        chunk_size = chunk_size or self.chunk_size
+        self.flush()
+        c = self._c.connection.cursor()
+        try:
+            last = None
+            while True:
+                if last is None:
+                    c.execute('SELECT rowid, * FROM %s ORDER BY rowid LIMIT ?' % self._table, (chunk_size,))
+                else:
+                    c.execute('SELECT rowid, * FROM %s WHERE rowid > ? ORDER BY rowid LIMIT ?' % self._table,
+                              (last, chunk_size))
+                names = [d[0] for d in c.description[2:]]
+                chunk = c.fetchall()
+                for r in chunk:
+                    yield r[1], dict(zip(names, r[2:]))
+                if len(chunk) < chunk_size:
+                    return
+                last = chunk[-1][0]
+        finally:
+            c.close()
+
+    def _iter_items(self):
+        return self._prefetched_items(self._iter_rows())
+
+    def _iter_cells(self):
+        return self._iter_rows()
+
+    def query(self, columns=None, where=None, order_by=None, limit=None):
+        """ Streams (row, cells dict) pairs matching where, see sqlite_shelf.query
+        Compiled to a single parameterized SELECT, read in chunks of chunk_size.
+        """
+        self.flush()
+        schema = self._get_schema()
+        if self._advisor is not None:
+            candidate = self._advisor.observe(query.conditions(where), schema)
+            if candidate is not None and self._advisor.auto_create and \
+                    any(columns == candidate for columns, _ in self.suggest_indexes()):
+                self.create_index(candidate)
+        sql, params, selected = query.compile_sql(self._table, schema,
+                                                  columns, where, order_by, limit)
+        return self._decode_items(self._stream(sql, params, selected))
+
+    def _stream(self, sql, params, selected):
+        c = self._c.connection.cursor()
+        try:
+            c.execute(sql, params)
+            while True:
+                chunk = c.fetchmany(self.chunk_size)
+                if not chunk:
+                    return
+                for r in chunk:
+                    yield r[0], dict(zip(selected, r[1:]))
+        finally:
+            c.close()
+
+    def __contains__(self, row):
+        if self._pending and row in self._pending:
+            return True
+        self._c.execute('SELECT 1 FROM %s WHERE _id = ? LIMIT 1' % self._table, (row,))
+        return self._c.fetchone() is not None
+
+    def __len__(self):
+        self.flush()
+        self._c.execute('SELECT COUNT(*) FROM %s' % self._table)
+        return self._c.fetchone()[0]
     
 
@@ -0,0 +1,21 @@
+""" contextlib.suppress that may be limited to matching exception messages
+
+    with suppress(sqlite3.Error, regex=r"already exists"):
+        ...
+"""
+from contextlib import contextmanager
+
+
+@contextmanager
+def suppress(*exceptions, regex=None):
+    """ Suppresses exceptions of the given classes
+    regex: suppress only those whose str() matches it (re.search), others are re-raised
+    """
+    try:
+        yield
+    except exceptions as e:
+        if regex is not None:
+            # Imported only once something is raised, to keep imports light
+            import re
+            if not re.search(regex, str(e)):
+                raise
@@ -0,0 +1,129 @@
+""" Bulk copies between CSV files and tables
+
+    import_csv('in.csv', sqlite_table, parser='thread')
+    export_csv(sqlite_table, 'out.csv')
+
+The CSV layout is CsvTable's: UTF-8 with a BOM, an _id column first, then
+the columns sorted, empty cells for None. Imports read chunks of records
+and write each chunk with one bulk_update(); parsing may run in a worker
+thread or process, overlapping the writes. Exports stream the rows of a
+query() straight into csv.writer.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from time import perf_counter
+import csv
+import io
+import itertools
+from sqlite_shelf.csvshelf import write_rows
+from sqlite_shelf.sqliteshelf import IngestStats
+
+
+def read_header(f):
+    "Column names after _id, from the first line of a binary file. Raises: ValueError"
+    header = next(csv.reader([f.readline().decode('utf-8-sig')]), None)
+    if not header or header[0] != '_id':
+        raise ValueError("CSV header must start with _id, got %r" % (header,))
+    return header[1:]
+
+
+def raw_chunks(f, size):
+    "Splits the records of a binary file into bytes of size records each, records may span lines"
+    lines = []
+    records = quotes = 0
+    for line in f:
+        lines.append(line)
+        quotes += line.count(b'"')
+        if not quotes % 2:
+            records += 1
+            if records == size:
+                yield b''.join(lines)
+                lines = []
+                records = 0
+    if lines:
+        yield b''.join(lines)
+
+
+def parse_chunk(columns, data):
+    "[(row, cells)] of a raw chunk, empty cells as None"
+    ret = []
+    for fields in csv.reader(io.StringIO(data.decode('utf-8'), newline='')):
+        if fields:
+            ret.append((fields[0], {col: value if value != '' else None
+                                    for col, value in zip(columns, fields[1:])}))
+    return ret
+
+
+def _bulk_writer(table):
+    return getattr(table, 'bulk_update', table.update)
+
+
+def import_csv(path, table, chunk_size=10000, parser=None, depth=2):
+    """ Upserts the rows of a CSV file into table, chunk_size rows per bulk_update()
+    parser: None parses inline, 'thread' or 'process' parse up to depth
+            chunks ahead in a worker while the previous chunk is written
+    Returns: IngestStats
+    Raises: ValueError for a CSV without an _id column first
+    """
+    start = perf_counter()
+    write = _bulk_writer(table)
+    count = 0
+    with open(path, 'rb') as f:
+        columns = read_header(f)
+        chunks = raw_chunks(f, chunk_size)
+        if parser is None:
+            for data in chunks:
+                rows = parse_chunk(columns, data)
+                write(rows)
+                count += len(rows)
+        else:
+            executors = {'thread':ThreadPoolExecutor, 'process':ProcessPoolExecutor}
+            if parser not in executors:
+                raise ValueError("parser must be None, 'thread' or 'process', got %r" % (parser,))
+            with executors[parser](1) as executor:
+                futures = deque(executor.submit(parse_chunk, columns, data)
+                                for data in itertools.islice(chunks, depth))
+                while futures:
+                    rows = futures.popleft().result()
+                    for data in itertools.islice(chunks, 1):
+                        futures.append(executor.submit(parse_chunk, columns, data))
+                    write(rows)
+                    count += len(rows)
+    seconds = perf_counter() - start
+    return IngestStats(count, seconds, count / seconds if seconds else float('inf'))
+
+
+def export_csv(table, path, columns=None, where=None, order_by=None):
+    """ Writes the rows of table.query(columns, where, order_by) as a CSV file
+    columns default to all of them, sorted.
+    Returns: number of rows written
+    """
+    if columns is None:
+        columns = sorted(table._get_column_names())
+    count = itertools.count()
+    with open(path, 'w', encoding='utf-8', newline="\n") as csvfile:
+        csvfile.write(u'\ufeff')
+        fieldnames = ['_id']
+        fieldnames.extend(columns)
+        csv.writer(csvfile).writerow(fieldnames)
+        rows = table.query(columns, where, order_by)
+        write_rows(csvfile, columns, (item for item, _ in zip(rows, count)))
+    return next(count)
+
+
+def copy_rows(source, target, chunk_size=10000, where=None):
+    """ Upserts the rows of source (matching where) into target, chunk_size rows per bulk_update()
+    Returns: IngestStats
+    """
+    start = perf_counter()
+    write = _bulk_writer(target)
+    rows = source.query(where=where)
+    count = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        write(chunk)
+        count += len(chunk)
+    seconds = perf_counter() - start
+    return IngestStats(count, seconds, count / seconds if seconds else float('inf'))
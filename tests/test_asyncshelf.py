@@ -0,0 +1,95 @@
+import unittest
+import asyncio
+import os
+import tempfile
+from sqlite_shelf.asyncshelf import AsyncSqliteTable
+from sqlite_shelf.serialization import Codec
+
+
+class AsyncSqliteTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tempfile = tempfile.mkstemp()
+        self.loop = asyncio.new_event_loop()
+        self.d = AsyncSqliteTable(self._tempfile[1])
+
+    def tearDown(self):
+        self.run_async(self.d.close())
+        self.loop.close()
+        os.close(self._tempfile[0])
+        os.remove(self._tempfile[1])
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_get_set(self):
+        async def test():
+            await self.d.set('1', {'a':1, 'b':'x'})
+            await self.d.update('1', {'b':'y'})
+            await self.d.update('2', {'c':2})
+            self.assertEqual(await self.d.get('1'), {'a':1, 'b':'y', 'c':None})
+            self.assertEqual(await self.d.get_many(['2', '3']), {'2':{'a':None, 'b':None, 'c':2}})
+            self.assertTrue(await self.d.contains('2'))
+            self.assertEqual(await self.d.len(), 2)
+            await self.d.delete('2')
+            self.assertEqual(await self.d.keys(), ['1'])
+            with self.assertRaises(KeyError):
+                await self.d.get('2')
+            with self.assertRaises(KeyError):
+                await self.d.delete('2')
+        self.run_async(test())
+
+    def test_pipelined_writes(self):
+        async def test():
+            await asyncio.gather(*[self.d.update(str(n), {'n':n}) for n in range(50)])
+            self.assertEqual(await self.d.len(), 50)
+        self.run_async(test())
+        # Committed, visible to other connections
+        other = AsyncSqliteTable(self._tempfile[1])
+        self.assertEqual(self.run_async(other.len()), 50)
+        self.run_async(other.close())
+
+    def test_batch_limits(self):
+        self.d.max_batch = 10
+        async def test():
+            await asyncio.gather(*[self.d.update(str(n), {'n':n}) for n in range(50)])
+        self.run_async(test())
+        self.assertGreaterEqual(self.d._commits, 5)
+
+    def test_failed_write(self):
+        def fail(table):
+            table['2'] = {'m':2}
+            table['1']['n'] = 10
+            1 / 0
+        async def test():
+            results = await asyncio.gather(self.d.update('1', {'n':1}), self.d.run(fail),
+                                           self.d.update('3', {'n':3}), return_exceptions=True)
+            self.assertIsInstance(results[1], ZeroDivisionError)
+            self.assertEqual(await self.d.keys(), ['1', '3'])
+            self.assertEqual(await self.d.get('1'), {'n':1})
+        self.run_async(test())
+
+    def test_iteration(self):
+        async def test():
+            stats = await self.d.bulk_update({str(n): {'n':n} for n in range(25)})
+            self.assertEqual(stats.rows, 25)
+            rows = []
+            async for row, cells in self.d.iter_rows(chunk_size=10):
+                rows.append((row, cells['n']))
+            self.assertEqual(rows, [(str(n), n) for n in range(25)])
+            rows = []
+            async for row, cells in self.d.query(['n'], where={'n':('>=', 20)}, order_by='-n', prefetch=2):
+                rows.append(cells['n'])
+            self.assertEqual(rows, [24, 23, 22, 21, 20])
+        self.run_async(test())
+
+    def test_run(self):
+        async def test():
+            await self.d.run(lambda table: table.set_codec(Codec()))
+            await self.d.update('1', {'a':[1, 2]})
+            self.assertEqual(await self.d.get('1'), {'a':[1, 2]})
+        self.run_async(test())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+from tests.test_mutabletable import DictTableTest
+from sqlite_shelf import columnartable
+from sqlite_shelf.columnartable import ColumnarTable
+
+
+class ColumnarTableTest(DictTableTest):
+
+    def setUp(self):
+        self.d = ColumnarTable(compact_threshold=2)
+
+    def test_typed_columns(self):
+        self.d.update({'5':{'i':5, 'f':0.5, 's':'55', 'n':None},
+                       '6':{'i':6, 'f':None, 's':6}})
+        self.assertEqual(self.d._columns['i'].values.typecode, 'q')
+        self.assertEqual(self.d._columns['f'].values.typecode, 'd')
+        self.assertIsInstance(self.d._columns['s'].values, list)
+        self.assertEqual(self.d, {'5':{'i':5, 'f':0.5, 's':'55', 'n':None},
+                                  '6':{'i':6, 'f':None, 's':6, 'n':None}})
+
+        self.d['6']['i'] = 2**70
+        self.assertIsInstance(self.d._columns['i'].values, list)
+        self.assertEqual(self.d['6']['i'], 2**70)
+        self.assertEqual(self.d['5']['i'], 5)
+
+    def test_compact(self):
+        self.d.update({str(n):{'i':n} for n in range(5)})
+        del self.d['1']
+        del self.d['3']
+        self.assertEqual(len(self.d._ids), 5)
+        del self.d['0']
+        self.assertEqual(len(self.d._ids), 2)
+        self.assertEqual(self.d, {'2':{'i':2}, '4':{'i':4}})
+        self.d['5'] = {'i':5}
+        self.assertEqual(self.d['5']['i'], 5)
+
+    def test_aggregates(self):
+        self.d.update({str(n):{'i':n, 'f':n / 2} for n in range(6)})
+        self.d['6'] = {'i':None, 'f':None}
+        del self.d['0']
+        self.assertEqual(self.d.column_sum('i'), 15)
+        self.assertEqual(self.d.column_min('i'), 1)
+        self.assertEqual(self.d.column_max('f'), 2.5)
+
+        mask = self.d.column_mask('i', '>=', 3)
+        self.assertEqual(sorted(self.d.mask_rows(mask)), ['3', '4', '5'])
+        self.assertEqual(self.d.column_sum('f', mask=mask), 6.0)
+        mask = self.d.mask_and(mask, self.d.column_mask('f', '<', 2.5))
+        self.assertEqual(sorted(self.d.mask_rows(mask)), ['3', '4'])
+        with self.assertRaises(KeyError):
+            self.d.column_sum('x')
+
+    def test_masks_and_compaction(self):
+        self.d.update({str(n):{'i':n} for n in range(6)})
+        mask = self.d.column_mask('i', '>=', 2)
+        with self.d.keep_positions():
+            for row in list(self.d.mask_rows(mask)):
+                del self.d[row]
+            self.assertEqual(len(self.d._ids), 6)
+            self.assertEqual(self.d.column_sum('i', mask=mask), 0)
+        self.assertEqual(len(self.d._ids), 2)
+        self.assertEqual(self.d, {'0':{'i':0}, '1':{'i':1}})
+        with self.assertRaises(ValueError):
+            list(self.d.mask_rows(mask))
+        with self.assertRaises(ValueError):
+            self.d.column_sum('i', mask=mask)
+
+    def test_numpy(self):
+        numpy = columnartable.numpy
+        if numpy is None:
+            self.skipTest("numpy is not installed")
+        self.d.update({str(n):{'i':n, 'f':n / 2, 's':str(n)} for n in range(6)})
+        self.d['6'] = {'i':None}
+        del self.d['0']
+        self.assertIsInstance(self.d._valid_values('i', None), numpy.ndarray)
+        self.assertIsInstance(self.d._valid_values('s', None), list)
+        mask = self.d.column_mask('i', '>', 2)
+        self.assertEqual(mask, bytearray([0, 0, 0, 1, 1, 1, 0]))
+        self.assertEqual(sorted(self.d.mask_rows(mask)), ['3', '4', '5'])
+        self.assertEqual(self.d.column_sum('f', mask=mask), 6.0)
+        self.assertIsInstance(self.d.column_sum('i'), int)
+        self.assertEqual(self.d.column_min('i'), 1)
+        self.assertEqual(self.d.column_max('f', mask=mask), 2.5)
+        with self.assertRaises(ValueError):
+            self.d.column_min('i', mask=bytearray(7))
+
+
+class PurePythonColumnarTableTest(ColumnarTableTest):
+
+    def setUp(self):
+        self._numpy, columnartable.numpy = columnartable.numpy, None
+        ColumnarTableTest.setUp(self)
+
+    def tearDown(self):
+        columnartable.numpy = self._numpy
+
+
+if __name__ == '__main__':
+    unittest.main()
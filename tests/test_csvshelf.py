@@ -1,8 +1,7 @@
 import unittest
-from es_commons.suppress2 import suppress
 import os
 from tests.test_mutabletable import DictTableTest
-from sqlite_shelf.csvshelf import CsvTable
+from sqlite_shelf.csvshelf import CsvTable, LazyCsvTable
 import tempfile
 
 class SqliteTableTest(DictTableTest):
@@ -18,6 +17,50 @@ class SqliteTableTest(DictTableTest):
         pass
 
 
+class LazyCsvTableTest(DictTableTest):
+
+    def setUp(self):
+        self._tempfile = tempfile.mkstemp()
+        self.d = LazyCsvTable(self._tempfile[1])
+
+    def tearDown(self):
+        self.d.close()
+        os.close(self._tempfile[0])
+        os.remove(self._tempfile[1])
+
+    def _reopen(self):
+        self.d.close()
+        self.d = LazyCsvTable(self._tempfile[1])
+
+    def _content(self):
+        with open(self._tempfile[1], encoding='utf-8-sig', newline='') as f:
+            return f.read()
+
+    def test_reopen(self):
+        self.d.update({'5':{'5':'55', '6':'a\n"b"'}, '6':{'6':'66'}})
+        self._reopen()
+        self.assertEqual(self._content(), '_id,5,6\r\n5,55,"a\n""b"""\r\n6,,66\r\n')
+        self.assertEqual(len(self.d), 2)
+        self.assertEqual(self.d['5']['6'], 'a\n"b"')
+        self.assertEqual(self.d, {'5':{'5':'55', '6':'a\n"b"'}, '6':{'5':None, '6':'66'}})
+
+        self.d['7'] = {'5':'75'}
+        self.assertFalse(self.d._dirty)
+        self._reopen()
+        self.assertEqual(self._content(), '_id,5,6\r\n5,55,"a\n""b"""\r\n6,,66\r\n7,75,\r\n')
+
+        self.d['5']['7'] = '57'
+        del self.d['6']
+        self.assertEqual(list(self.d), ['5', '7'])
+        self._reopen()
+        self.assertEqual(self._content(), '_id,5,6,7\r\n5,55,"a\n""b""",57\r\n7,75,,\r\n')
+
+    def test_read_during_scan(self):
+        self.d.update({'5':{'5':'55'}, '6':{'5':'65'}})
+        self._reopen()
+        self.assertEqual([(row_key, row['5'], self.d['5']['5']) for row_key, row in self.d.items()],
+                         [('5', '55', '55'), ('6', '65', '55')])
+
 
 if __name__ == '__main__':
     #unittest.TextTestRunner(verbosity=2).run(SqliteTableTest("test_get_set_del_item"))
@@ -1,7 +1,8 @@
 import unittest
 import pickle
 import cProfile
-from sqlite_shelf.mutabletable import DictTable
+from sqlite_shelf.mutabletable import DictTable, MutableTable
+from sqlite_shelf.serialization import Codec
 
 class DictTableTest(unittest.TestCase):
     
@@ -84,6 +85,19 @@ class DictTableTest(unittest.TestCase):
             
         
         
+    def test_write_during_items(self):
+        self.d.update({str(n):{'a':str(n)} for n in range(5)})
+        seen = dict()
+        for row, view in self.d.items():
+            if not seen:
+                for other in self.d.keys():
+                    self.d[other]['a'] = 'x' + other
+                self.d[row]['b'] = 'b'
+            seen[row] = (view['a'], view.get('b'), sorted(view))
+        self.assertEqual(seen, {str(n): ('x' + str(n), 'b' if seen[str(n)][1] else None, ['a', 'b'])
+                                for n in range(5)})
+        self.assertEqual(sum(1 for value in seen.values() if value[1] == 'b'), 1)
+
     def test_iter(self):
         self.d.update({'5':{'5':'55', '6':'56'}, '6':{'6':'66'}})
 
@@ -271,10 +285,190 @@ class DictTableTest(unittest.TestCase):
 ##    def test_profile(self):
 ##        cProfile.runctx('self.test_update()', locals=locals(), globals=globals())
 ##        
+    def test_query(self):
+        self.d.update({'1':{'status':'failed', 'n':1}, '2':{'status':'ok', 'n':2},
+                       '3':{'status':'failed', 'n':3}, '4':{'n':4}})
+        self.assertEqual(sorted(self.d.query(where={'status':'failed'})),
+                         [('1', {'status':'failed', 'n':1}), ('3', {'status':'failed', 'n':3})])
+        self.assertEqual(list(self.d.query(['n'], {'n':('>=', 2)}, order_by='-n', limit=2)),
+                         [('4', {'n':4}), ('3', {'n':3})])
+        self.assertEqual(list(self.d.query(['n', 'x'], {'status':None})), [('4', {'n':4, 'x':None})])
+        self.assertEqual(list(self.d.query(['_id', 'n'], {'n':2})), [('2', {'_id':'2', 'n':2})])
+        self.assertEqual([row for row, cells in self.d.query(where={'status':('is not', None), 'n':('between', (2, 3))}, order_by='_id')],
+                         ['2', '3'])
+        self.assertEqual([row for row, cells in self.d.query(where={'status':('not in', ['ok']), 'x':None}, order_by=['status', '-_id'])],
+                         ['3', '1'])
+        self.assertEqual(list(self.d.query(where={'n':('in', [1, 4]), 'status':('!=', 'ok')})), [('1', {'status':'failed', 'n':1})])
+        self.assertEqual(list(self.d.query(where={'x':1})), [])
+        with self.assertRaises(ValueError):
+            list(self.d.query(where={'n':('like', 1)}))
+
+    def test_codec(self):
+        self.d.set_codec(Codec(compress_threshold=16))
+        blob = {'list':[1, 2], 'text':'x' * 100}
+        self.d.update({'5':{'5':'55', '6':blob}})
+        self.d['6'] = {'5':b'raw', '6':(1, 2)}
+        self.d['6']['7'] = True
+        self.assertEqual(self.d['5']['6'], blob)
+        self.assertIs(self.d['6']['7'], True)
+        self.assertEqual(self.d['6'], {'5':b'raw', '6':(1, 2), '7':True})
+        self.assertEqual(dict(self.d.query(['6'], {'5':'55'})), {'5':{'6':blob}})
+        self.assertEqual(self.d.pop('6'), {'5':b'raw', '6':(1, 2), '7':True})
+
+    def test_columns(self):
+        self.d.update({'5':{'5':'55', '6':'56'}, '6':{'5':'65'}})
+        column = self.d.column('5')
+        self.assertEqual(dict(column.items()), {'5':'55', '6':'65'})
+        self.assertEqual(sorted(column.values()), ['55', '65'])
+        self.assertEqual((column['6'], len(column), '7' in column), ('65', 2, False))
+        with self.assertRaises(KeyError):
+            self.d.column('7')
+
+        self.d.set_column('7', {'5':'57', '7':'77'})
+        self.assertEqual(self.d['7'], {'5':None, '6':None, '7':'77'})
+        self.d.fill_column('6', '0')
+        self.assertEqual(dict(self.d.column('6').items()), {'5':'56', '6':'0', '7':'0'})
+        self.d.fill_column('8', '8', overwrite=True)
+        self.assertEqual(list(self.d.column('8').values()), ['8', '8', '8'])
+
+        self.assertEqual(self.d['5']['5'], '55')
+        self.d.rename_column('5', 'five')
+        with self.assertRaises(ValueError):
+            self.d.rename_column('6', '7')
+        with self.assertRaises(KeyError):
+            self.d.rename_column('5', '9')
+        self.d.drop_column('6')
+        with self.assertRaises(KeyError):
+            self.d.drop_column('6')
+        self.assertEqual(self.d['5'], {'five':'55', '7':'57', '8':'8'})
+        self.assertEqual(self.d['7'], {'five':None, '7':'77', '8':'8'})
+
+    def test_transaction(self):
+        self.d.update({'5':{'5':'55'}, '6':{'5':'65'}})
+        with self.d.transaction():
+            self.d['7'] = {'5':'75'}
+            self.d['5']['5'] = '550'
+        self.assertEqual(self.d['5']['5'], '550')
+
+        with self.assertRaises(ZeroDivisionError):
+            with self.d.transaction():
+                self.d['5']['5'] = '5500'
+                del self.d['6']
+                self.d['8'] = {'5':'85'}
+                with self.d.savepoint():
+                    self.d['9'] = {'5':'95'}
+                1 / 0
+        self.assertEqual(sorted(self.d), ['5', '6', '7'])
+        self.assertEqual(self.d['5']['5'], '550')
+        self.assertEqual(self.d['6']['5'], '65')
+
+        with self.d.transaction():
+            self.d['8'] = {'5':'85'}
+            with self.assertRaises(ZeroDivisionError):
+                with self.d.savepoint():
+                    self.d['8']['5'] = '850'
+                    self.d['9'] = {'5':'95'}
+                    1 / 0
+            self.assertEqual(self.d['8']['5'], '85')
+            self.assertNotIn('9', self.d)
+        self.assertEqual(sorted(self.d), ['5', '6', '7', '8'])
+
+    def test_transaction_columns(self):
+        self.d.update({'5':{'5':'55', '6':'56'}})
+        with self.assertRaises(ZeroDivisionError):
+            with self.d.transaction():
+                self.d['5']['7'] = '57'
+                self.d.drop_column('6')
+                1 / 0
+        # Without native transactions the added column stays, empty
+        self.assertEqual({col: value for col, value in self.d['5'].items() if value is not None},
+                         {'5':'55', '6':'56'})
+
     def test_type(self):
         self.d.update({'5':{'5':55}})
         self.assertIsInstance(self.d['5']['5'], int)
         
 
+class GenericColumnsTest(unittest.TestCase):
+
+    class Table(DictTable):
+        rename_column = MutableTable.rename_column
+        drop_column = MutableTable.drop_column
+
+    def test_generic_columns(self):
+        d = self.Table()
+        d.update({'5':{'5':'55', '6':'56'}, '6':{'5':'65'}})
+        d.rename_column('5', 'five')
+        with self.assertRaises(ValueError):
+            d.rename_column('6', 'five')
+        d.drop_column('6')
+        with self.assertRaises(KeyError):
+            d.drop_column('7')
+        self.assertEqual(d, {'5':{'5':None, '6':None, 'five':'55'}, '6':{'5':None, '6':None, 'five':'65'}})
+
+
+class CachedDictTableTest(DictTableTest):
+
+    def setUp(self):
+        self.d = DictTable()
+        self.d.enable_row_cache(maxrows=2)
+
+    def test_row_cache(self):
+        self.d.update({'5':{'5':'55'}, '6':{'5':'65'}, '7':{'5':'75'}})
+        self.assertEqual(self.d['5']['5'], '55')
+        self.assertEqual(self.d['5']['5'], '55')
+        info = self.d.row_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currrows), (1, 1, 1))
+
+        self.d['5']['5'] = '550'
+        self.assertEqual(self.d.row_cache_info().currrows, 0)
+        self.assertEqual(self.d['5']['5'], '550')
+        self.d['6']['5'], self.d['7']['5']
+        self.assertEqual(self.d.row_cache_info().evictions, 1)
+        del self.d['7']
+        self.assertEqual(self.d.row_cache_info().currrows, 1)
+
+        self.d['6']['6'] = '66'
+        self.assertEqual(self.d.row_cache_info().currrows, 0)
+        self.assertEqual(self.d['6'], {'5':'65', '6':'66'})
+
+    def test_row_cache_not_shared(self):
+        self.d.update({'5':{'5':'55'}, '6':{'5':'65'}, '7':{'5':'75'}})
+        self.assertEqual(self.d['5']['5'], '55')
+        info = self.d.row_cache_info()
+        for row, cells in self.d.query():
+            cells['5'] = None
+        self.assertEqual(self.d.row_cache_info(), info)
+        self.assertEqual(self.d['5']['5'], '55')
+        self.d.pop('5')['5'] = None
+        self.d['5'] = {'5':'55'}
+        self.assertEqual(self.d['5']['5'], '55')
+
+
+class InstrumentedDictTableTest(DictTableTest):
+
+    def setUp(self):
+        self.records = []
+        self.d = DictTable()
+        self.d.enable_metrics(lambda name, seconds: self.records.append(name))
+
+    def test_metrics(self):
+        self.d.update({'5':{'5':'55'}, '6':{'5':'65'}})
+        self.assertEqual(self.d['5']['5'], '55')
+        self.assertEqual(list(self.d), ['5', '6'])
+        info = self.d.metrics_info()
+        self.assertEqual(info['_update_cells'].count, 2)
+        self.assertEqual(info['_get_cells'].count, 1)
+        self.assertGreaterEqual(info['_get_row_names'].count, 1)
+        self.assertLessEqual(info['_get_cells'].p50, info['_get_cells'].max)
+        self.assertEqual(self.records.count('_update_cells'), 2)
+
+        self.d.disable_metrics()
+        self.assertIs(type(self.d), DictTable)
+        self.assertIsNone(self.d.metrics_info())
+        self.d['5']['5'] = '550'
+        self.assertEqual(self.records.count('_update_cells'), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
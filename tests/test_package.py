@@ -0,0 +1,61 @@
+import unittest
+import json
+import os
+import subprocess
+import sys
+import sqlite_shelf
+from sqlite_shelf.suppress import suppress
+
+
+def import_in_subprocess(statement):
+    "(seconds, loaded modules) of running statement in a fresh interpreter"
+    code = ('import sys, json, time\n'
+            'start = time.perf_counter()\n'
+            '%s\n'
+            'print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))' % statement)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(sqlite_shelf.__file__)))
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    seconds, modules = json.loads(out.decode('utf-8'))
+    return seconds, set(modules)
+
+
+class PackageTest(unittest.TestCase):
+
+    def test_lazy_import(self):
+        seconds, modules = import_in_subprocess('import sqlite_shelf')
+        self.assertNotIn('sqlite3', modules)
+        self.assertNotIn('sqlite_shelf.mutabletable', modules)
+        self.assertNotIn('es_commons', modules)
+        _, modules = import_in_subprocess('import sqlite_shelf.csvshelf')
+        self.assertNotIn('sqlite3', modules)
+        self.assertNotIn('sqlite_shelf.sqliteshelf', modules)
+        _, modules = import_in_subprocess('from sqlite_shelf import SqliteTable')
+        self.assertIn('sqlite_shelf.sqliteshelf', modules)
+
+    def test_import_time(self):
+        # Best of a few runs, against the import of every backend
+        lazy = min(import_in_subprocess('import sqlite_shelf')[0] for _ in range(3))
+        eager = min(import_in_subprocess('import sqlite_shelf.sqliteshelf, sqlite_shelf.csvshelf')[0]
+                    for _ in range(3))
+        self.assertLess(lazy, eager)
+
+    def test_exports(self):
+        from sqlite_shelf.sqliteshelf import SqliteTable
+        self.assertIs(sqlite_shelf.SqliteTable, SqliteTable)
+        self.assertIn('CsvTable', dir(sqlite_shelf))
+        with self.assertRaises(AttributeError):
+            sqlite_shelf.NoSuchTable
+        for name in sqlite_shelf.__all__:
+            self.assertTrue(hasattr(sqlite_shelf, name), name)
+
+    def test_suppress(self):
+        with suppress(KeyError):
+            raise KeyError('x')
+        with suppress(ValueError, regex=r'already exists'):
+            raise ValueError('table t already exists')
+        with self.assertRaises(ValueError):
+            with suppress(ValueError, regex=r'already exists'):
+                raise ValueError('no such table')
+        with self.assertRaises(TypeError):
+            with suppress(ValueError):
+                raise TypeError
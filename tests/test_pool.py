@@ -0,0 +1,130 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+import threading
+from tests.test_mutabletable import DictTableTest
+from sqlite_shelf.pool import SqliteTablePool
+
+
+class PooledSqliteTableTest(DictTableTest):
+
+    def setUp(self):
+        self._tempfile = tempfile.mkstemp()
+        self._pool = SqliteTablePool(self._tempfile[1], size=2, timeout=1)
+        self._handle = self._pool.table()
+        self.d = self._handle.__enter__()
+
+    def tearDown(self):
+        self._handle.__exit__(None, None, None)
+        self._pool.close()
+        os.close(self._tempfile[0])
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self._tempfile[1] + suffix):
+                os.remove(self._tempfile[1] + suffix)
+
+    def test_concurrent_handles(self):
+        errors = []
+
+        def work(n):
+            try:
+                with self._pool.table() as table:
+                    for m in range(20):
+                        table['%d-%d' % (n, m)] = {'n':n}
+                        self.assertEqual(table['%d-%d' % (n, m)]['n'], n)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.d), 80)
+
+        stats = self._pool.stats()
+        self.assertEqual(stats.connections, 2)
+        self.assertEqual(stats.in_use, 1)
+        self.assertEqual(stats.writes, 80)
+        self.assertLessEqual(stats.commits, 80)
+
+    def test_timeout(self):
+        with self._pool.table():
+            with self.assertRaises(TimeoutError):
+                with self._pool.table():
+                    pass
+        self.assertEqual(self._pool.stats().waits, 1)
+
+    def test_failed_write(self):
+        self.d['5'] = {'5':'55'}
+
+        def job(table):
+            table['6'] = {'6':'66'}
+            table['5']['5'] = '550'
+            1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            self._pool._write(job)
+        self.assertEqual(self.d, {'5':{'5':'55'}})
+        self.d['7'] = {'7':'77'}
+        self.assertEqual(self.d, {'5':{'5':'55', '7':None}, '7':{'5':None, '7':'77'}})
+
+    def test_transaction_holds_writer(self):
+        def write():
+            with self._pool.table() as other:
+                other['6'] = {'5':'65'}
+
+        with self.d.transaction():
+            self.d['5'] = {'5':'55'}
+            thread = threading.Thread(target=write)
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(self.d, {'5':{'5':'55'}})
+        thread.join()
+        self.assertEqual(self.d, {'5':{'5':'55'}, '6':{'5':'65'}})
+
+    def test_column_writes_on_writer(self):
+        self.d.update({'5':{'5':'55', '6':None}})
+        writes = self._pool.stats().writes
+        self.d.fill_column('6', '56')
+        self.d.rename_column('6', 'six')
+        self.d.enable_change_tracking()
+        self.d['6'] = {'5':'65'}
+        del self.d['6']
+        self.d.drop_column('six')
+        self.assertEqual(self.d.compact_changes(deletes_before=10), 2)
+        self.d.disable_change_tracking()
+        self.assertEqual(self._pool.stats().writes - writes, 8)
+        with self.assertRaises(KeyError):
+            self.d.drop_column('six')
+        with self._pool.table() as other:
+            self.assertEqual(other, {'5':{'5':'55'}})
+
+    def test_change_tracking(self):
+        with self._pool.table() as other:
+            other['0'] = {'5':'05'}
+            self.d.enable_change_tracking()
+            other['5'] = {'5':'55'}
+            del other['5']
+            self.assertEqual([change[1:3] for change in self.d.changes_since(0)],
+                             [('5', 'insert'), ('5', 'delete')])
+
+    def test_stopped_writer(self):
+        self._pool._queue.put(None)
+        self._pool._writer.join()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            self.d['5'] = {'5':'55'}
+
+    def test_bulk_update_and_index(self):
+        self.d.bulk_update({'5':{'5':'55'}, '6':{'5':'65'}})
+        self.d.create_index('5')
+        with self._pool.table() as other:
+            self.assertEqual(other, {'5':{'5':'55'}, '6':{'5':'65'}})
+            self.assertEqual([index.columns for index in other.list_indexes()], [('5',)])
+        with self.assertRaises(KeyError):
+            del self.d['7']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import datetime
+from sqlite_shelf import serialization
+from sqlite_shelf.serialization import Codec, MAGIC
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_native(self):
+        codec = Codec()
+        for value in ['x', 1, 1.5, None, b'raw']:
+            self.assertIs(codec.encode(value), value)
+        self.assertEqual(codec.decode(b'raw'), b'raw')
+
+    def test_round_trip(self):
+        codec = Codec(compress_threshold=64, column_formats={'j':'json'})
+        values = [{'a':[1, 2]}, datetime.date(2020, 1, 2), MAGIC + b'looks encoded', ['x'] * 1000, True]
+        for value in values:
+            encoded = codec.encode(value)
+            self.assertIsInstance(encoded, bytes)
+            self.assertEqual(codec.decode(encoded), value)
+        self.assertEqual(codec.encode({'a':1}, 'j'), MAGIC + b'\x02\x00{"a":1}')
+
+    def test_compression(self):
+        codec = Codec(compress_threshold=64)
+        small, large = codec.encode(['x']), codec.encode(['x'] * 1000)
+        self.assertEqual(small[len(MAGIC) + 1], 0)
+        self.assertEqual(large[len(MAGIC) + 1], 1)
+        self.assertLess(len(large), 200)
+        self.assertEqual(Codec(compression=None).encode(['x'] * 1000)[len(MAGIC) + 1], 0)
+
+    def test_register(self):
+        with self.assertRaises(KeyError):
+            Codec(format='yaml')
+        serialization.register_format('csv', 200, lambda value: ','.join(value).encode(),
+                                      lambda data: data.decode().split(','))
+        self.addCleanup(serialization.unregister_format, 'csv')
+        self.assertEqual(Codec(format='csv').encode(['a', 'b']), MAGIC + b'\xc8\x00a,b')
+        self.assertEqual(serialization.decode(MAGIC + b'\xc8\x00a,b', ['csv']), ['a', 'b'])
+        with self.assertRaises(ValueError):
+            serialization.decode(MAGIC + b'\xc9\x00', ['csv'])
+
+    def test_decode_formats(self):
+        pickled = Codec().encode([1])
+        with self.assertRaises(ValueError):
+            Codec(format='json').decode(pickled)
+        with self.assertRaises(ValueError):
+            Codec(format='json').decode_cells({'a':pickled})
+        with self.assertRaises(ValueError):
+            serialization.decode(pickled, ['json'])
+        self.assertEqual(Codec(format='json', decode_formats=['pickle']).decode(pickled), [1])
+        self.assertEqual(Codec(format='json', column_formats={'a':'pickle'}).decode_cells({'a':pickled}),
+                         {'a':[1]})
+        with self.assertRaises(KeyError):
+            Codec(decode_formats=['yaml'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+from tests.test_mutabletable import DictTableTest
+from sqlite_shelf.shardedshelf import ShardedTable, reshard, main
+
+
+class ShardedTableTest(DictTableTest):
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._path = os.path.join(self._tempdir, 'shelf')
+        self.d = ShardedTable(self._path, shards=3)
+
+    def tearDown(self):
+        self.d.close()
+        shutil.rmtree(self._tempdir)
+
+    def test_shards(self):
+        self.d.update({str(n): {'n':n} for n in range(30)})
+        self.assertEqual(len(self.d), 30)
+        self.assertEqual(sum(len(shard) for shard in self.d._shards), 30)
+        self.assertTrue(all(len(shard) for shard in self.d._shards))
+        self.assertEqual(self.d['7']['n'], 7)
+        self.d.close()
+        with self.assertRaises(ValueError):
+            ShardedTable(self._path, shards=4)
+        self.d = ShardedTable(self._path)
+        self.assertEqual(self.d.shard_count, 3)
+        self.assertEqual(len(self.d), 30)
+
+    def test_parallel_bulk_update(self):
+        self.d['0'] = {'n':-1}
+        self.d.parallel_threshold = 10
+        stats = self.d.bulk_update([(str(n), {'n':n, 'm':str(n)}) for n in range(40)] + [('3', None)])
+        self.assertEqual(stats.rows, 41)
+        self.assertIs(self.d.last_ingest_stats, stats)
+        self.assertEqual(len(self.d), 39)
+        self.assertEqual(self.d['0'], {'n':0, 'm':'0'})
+        self.assertNotIn('3', self.d)
+
+    def test_merged_query(self):
+        self.d.update({str(n): {'n':n % 7, 'm':n} for n in range(30)})
+        self.assertEqual([cells['m'] for _, cells in self.d.query(['m'], order_by=['n', '-m'], limit=6)],
+                         [28, 21, 14, 7, 0, 29])
+        self.assertEqual(sorted(row for row, _ in self.d.query([], where={'n':3})),
+                         ['10', '17', '24', '3'])
+
+    def test_reshard(self):
+        self.d.update({str(n): {'n':n} for n in range(30)})
+        self.d.close()
+        target = os.path.join(self._tempdir, 'resharded')
+        self.assertEqual(main(['reshard', self._path, target, '5', '--chunk-size', '7']), 0)
+        with self.assertRaises(ValueError):
+            reshard(self._path, target, 2)
+        self.d = ShardedTable(target)
+        self.assertEqual(self.d.shard_count, 5)
+        self.assertEqual(dict(self.d.iter_rows()), {str(n): {'n':n} for n in range(30)})
+
+    def test_reshard_one_pool(self):
+        self.d.update({str(n): {'n':n} for n in range(30)})
+        self.d.close()
+        target = os.path.join(self._tempdir, 'resharded')
+        with mock.patch('sqlite_shelf.shardedshelf.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as pool:
+            self.assertEqual(reshard(self._path, target, 2, chunk_size=7, processes=2), 30)
+        self.assertEqual(pool.call_count, 1)
+        self.d = ShardedTable(target)
+        self.assertEqual(dict(self.d.iter_rows()), {str(n): {'n':n} for n in range(30)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import os
+import shutil
+import tempfile
+from sqlite_shelf.mutabletable import DictTable
+from sqlite_shelf.serialization import Codec
+from sqlite_shelf.snapshot import SnapshotTable, write_snapshot
+
+
+class SnapshotTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self._tempdir, 'table.snap')
+        self.source = DictTable()
+        self.source['c'] = {'empty':None}
+        del self.source['c']
+        self.source.update({'b': {'int':-3, 'float':1.5, 'text':u'caf\xe9', 'blob':b'\x00\x01'},
+                            'a': {'int':2 ** 70, 'bool':True},
+                            u'\xe9': {'text':''}})
+        self.assertEqual(write_snapshot(self.source, self.path), 3)
+        self.d = SnapshotTable(self.path)
+
+    def tearDown(self):
+        self.d.close()
+        shutil.rmtree(self._tempdir)
+
+    def test_read(self):
+        self.assertEqual(self.d, self.source)
+        self.assertEqual(len(self.d), 3)
+        self.assertEqual(list(self.d), ['a', 'b', u'\xe9'])
+        self.assertIn('b', self.d)
+        self.assertNotIn('c', self.d)
+        self.assertNotIn(1, self.d)
+        self.assertEqual(self.d['a']['int'], 2 ** 70)
+        self.assertIs(self.d['a']['bool'], True)
+        self.assertIsNone(self.d['a']['text'])
+        self.assertEqual(self.d['b']['blob'], b'\x00\x01')
+        with self.assertRaises(KeyError):
+            self.d['c']
+        self.assertEqual(set(self.d._get_column_names()), {'int', 'float', 'text', 'blob', 'bool', 'empty'})
+        self.assertEqual(list(self.d.query(['int'], where={'int': ('<', 0)})), [('b', {'int':-3})])
+        self.assertEqual(dict(self.d.column('text')), {'a':None, 'b':u'caf\xe9', u'\xe9':''})
+
+    def test_read_only(self):
+        with self.assertRaises(TypeError):
+            self.d['c'] = {'int':1}
+        with self.assertRaises(TypeError):
+            self.d['a']['int'] = 1
+        with self.assertRaises(TypeError):
+            del self.d['a']
+        with self.assertRaises(TypeError):
+            self.d.rename_column('int', 'n')
+        with self.assertRaises(TypeError):
+            self.d.drop_column('int')
+        with self.assertRaises(TypeError):
+            self.d.fill_column('int', 0)
+        self.assertEqual(len(self.d), 3)
+
+    def test_write(self):
+        write_snapshot(DictTable(), self.path)
+        empty = SnapshotTable(self.path)
+        self.assertEqual(len(empty), 0)
+        self.assertNotIn('a', empty)
+        empty.close()
+        source = DictTable()
+        source[1] = {'a':1}
+        with self.assertRaises(TypeError):
+            write_snapshot(source, self.path)
+        source = DictTable()
+        source['a'] = {'a':[1]}
+        with self.assertRaises(TypeError):
+            write_snapshot(source, self.path)
+        with open(self.path, 'wb') as f:
+            f.write(b'not a snapshot')
+        with self.assertRaises(ValueError):
+            SnapshotTable(self.path)
+
+    def test_codec(self):
+        source = DictTable()
+        source.set_codec(Codec())
+        source['a'] = {'list':[1, 2]}
+        write_snapshot(source, self.path)
+        d = SnapshotTable(self.path)
+        d.set_codec(Codec())
+        self.assertEqual(d['a']['list'], [1, 2])
+        self.assertEqual(list(d.query()), [('a', {'list':[1, 2]})])
+        d.close()
@@ -0,0 +1,110 @@
+import unittest
+import sqlite3
+import os
+import tempfile
+from tests.test_mutabletable import DictTableTest
+from sqlite_shelf.sqliteshelf import SqliteTable
+from sqlite_shelf.sparseshelf import SparseSqliteTable, layout_of, migrate_to_sparse, migrate_to_wide, open_table
+
+
+class SparseSqliteTableTest(DictTableTest):
+
+    def setUp(self):
+        self._tempfile = tempfile.mkstemp()
+        self._conn = sqlite3.connect(self._tempfile[1])
+        self.d = SparseSqliteTable(self._conn)
+
+    def tearDown(self):
+        self.d.close()
+        self._conn.commit()
+        self._conn.close()
+        os.close(self._tempfile[0])
+        os.remove(self._tempfile[1])
+
+    def test_bulk_update(self):
+        self.d['5'] = {'5':'55', '6':'56'}
+        stats = self.d.bulk_update([('5', {'7':7}), ('6', {'6':'66'}),
+                                    ('7', {'5':'75'}), ('7', None),
+                                    ('8', None), ('8', {'8':8.5}), ('9', {})])
+        self.assertEqual(stats.rows, 7)
+        self.assertIs(self.d.last_ingest_stats, stats)
+        self.assertEqual(self.d, {'5':{'5':'55', '6':'56', '7':7, '8':None},
+                                  '6':{'5':None, '6':'66', '7':None, '8':None},
+                                  '8':{'5':None, '6':None, '7':None, '8':8.5},
+                                  '9':{'5':None, '6':None, '7':None, '8':None}})
+        with self.assertRaises(sqlite3.Error):
+            self.d.bulk_update({'6':{'6':'660'}, '7':{'9':object()}})
+        self.assertEqual(self.d['6']['6'], '66')
+        self.assertEqual(list(self.d._get_column_names()), ['5', '6', '7', '8'])
+
+    def test_transaction_after_bulk_update(self):
+        self.d['5'] = {'5':'55'}
+        self.d.update({'6':{'5':'65'}})
+        with self.d.transaction():
+            self.d['7'] = {'5':'75'}
+        self.assertFalse(self._conn.in_transaction)
+        other = sqlite3.connect(self._tempfile[1])
+        self.assertEqual(other.execute('SELECT COUNT(*) FROM DefaultTable__rows').fetchone()[0], 3)
+        other.close()
+
+    def test_transaction_after_writes(self):
+        self.d['5'] = {'5':'55'}
+        with self.d.transaction():
+            self.d['6'] = {'5':'65'}
+        self.assertFalse(self._conn.in_transaction)
+
+    def test_sparse_storage(self):
+        self.d.chunk_size = 2
+        self.d.update({str(n): {'c%d' % n: n} for n in range(5)})
+        self.d['0'] = {'c1':1}
+        self.d['1']['c1'] = None
+        self.assertEqual(self._conn.execute('SELECT _id, col, value FROM DefaultTable__cells').fetchall(),
+                         [('0', 'c1', 1), ('2', 'c2', 2), ('3', 'c3', 3), ('4', 'c4', 4)])
+        self.assertEqual(len(self.d['1']), 5)
+        self.assertEqual(dict(self.d.iter_rows())['3'], {'c0':None, 'c1':None, 'c2':None, 'c3':3, 'c4':None})
+        self.assertEqual(list(self.d.query(['c2'], {'c2':2, '_id':('>', '1')})), [('2', {'c2':2})])
+        plan = self._conn.execute('EXPLAIN QUERY PLAN SELECT _id FROM DefaultTable__cells WHERE col = ? AND value = ?',
+                                  ('c2', 2)).fetchall()
+        self.assertIn('ix_DefaultTable__cells_col', str(plan))
+
+    def test_migrate(self):
+        self.d.close()
+        self._conn.execute('DROP TABLE DefaultTable__cells')
+        wide = SqliteTable(self._conn)
+        wide.update({'5':{'5':'55', '6':5.5}, '6':{'7':b'67'}, '7':{}})
+        wide.close()
+        expected = {'5':{'5':'55', '6':5.5, '7':None}, '6':{'5':None, '6':None, '7':b'67'},
+                    '7':{'5':None, '6':None, '7':None}}
+        with self.assertRaises(ValueError):
+            SparseSqliteTable(self._conn)
+
+        migrate_to_sparse(self._conn)
+        self.assertEqual(layout_of(self._conn), 'sparse')
+        self.d = SparseSqliteTable(self._conn)
+        self.assertEqual(self.d, expected)
+        with self.assertRaises(ValueError):
+            migrate_to_sparse(self._conn)
+
+        self.d.close()
+        migrate_to_wide(self._conn)
+        self.assertEqual(layout_of(self._conn), 'wide')
+        self.d = SqliteTable(self._conn)
+        self.assertEqual(self.d, expected)
+        self.assertEqual(list(self.d.column_types().items()), [('5', 'TEXT'), ('6', 'REAL'), ('7', 'BLOB')])
+
+    def test_open_table(self):
+        self.d['5'] = {'5':'55'}
+        self.assertIsInstance(open_table(self._conn), SparseSqliteTable)
+        self.assertIsInstance(open_table(self._conn, 'Other'), SqliteTable)
+        with self.assertRaises(ValueError):
+            open_table(self._conn, layout='eav')
+
+        wide = open_table(self._conn, layout='wide')
+        self.assertIsInstance(wide, SqliteTable)
+        self.assertEqual(wide, {'5':{'5':'55'}})
+        # Past the threshold while open, the table moves on the next open_table()
+        wide['6'] = {'6':'66', '7':'67'}
+        self.assertIsInstance(open_table(self._conn, column_threshold=3), SqliteTable)
+        self.d = open_table(self._conn, column_threshold=2)
+        self.assertIsInstance(self.d, SparseSqliteTable)
+        self.assertEqual(self.d['6'], {'5':None, '6':'66', '7':'67'})
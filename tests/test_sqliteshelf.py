@@ -1,10 +1,12 @@
 import unittest
-from es_commons.suppress2 import suppress
+from collections import OrderedDict
 import sqlite3
 import os
 import tempfile
 from tests.test_mutabletable import DictTableTest
+from sqlite_shelf.mutabletable import DictTable
 from sqlite_shelf.sqliteshelf import SqliteTable
+from sqlite_shelf.instrumentation import profile
 
 
 class SqliteTableTest(DictTableTest):
@@ -24,6 +26,350 @@ class SqliteTableTest(DictTableTest):
         os.remove(self._tempfile[1])
         pass
 
+    def test_bulk_update(self):
+        self.d['5'] = {'5':'55', '6':'56'}
+        stats = self.d.bulk_update([('5', {'7':7}), ('6', {'6':'66'}),
+                                    ('7', {'5':'75'}), ('7', None),
+                                    ('8', None), ('8', {'8':8.5})])
+        self.assertEqual(stats.rows, 6)
+        self.assertIs(self.d.last_ingest_stats, stats)
+        self.assertGreater(stats.rows_per_sec, 0)
+        self.assertEqual(self.d, {'5':{'5':'55', '6':'56', '7':7, '8':None},
+                                  '6':{'5':None, '6':'66', '7':None, '8':None},
+                                  '8':{'5':None, '6':None, '7':None, '8':8.5}})
+        self.assertIsInstance(self.d['8']['8'], float)
+
+    def test_bulk_update_rollback(self):
+        self.d['5'] = {'5':'55'}
+        with self.assertRaises(sqlite3.Error):
+            self.d.bulk_update({'6':{'6':'66'}, '7':{'_id':'x', '5':object()}})
+        self.assertEqual(self.d, {'5':{'5':'55'}})
+
+    def test_iter_while_writing(self):
+        self.d.update({'5':{'5':'55'}, '6':{'5':'65'}})
+        for row in self.d:
+            self.d[row]['6'] = row
+        self.assertEqual(self.d, {'5':{'5':'55', '6':'5'}, '6':{'5':'65', '6':'6'}})
+
+    def test_iter_rows_chunked(self):
+        self.d.chunk_size = 2
+        expected = {str(n):{'5':n} for n in range(5)}
+        self.d.update(expected)
+        self.assertEqual(dict(self.d.iter_rows()), expected)
+        self.assertEqual(dict(self.d.iter_rows(chunk_size=5)), expected)
+        for row_key, row in self.d.items():
+            row['6'] = row_key
+        self.assertEqual([dict(row) for row in self.d.values()],
+                         [{'5':n, '6':str(n)} for n in range(5)])
+
+    def test_indexes(self):
+        self.d.update({'1':{'status':'failed', 'n':1}, '2':{'status':'ok', 'n':2}})
+        self.assertEqual(self.d.list_indexes(), [])
+        name = self.d.create_index('status')
+        self.d.create_index(['n', 'status'], name='ix_failed', where={'status':'failed'})
+        self.assertEqual(sorted(self.d.list_indexes()),
+                         [('ix_DefaultTable_status', ('status',), False, False),
+                          ('ix_failed', ('n', 'status'), False, True)])
+        plan = self._conn.execute('EXPLAIN QUERY PLAN SELECT * FROM DefaultTable WHERE status = ?', ('ok',)).fetchall()
+        self.assertIn(name, str(plan))
+        self.assertEqual(list(self.d.query(['n'], {'status':'ok'})), [('2', {'n':2})])
+
+        self.d.drop_index(name)
+        self.assertEqual([index.name for index in self.d.list_indexes()], ['ix_failed'])
+        with self.assertRaises(KeyError):
+            self.d.drop_index(name)
+        with self.assertRaises(KeyError):
+            self.d.create_index('x')
+
+    def test_index_advisor(self):
+        self.d.update({'1':{'status':'failed', 'n':1}})
+        self.d.enable_index_advisor(threshold=2)
+        list(self.d.query(where={'n':('>', 0), 'status':'failed', 'x':1}))
+        self.assertEqual(self.d.suggest_indexes(), [])
+        list(self.d.query(where={'n':('>', 0), 'status':'failed'}))
+        self.assertEqual(self.d.suggest_indexes(), [(('status', 'n'), 2)])
+        self.assertEqual(self.d.list_indexes(), [])
+
+        self.d.enable_index_advisor(threshold=1, auto_create=True)
+        list(self.d.query(where={'n':1}))
+        self.assertEqual([index.columns for index in self.d.list_indexes()], [('n',)])
+        self.assertEqual(self.d.suggest_indexes(), [])
+
+    def test_stale_schema_write(self):
+        self.d['5'] = {'5':'55'}
+        self._conn.commit()
+        other = sqlite3.connect(self._tempfile[1])
+        other.execute('ALTER TABLE DefaultTable ADD COLUMN "6" TEXT')
+        other.commit()
+        other.close()
+        self.d['5']['6'] = '56'
+        self.assertEqual(self.d, {'5':{'5':'55', '6':'56'}})
+
+    def test_sql_cache(self):
+        self.d.disable_write_behind()
+        self.d.sql_cache_size = 2
+        self.d['1'] = {}
+        for col in ['5', '6', '7']:
+            self.d['1'][col] = col
+        self.assertEqual(list(self.d._sql_cache), [('6',), ('7',)])
+        self.d['1']['6'] = '66'
+        self.assertEqual(list(self.d._sql_cache), [('7',), ('6',)])
+
+    def test_schema_cache(self):
+        self.d['5'] = {'5':'55', '6':56}
+        self.assertEqual(list(self.d.column_types().items()), [('5', 'TEXT'), ('6', 'INT')])
+        info = self.d.schema_cache_info()
+        self.assertEqual(list(self.d['5']), ['5', '6'])
+        self.assertGreater(self.d.schema_cache_info().hits, info.hits)
+        self.assertEqual(self.d.schema_cache_info().misses, info.misses)
+
+        self._conn.commit()
+        other = sqlite3.connect(self._tempfile[1])
+        other.execute('ALTER TABLE DefaultTable ADD COLUMN "7" TEXT')
+        other.commit()
+        other.close()
+        self.assertEqual(list(self.d['5']), ['5', '6', '7'])
+        self.assertEqual(self.d.schema_cache_info().invalidations, info.invalidations + 1)
+
+
+
+    def test_change_tracking(self):
+        self.d['1'] = {'a':1}
+        with self.assertRaises(TypeError):
+            list(self.d.changes_since())
+        self.d.enable_change_tracking()
+        self.assertEqual(self.d.change_version(), 0)
+        self.d['1']['a'] = 2
+        self.d['2'] = {'b':'x'}
+        del self.d['1']
+        self.d.bulk_update([('2', {'a':3}), ('3', {'a':4}), ('4', None), ('3', None), ('5', {'b':'y'})])
+        self.d.fill_column('a', 0)
+        changes = list(self.d.changes_since())
+        self.assertEqual([change[1:] for change in changes],
+                         [('1', 'update', ('a',)), ('2', 'insert', ('a', 'b')), ('1', 'delete', None),
+                          ('2', 'update', ('a',)), ('5', 'insert', ('b',)), ('5', 'update', ('a',))])
+        self.assertEqual([change.version for change in changes], list(range(1, 7)))
+        self.assertEqual(list(self.d.changes_since(5)), changes[5:])
+        self.assertEqual(self.d.row_version('2'), 4)
+        self.assertIsNone(self.d.row_version('3'))
+
+        with self.assertRaises(ZeroDivisionError):
+            with self.d.transaction():
+                self.d['6'] = {'a':6}
+                1 / 0
+        self.assertEqual(self.d.change_version(), 6)
+
+        self.assertEqual(self.d.compact_changes(deletes_before=4), 4)
+        self.assertEqual([change[1:] for change in self.d.changes_since()],
+                         [('2', 'insert', ('a', 'b')), ('5', 'insert', ('a', 'b'))])
+        self.d.rename_column('a', 'c')
+        self.assertEqual(self.d.changes_since(6).__next__()[1:], ('2', 'update', ('a', 'c')))
+        self.d.disable_change_tracking()
+        self.assertNotIn('DefaultTable__changes', [r[0] for r in self._conn.execute('SELECT name FROM sqlite_master')])
+
+    def test_new_column_with_unmapped_type(self):
+        self.d['5'] = {'5':1}
+        self.d['5'].update({'5':True, '6':'56'})
+        self.assertEqual(self.d['5'], {'5':1, '6':'56'})
+        self.d.fill_column('5', False, overwrite=True)
+        with self.assertRaises(KeyError):
+            self.d['5'].update({'5':1, '7':True})
+
+    def test_tracking_enabled_elsewhere(self):
+        self.d['1'] = {'a':1}
+        self.d.flush()
+        self._conn.commit()
+        conn = sqlite3.connect(self._tempfile[1])
+        other = SqliteTable(conn)
+        other.enable_change_tracking()
+        conn.commit()
+        self.d['2'] = {'a':2}
+        del self.d['1']
+        self.assertEqual(sorted(change[1:3] for change in self.d.changes_since()), [('1', 'delete'), ('2', 'insert')])
+        self._conn.commit()
+        self.assertEqual(other.change_version(), 2)
+        other.disable_change_tracking()
+        conn.commit()
+        self.d['3'] = {'a':3}
+        with self.assertRaises(TypeError):
+            self.d.change_version()
+        other.close()
+        conn.close()
+
+    def test_autocommit(self):
+        self._conn.commit()
+        other = sqlite3.connect(self._tempfile[1])
+        count = lambda: other.execute('SELECT COUNT(*) FROM DefaultTable').fetchone()[0]
+        with self.d.transaction(autocommit_every=2):
+            for n in range(5):
+                self.d[str(n)] = {'n':n}
+            self.assertEqual(count(), 4)
+            self.assertEqual(self.d._transaction.commits, 2)
+        self.assertEqual(count(), 5)
+        other.close()
+
+    def test_query_as_evaluate(self):
+        rows = {'1':{'status':'failed', 'n':1}, '2':{'status':'ok', 'n':2}, '3':{'n':3}}
+        self.d.update(rows)
+        table = DictTable()
+        table.update(rows)
+        for args in [(['_id', 'n'], {'n':('>', 1)}, '-_id'), (['n', 'x', '_id'], {'status':None}),
+                     (None, {'_id':('in', ['1', '3'])}, 'n', 1)]:
+            self.assertEqual(list(self.d.query(*args)), list(table.query(*args)))
+
+    def test_transaction_after_bulk_update(self):
+        self.d['5'] = {'5':'55'}
+        self.d.update({'6':{'5':'65'}})
+        self.d.create_index('5')
+        with self.d.transaction():
+            self.d['7'] = {'5':'75'}
+        self.assertFalse(self._conn.in_transaction)
+        other = sqlite3.connect(self._tempfile[1])
+        self.assertEqual(other.execute('SELECT COUNT(*) FROM DefaultTable').fetchone()[0], 3)
+        other.close()
+
+    def test_transaction_after_writes(self):
+        # Writes outside transaction() leave the connection's implicit transaction open
+        self.d['5'] = {'5':'55'}
+        with self.d.transaction():
+            self.d['6'] = {'5':'65'}
+        self.assertFalse(self._conn.in_transaction)
+        other = sqlite3.connect(self._tempfile[1])
+        self.assertEqual(other.execute('SELECT COUNT(*) FROM DefaultTable').fetchone()[0], 2)
+        other.close()
+
+    def test_transaction_in_open_transaction(self):
+        self.d['5'] = {'5':'55'}
+        self._conn.commit()
+        self._conn.execute('INSERT INTO DefaultTable (_id) VALUES (?)', ('6',))
+        with self.assertRaises(ZeroDivisionError):
+            with self.d.transaction():
+                self.d['7'] = {'5':'75'}
+                1 / 0
+        self.assertTrue(self._conn.in_transaction)
+        self._conn.commit()
+        self.assertEqual(sorted(self.d), ['5', '6'])
+
+    def test_drop_indexed_column(self):
+        self.d.update({'5':{'5':'55', '6':'56', '7':'57', '_':None}})
+        self.d.create_index('5')
+        self.d.create_index('6', where={'5':'55'})
+        self.d.create_index(['6', '7'], name='ix_67')
+        self.d.create_index('6', name='ix_literal', where={'6':'"5"'})
+        # Neither _ as a wildcard nor the string literal "5" name a column
+        self.d.drop_column('_')
+        self.assertEqual(sorted(index.name for index in self.d.list_indexes()),
+                         ['ix_67', 'ix_DefaultTable_5', 'ix_DefaultTable_6', 'ix_literal'])
+        self.d.drop_column('5')
+        self.assertEqual(sorted(index.name for index in self.d.list_indexes()), ['ix_67', 'ix_literal'])
+        self.d.drop_index('ix_literal')
+        # Rebuild used before SQLite 3.35
+        self.d._rebuild(OrderedDict([('6', 'six'), ('7', '7')]))
+        self.assertEqual(self.d['5'], {'six':'56', '7':'57'})
+        self.assertEqual([index.columns for index in self.d.list_indexes()], [('six', '7')])
+
+
+class CachedSqliteTableTest(SqliteTableTest):
+
+    def setUp(self):
+        SqliteTableTest.setUp(self)
+        self.d.enable_row_cache(maxbytes=4096)
+
+    def test_row_cache_affinity(self):
+        self.d['5'] = {'5':1}
+        view = self.d['5']
+        self.assertEqual(view['5'], 1)
+        self.d['5']['5'] = '2'
+        self.assertEqual(self.d['5']['5'], 2)
+        view['5'] = '3'
+        self.assertEqual(view['5'], 3)
+        for row, view in self.d.items():
+            view['5'] = '4'
+            self.assertEqual(view['5'], 4)
+        self.assertEqual(self.d['5'], {'5':4})
+
+
+class InstrumentedSqliteTableTest(SqliteTableTest):
+
+    def setUp(self):
+        SqliteTableTest.setUp(self)
+        self.d.enable_metrics()
+
+    def test_metrics(self):
+        self.d.update({'5':{'5':'55'}})
+        self.assertEqual(self.d['5']['5'], '55')
+        info = self.d.metrics_info()
+        self.assertGreater(info['sql.select'].count, 0)
+        self.assertGreater(info['sql.pragma'].count, 0)
+        self.assertGreater(info['sql.insert'].count, 0)
+        self.assertEqual(info['_get_cells'].count, 1)
+
+        with profile(self.d) as metrics:
+            list(self.d.iter_rows())
+        self.assertEqual(set(metrics.stats()), {'sql.select'})
+        self.assertEqual(self.d.metrics_info()['_get_cells'].count, 1)
+
+        self.d.disable_metrics()
+        self.assertIs(type(self.d), SqliteTable)
+        self.assertIsInstance(self.d._c, sqlite3.Cursor)
+
+
+class WriteBehindSqliteTableTest(SqliteTableTest):
+
+    def setUp(self):
+        SqliteTableTest.setUp(self)
+        self.d.enable_write_behind(max_rows=3, max_age=60)
+
+    def _stored(self):
+        return self._conn.execute('SELECT COUNT(*) FROM DefaultTable').fetchone()[0]
+
+    def test_write_behind(self):
+        self.d['1'] = {'5':'15'}
+        self.d['1']['6'] = '16'
+        self.d['2'] = {'6':'26'}
+        self.assertEqual(self._stored(), 0)
+        self.assertTrue('2' in self.d)
+        self.assertEqual(self.d['1'], {'5':'15', '6':'16'})
+        self.assertEqual(self.d['2'], {'5':None, '6':'26'})
+        self.assertEqual(list(self.d['2']), ['5', '6'])
+
+        del self.d['2']
+        self.assertFalse('2' in self.d)
+        self.assertEqual(self._stored(), 1)
+        self.d['2'] = {'5':'25'}
+        self.d['3'] = {'5':'35'}
+        self.assertEqual(self._stored(), 1)
+        self.d['4'] = {'5':'45'}
+        self.assertEqual(self._stored(), 4)
+
+        self.d['1']['5'] = '150'
+        self.assertEqual(self._conn.execute('SELECT "5" FROM DefaultTable WHERE _id = ?', ('1',)).fetchone(), ('15',))
+        self.d.flush()
+        self.assertEqual(self._conn.execute('SELECT "5" FROM DefaultTable WHERE _id = ?', ('1',)).fetchone(), ('150',))
+
+        self.d.enable_write_behind(max_rows=100, max_age=0)
+        self.d['5'] = {'5':'55'}
+        self.assertEqual(self._stored(), 5)
+
+    def test_failed_flush(self):
+        self.d['1'] = {'5':'15'}
+        self.d.flush()
+        with self.assertRaises(KeyError):
+            self.d['2'] = {'6':object()}
+        with self.assertRaises(sqlite3.Error):
+            self.d['2'] = {'5':object()}
+        self.d['2'] = {'5':'25', '7':'27'}
+        self._conn.execute("""CREATE TRIGGER reject BEFORE INSERT ON DefaultTable
+                              WHEN NEW."5" = '25' BEGIN SELECT RAISE(ABORT, 'rejected'); END""")
+        with self.assertRaises(sqlite3.IntegrityError):
+            len(self.d)
+        # The failed batch is kept, for flush() to retry
+        self.d['3'] = {'5':'35'}
+        self.assertEqual(self.d['2'], {'5':'25', '7':'27'})
+        self.assertEqual(self._stored(), 1)
+        self._conn.execute('DROP TRIGGER reject')
+        self.d.flush()
+        self.assertEqual(self.d, {'1':{'5':'15', '7':None}, '2':{'5':'25', '7':'27'}, '3':{'5':'35', '7':None}})
 
 
 if __name__ == '__main__':
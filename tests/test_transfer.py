@@ -0,0 +1,57 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+from sqlite_shelf.mutabletable import DictTable
+from sqlite_shelf.sqliteshelf import SqliteTable
+from sqlite_shelf.csvshelf import CsvTable
+from sqlite_shelf.transfer import import_csv, export_csv, copy_rows
+
+
+class TransferTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._conn = sqlite3.connect(os.path.join(self._tempdir, 'table.db'))
+        self.d = SqliteTable(self._conn)
+        self.rows = {str(n): {'a':str(n), 'b':'line\nbreak "%d"' % n if n % 3 else None}
+                     for n in range(25)}
+        self.csv = os.path.join(self._tempdir, 'rows.csv')
+        table = CsvTable(self.csv)
+        table.update(self.rows)
+        table.close()
+
+    def tearDown(self):
+        self.d.close()
+        self._conn.close()
+        shutil.rmtree(self._tempdir)
+
+    def test_import(self):
+        for parser in [None, 'thread', 'process']:
+            self.d.clear()
+            stats = import_csv(self.csv, self.d, chunk_size=4, parser=parser)
+            self.assertEqual(stats.rows, 25)
+            self.assertEqual(self.d, self.rows)
+        with self.assertRaises(ValueError):
+            import_csv(self.csv, self.d, parser='fork')
+
+    def test_export(self):
+        import_csv(self.csv, self.d)
+        exported = os.path.join(self._tempdir, 'exported.csv')
+        self.assertEqual(export_csv(self.d, exported, order_by='_id'), 25)
+        expected = CsvTable(os.path.join(self._tempdir, 'expected.csv'))
+        expected.update(sorted(self.rows.items()))
+        expected.close()
+        with open(exported, 'rb') as f, open(os.path.join(self._tempdir, 'expected.csv'), 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+    def test_copy_rows(self):
+        import_csv(self.csv, self.d)
+        target = DictTable()
+        self.assertEqual(copy_rows(self.d, target, chunk_size=10, where={'b':None}).rows, 9)
+        self.assertEqual(sorted(target), sorted(row for row, cells in self.rows.items() if cells['b'] is None))
+
+
+if __name__ == '__main__':
+    unittest.main()